@@ -0,0 +1,264 @@
+# benchmarks/bench_helpers.py
+"""Micro-benchmark các hàm xử lý chuỗi / so khớp / tổng hợp chạy ở mỗi lượt tương tác.
+
+Import main như thư viện (không dựng giao diện, không cần Google Sheets) rồi đo trên danh sách
+SV tổng hợp 100 / 1k / 10k người. Câu tìm kiếm và câu hỏi trợ lý trộn có dấu, không dấu,
+gõ sai 1 ký tự, chỉ tên + đệm, 4 số cuối MSSV. Cột thời gian trộn nhiều định dạng.
+
+Mỗi phép đo chạy nhiều vòng, báo min/median/mean/stddev theo µs cho 1 lượt gọi (kiểu
+pytest-benchmark). Kết quả lưu JSON để lần sau so sánh khi đổi logic so khớp:
+
+    python benchmarks/bench_helpers.py --save                    # ghi benchmarks/results/helpers.json
+    python benchmarks/bench_helpers.py --compare                 # so với file đó, exit 1 nếu chậm/kém đi
+    python benchmarks/bench_helpers.py --sizes 1000 -k find --rounds 9
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import unicodedata
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(HERE), HERE]
+DEFAULT_RESULTS = os.path.join(HERE, "results", "helpers.json")
+
+from fake_sheets import synthetic_roster  # noqa: E402
+
+N_QUERIES = 100
+TIME_FORMATS = ["%Y-%m-%d %H:%M:%S", "%d/%m/%Y %H:%M:%S", "%H:%M:%S", "%H:%M"]
+
+
+def _plain(s: str) -> str:
+    s = unicodedata.normalize("NFD", s)
+    s = "".join(ch for ch in s if unicodedata.category(ch) != "Mn")
+    return unicodedata.normalize("NFC", s).replace("đ", "d").replace("Đ", "D")
+
+
+def _typo(s: str, rnd: random.Random) -> str:
+    """Gõ sai 1 ký tự: bỏ, lặp, đổi chỗ hoặc thay."""
+    i = rnd.randrange(1, len(s) - 1)
+    kind = rnd.randrange(4)
+    if kind == 0:
+        return s[:i] + s[i + 1:]
+    if kind == 1:
+        return s[:i] + s[i] + s[i:]
+    if kind == 2:
+        return s[:i - 1] + s[i] + s[i - 1] + s[i + 1:]
+    return s[:i] + rnd.choice("aeinhtu") + s[i + 1:]
+
+
+class Dataset:
+    """Worksheet tổng hợp n SV + các bộ đầu vào cho từng hàm."""
+
+    def __init__(self, main, n: int, seed: int = 0):
+        rnd = random.Random(seed)
+        values = synthetic_roster(n, present_rate=0.6, seed=seed)
+        headers = values[0]
+        tcols = [i for i, h in enumerate(headers) if h.startswith("Thời gian")]
+        base = datetime.datetime(2025, 9, 1, 7, 0, 0)
+        for k, c in enumerate(tcols):
+            main_fmt = TIME_FORMATS[k % len(TIME_FORMATS)]   # mỗi cột 1 định dạng chính + ~10% ô lệch
+            for row in values[1:]:
+                if row[c]:
+                    fmt = main_fmt if rnd.random() < 0.9 else rnd.choice(TIME_FORMATS)
+                    row[c] = (base + datetime.timedelta(seconds=rnd.randrange(5400))).strftime(fmt)
+                elif rnd.random() < 0.05:
+                    row[c] = rnd.choice(["x", "7h30", "?"])   # ô gõ tay lỗi
+        self.values = values
+        self.headers = headers
+        self.roster = main.RosterSnapshot.from_values(values)
+        self.roster.search_index()
+        self.roster.mssv_index()
+        self.names = [row[1] for row in values[1:]]
+        self.time_columns = [[row[c] for row in values[1:]] for c in tcols]
+        self.times = [v for col in self.time_columns for v in col]
+        self.buoi_cols = main.detect_buoi_columns(headers)
+
+        picks = [values[rnd.randrange(1, len(values))] for _ in range(N_QUERIES)]
+        self.targets = [row[0] for row in picks]
+        self.target_idx = [self.roster.mssv_index().by_full[mssv][0] - 2 for mssv in self.targets]
+        self.queries = []
+        for i, row in enumerate(picks):
+            name = row[1]
+            kind = i % 10
+            if kind < 3:
+                q = name                                 # đúng, có dấu
+            elif kind < 5:
+                q = _plain(name).lower()                 # không dấu
+            elif kind < 8:
+                q = _typo(rnd.choice([name, _plain(name)]), rnd)   # gõ sai 1 ký tự
+            elif kind < 9:
+                q = " ".join(name.split()[-2:])          # chỉ tên đệm + tên
+            else:
+                q = row[0][-4:]                          # 4 số cuối MSSV
+            self.queries.append(q)
+        templates = ["Buổi {b} {name} có đi học không?", "{name} đi mấy buổi?", "buoi {b} {name} co di hoc khong",
+                     "MSSV {mssv} đi mấy buổi?", "Ai đi học sớm nhất buổi {b}?", "Tổ {to} buổi {b} có bao nhiêu SV?",
+                     "sinh vien {name} vang may buoi", "Buổi {b} có bao nhiêu SV đi học?"]
+        self.questions = [
+            templates[i % len(templates)].format(
+                b=rnd.randrange(1, 7), to=rnd.randrange(1, 9), mssv=row[0],
+                name=q if not q.isdigit() else row[1])
+            for i, (row, q) in enumerate(zip(picks, self.queries))
+        ]
+
+
+def benchmarks(main, ds: Dataset) -> dict:
+    """{tên: (hàm chạy 1 lô, số lượt gọi trong lô)}."""
+    roster = ds.roster
+    matrix = roster.attendance()
+    headers, buoi_cols = ds.headers, ds.buoi_cols
+    return {
+        "strip_accents": (lambda: [main.strip_accents(s) for s in ds.names], len(ds.names)),
+        "norm_search": (lambda: [main.norm_search(s) for s in ds.names], len(ds.names)),
+        "normalize_name": (lambda: [main.normalize_name(s) for s in ds.queries], len(ds.queries)),
+        "find_student_candidates": (lambda: [main.find_student_candidates(roster, q) for q in ds.queries],
+                                    len(ds.queries)),
+        "find_student_row": (lambda: [main.find_student_row(roster, q) for q in ds.queries], len(ds.queries)),
+        "search_index_build": (lambda: main.RosterSnapshot(roster.headers, roster.records).search_index(), 1),
+        "detect_buoi_columns": (lambda: main.detect_buoi_columns(headers), 1),
+        "build_time_map": (lambda: main.build_time_map(headers, buoi_cols), 1),
+        "parse_question": (lambda: [main.parse_question(q, buoi_cols) for q in ds.questions], len(ds.questions)),
+        "parse_time": (lambda: [main.parse_time(v) for v in ds.times], len(ds.times)),
+        "parse_time_column": (lambda: [main.parse_time_column(col) for col in ds.time_columns], len(ds.times)),
+        "student_summary": (lambda: [matrix.student_summary(i) for i in ds.target_idx], len(ds.target_idx)),
+        "at_risk": (lambda: matrix.at_risk(3, 2), 1),
+    }
+
+
+def hit_rate(main, ds: Dataset) -> dict:
+    """Tỷ lệ câu tìm kiếm trả về đúng SV cần tìm (đo chất lượng so khớp, không phải tốc độ)."""
+    roster = ds.roster
+    cand_hits = row_hits = 0
+    for q, mssv in zip(ds.queries, ds.targets):
+        cand_hits += any(r and r.get("MSSV") == mssv for r in main.find_student_candidates(roster, q))
+        row = main.find_student_row(roster, q)
+        row_hits += bool(row) and row.get("MSSV") == mssv
+    return {"find_student_candidates": round(cand_hits / len(ds.queries), 3),
+            "find_student_row": round(row_hits / len(ds.queries), 3)}
+
+
+def measure(fn, calls: int, rounds: int, min_time: float) -> dict:
+    """Chạy `rounds` vòng; mỗi vòng lặp lô đủ `min_time` giây. Trả thống kê µs / lượt gọi."""
+    fn()   # làm nóng (lru_cache, import trễ...)
+    loops = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        took = time.perf_counter() - t0
+        if took >= min_time or loops >= 1 << 16:
+            break
+        loops *= 2
+    per_call = [took / (loops * calls)]
+    for _ in range(rounds - 1):
+        t0 = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        per_call.append((time.perf_counter() - t0) / (loops * calls))
+    us = [x * 1e6 for x in per_call]
+    return {
+        "min_us": round(min(us), 3),
+        "median_us": round(statistics.median(us), 3),
+        "mean_us": round(statistics.fmean(us), 3),
+        "stddev_us": round(statistics.stdev(us), 3) if len(us) > 1 else 0.0,
+        "ops_per_s": round(1e6 / statistics.median(us), 1),
+        "calls": calls,
+        "rounds": rounds,
+        "loops": loops,
+    }
+
+
+def run(sizes, rounds: int, min_time: float, select: str | None = None, seed: int = 0) -> dict:
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    import main  # noqa: E402  (chỉ nạp hàm, không dựng giao diện)
+
+    results = {}
+    for n in sizes:
+        ds = Dataset(main, n, seed=seed)
+        hits = hit_rate(main, ds)
+        for name, (fn, calls) in benchmarks(main, ds).items():
+            if select and select not in name:
+                continue
+            results[f"{name}[{n}]"] = measure(fn, calls, rounds, min_time)
+            if name in hits:
+                results[f"{name}[{n}]"]["hit_rate"] = hits[name]
+    return {
+        "meta": {
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "sizes": list(sizes),
+            "seed": seed,
+        },
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float, hit_drop: float = 0.02) -> list[str]:
+    """In bảng so sánh median; trả danh sách phép đo chậm hơn baseline quá `threshold` lần
+    hoặc có tỷ lệ tìm đúng giảm quá `hit_drop`."""
+    worse = []
+    print(f"{'phép đo':<34}{'baseline µs':>13}{'hiện tại µs':>13}{'tỷ lệ':>9}{'tìm đúng':>16}")
+    for key, cur in current["results"].items():
+        base = baseline.get("results", {}).get(key)
+        if base is None:
+            print(f"{key:<34}{'—':>13}{cur['median_us']:>13.2f}{'mới':>9}")
+            continue
+        ratio = cur["median_us"] / base["median_us"] if base["median_us"] else float("inf")
+        hits = ""
+        hit_worse = False
+        if "hit_rate" in cur and "hit_rate" in base:
+            hits = f"{base['hit_rate']:.2f} → {cur['hit_rate']:.2f}"
+            hit_worse = cur["hit_rate"] < base["hit_rate"] - hit_drop
+        flag = "  ⚠️" if ratio > threshold or hit_worse else ""
+        print(f"{key:<34}{base['median_us']:>13.2f}{cur['median_us']:>13.2f}{ratio:>8.2f}x{hits:>16}{flag}")
+        if ratio > threshold or hit_worse:
+            worse.append(key)
+    return worse
+
+
+def print_report(res: dict):
+    print(f"{'phép đo':<34}{'min µs':>11}{'median µs':>11}{'mean µs':>11}{'stddev':>9}{'ops/s':>12}{'tìm đúng':>10}")
+    for key, r in res["results"].items():
+        hits = f"{r['hit_rate']:.2f}" if "hit_rate" in r else ""
+        print(f"{key:<34}{r['min_us']:>11.2f}{r['median_us']:>11.2f}{r['mean_us']:>11.2f}"
+              f"{r['stddev_us']:>9.2f}{r['ops_per_s']:>12.0f}{hits:>10}")
+
+
+def main_cli(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000], help="sĩ số danh sách tổng hợp")
+    ap.add_argument("--rounds", type=int, default=5, help="số vòng đo mỗi phép")
+    ap.add_argument("--min-time", type=float, default=0.05, help="thời gian tối thiểu mỗi vòng (giây)")
+    ap.add_argument("-k", dest="select", help="chỉ chạy phép đo có tên chứa chuỗi này")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--save", nargs="?", const=DEFAULT_RESULTS, help="lưu kết quả JSON (mặc định %(const)s)")
+    ap.add_argument("--compare", nargs="?", const=DEFAULT_RESULTS, help="so với file JSON đã lưu")
+    ap.add_argument("--threshold", type=float, default=1.25, help="chậm hơn baseline quá N lần thì báo lỗi")
+    args = ap.parse_args(argv)
+
+    res = run(args.sizes, args.rounds, args.min_time, args.select, args.seed)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            slower = compare(res, json.load(f), args.threshold)
+    else:
+        print_report(res)
+        slower = []
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(res, f, ensure_ascii=False, indent=2)
+    if slower:
+        print(f"Chậm hơn baseline quá {args.threshold}x hoặc tìm đúng ít hơn: {', '.join(slower)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,138 @@
+# benchmarks/bench_importtime.py
+"""Chi phí khởi động theo từng đường vào của app, đo bằng `python -X importtime`.
+
+Mỗi lần đo chạy 1 tiến trình Python mới (giống tiến trình Streamlit vừa khởi động), import main
+rồi đi hết 1 đường vào:
+  import : chỉ import main
+  sv     : trang SV (?sv=1) — 1 lượt điểm danh trên worksheet giả
+  gv     : trang GV — vẽ QR, tính bảng điểm danh, dựng DataFrame xuất file
+
+Chế độ `eager` import sẵn pandas/numpy/altair/qrcode trước khi import main, tức đúng chi phí
+của bản cũ (import tất cả ở đầu file); `lazy` là bản hiện tại.
+
+    python benchmarks/bench_importtime.py
+    python benchmarks/bench_importtime.py --paths sv --repeat 9 --json importtime.json
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+HEAVY = ("pandas", "numpy", "altair", "qrcode", "PIL")
+_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$")
+
+_PRELUDE = """
+import sys, time, logging
+sys.path[:0] = [{root!r}, {here!r}]
+t0 = time.perf_counter()
+{eager}
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+import main
+"""
+
+_PATHS = {
+    "import": "",
+    "sv": """
+from fake_sheets import FakeWorksheet, synthetic_roster
+ws = FakeWorksheet(synthetic_roster(200, seed=1))
+status, _ = main.checkin_student(ws, "Buổi 1", "0007", ws.rows[8][1])
+assert status == "ok", status
+""",
+    "gv": """
+from fake_sheets import FakeWorksheet, synthetic_roster
+ws = FakeWorksheet(synthetic_roster(200, present_rate=0.5, seed=1))
+main.render_qr_png(main.qr_payload("http://localhost:8501", "Buổi 1", 0))
+roster = main.get_roster(ws)
+roster.attendance()
+main.export_frame(roster)
+""",
+}
+
+_EPILOGUE = """
+import json
+print(json.dumps({{"elapsed": time.perf_counter() - t0,
+                  "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def script_for(path: str, mode: str) -> str:
+    eager = "import pandas, numpy, altair, qrcode" if mode == "eager" else ""
+    return (_PRELUDE.format(root=ROOT, here=HERE, eager=eager) + _PATHS[path]
+            + _EPILOGUE.format(heavy=HEAVY))
+
+
+def parse_importtime(stderr: str) -> dict:
+    """Tổng thời gian import cấp 1 và thời gian riêng (self) của mọi module thuộc từng thư viện nặng, µs."""
+    total, heavy = 0, {}
+    for line in stderr.splitlines():
+        m = _LINE.match(line)
+        if not m:
+            continue
+        own, cum, indent, name = int(m.group(1)), int(m.group(2)), m.group(3), m.group(4)
+        if not indent:
+            total += cum
+        pkg = name.split(".", 1)[0]
+        if pkg in HEAVY:
+            heavy[pkg] = heavy.get(pkg, 0) + own
+    return {"total_us": total, "heavy_us": heavy}
+
+
+def measure(path: str, mode: str) -> dict:
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", script_for(path, mode)],
+                          capture_output=True, text=True, cwd=ROOT)
+    out = [l for l in proc.stdout.splitlines() if l.startswith("{")]
+    if proc.returncode != 0 or not out:
+        raise RuntimeError(f"{path}/{mode} lỗi:\n{proc.stderr[-2000:]}")
+    res = json.loads(out[-1])
+    res.update(parse_importtime(proc.stderr))
+    return res
+
+
+def run(paths, modes, repeat: int) -> dict:
+    results = {}
+    for path in paths:
+        for mode in modes:
+            runs = [measure(path, mode) for _ in range(repeat)]
+            results[f"{path}/{mode}"] = {
+                "path": path, "mode": mode,
+                "import_ms": statistics.median(r["total_us"] for r in runs) / 1000,
+                "elapsed_ms": statistics.median(r["elapsed"] for r in runs) * 1000,
+                "heavy_ms": {m: statistics.median(r["heavy_us"].get(m, 0) for r in runs) / 1000
+                             for m in HEAVY if any(m in r["heavy_us"] for r in runs)},
+                "loaded": runs[-1]["loaded"],
+            }
+    return results
+
+
+def print_report(results: dict):
+    print(f"{'đường vào':<14}{'import (ms)':>13}{'tới xong (ms)':>15}  thư viện nặng đã nạp")
+    for key, r in results.items():
+        heavy = ", ".join(f"{m} {ms:.0f}" for m, ms in r["heavy_ms"].items()) or "—"
+        print(f"{key:<14}{r['import_ms']:>13.1f}{r['elapsed_ms']:>15.1f}  {heavy}")
+    for path in dict.fromkeys(r["path"] for r in results.values()):
+        eager, lazy = results.get(f"{path}/eager"), results.get(f"{path}/lazy")
+        if eager and lazy:
+            print(f"{path}: lazy nhanh hơn eager {eager['elapsed_ms'] - lazy['elapsed_ms']:+.0f} ms")
+
+
+def main_cli(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--paths", nargs="+", choices=list(_PATHS), default=list(_PATHS))
+    ap.add_argument("--modes", nargs="+", choices=["eager", "lazy"], default=["eager", "lazy"])
+    ap.add_argument("--repeat", type=int, default=5, help="số tiến trình mỗi ô, lấy trung vị")
+    ap.add_argument("--json", help="ghi kết quả ra file JSON")
+    args = ap.parse_args(argv)
+    results = run(args.paths, args.modes, args.repeat)
+    print_report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
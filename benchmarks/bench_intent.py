@@ -0,0 +1,164 @@
+# benchmarks/bench_intent.py
+"""Micro-benchmark: thời gian phân tích 1 câu hỏi của trợ lý (có dấu / không dấu).
+
+So sánh bộ định tuyến biên dịch sẵn (main.parse_question) với cách cũ: định nghĩa lại
+helper mỗi lượt, SequenceMatcher trên cả câu với từng cách viết, duyệt nhánh tuần tự.
+
+    python benchmarks/bench_intent.py              # 2000 lượt mỗi câu
+    python benchmarks/bench_intent.py -n 500 --json out.json
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+import unicodedata
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BUOI_COLS = ["Buổi 1", "Buổi 2", "Buổi 3", "Buổi 4", "Buổi 5", "Buổi 6"]
+
+CORPUS_ACCENTED = [
+    "Buổi 3 có bao nhiêu SV đi học?",
+    "Tổ 2 buổi 5 có bao nhiêu SV có mặt?",
+    "Ai đi học sớm nhất buổi 2?",
+    "Ai đến muộn nhất buổi 4?",
+    "Buổi 1 Thái có đi học không?",
+    "MSSV 511250123 đi mấy buổi?",
+    "Nguyễn Văn An có vắng không?",
+    "Tỷ lệ chuyên cần trung bình là bao nhiêu?",
+    "Danh sách vắng quá 2 buổi",
+    "Buổi 6 tổ 3 thế nào?",
+    "Sinh viên Trần Thị Bình đi mấy buổi?",
+    "Cho tôi xem thống kê lớp",
+    # tên giống "trễ/sớm nhất" không được hiểu thành câu hỏi sớm nhất / muộn nhất
+    "Buổi 2 Trần Nhật có đi học không?",
+    "Buổi 2 Sơn Nhật có đi học không?",
+    "Buổi 3 Trần Nhật có đi học không",
+]
+
+# ý định bắt buộc (cả bản có dấu lẫn không dấu); sai thì thoát với mã lỗi
+EXPECTED = {
+    "Buổi 2 Trần Nhật có đi học không?": "student_in_buoi",
+    "Buổi 2 Sơn Nhật có đi học không?": "student_in_buoi",
+    "Buổi 3 Trần Nhật có đi học không": "student_in_buoi",
+    "Ai đi học sớm nhất buổi 2?": "extreme_time",
+    "Ai đến muộn nhất buổi 4?": "extreme_time",
+}
+
+def strip(s: str) -> str:
+    s = unicodedata.normalize("NFD", s)
+    s = "".join(ch for ch in s if unicodedata.category(ch) != "Mn")
+    return unicodedata.normalize("NFC", s).replace("đ", "d").replace("Đ", "D")
+
+CORPUS_PLAIN = [strip(q) for q in CORPUS_ACCENTED]
+
+def legacy_route(q_raw: str, buoi_cols: list[str]) -> str:
+    """Bản sao phần phân tích của render_tab_ai cũ (helper định nghĩa lại mỗi lượt)."""
+    import unicodedata, re  # noqa: F811 (như bản cũ)
+
+    def lv_norm(s):
+        s = (s or "").strip().lower()
+        s = unicodedata.normalize("NFD", s)
+        s = "".join(ch for ch in s if unicodedata.category(ch) != "Mn")
+        s = unicodedata.normalize("NFC", s)
+        return re.sub(r"\s+", " ", s)
+
+    def fuzzy_has(text_norm, variants, thresh=0.8):
+        from difflib import SequenceMatcher
+        for v in variants:
+            v2 = lv_norm(v)
+            if v2 in text_norm:
+                return True
+            if SequenceMatcher(None, text_norm, v2).ratio() >= thresh:
+                return True
+        return False
+
+    def extract_buoi(text_norm, buoi_cols):
+        for b in buoi_cols:
+            if lv_norm(b) in text_norm:
+                return b
+        m = re.search(r"\bbuoi\s*(\d+)\b", text_norm)
+        if m:
+            for b in buoi_cols:
+                if re.search(rf"\b{m.group(1)}\b", lv_norm(b)):
+                    return b
+        return None
+
+    def extract_name_candidate(text_norm):
+        stop = {"buoi", "buổi", "to", "tổ", "mssv", "sv", "student", "di", "đi", "hoc", "học", "co", "có",
+                "mat", "mặt", "vang", "vắng", "khong", "không", "ai", "nhat", "nhất", "som", "sớm", "muon",
+                "muộn", "den", "đến", "tre", "trễ", "bao", "nhiu", "nhieu", "bao nhieu", "ty", "le", "ty le",
+                "chuyen", "can", "chuyên", "cần", "trung", "binh", "trung binh", "la", "là", "khong di",
+                "co di", "khong co mat"}
+        tokens = re.findall(r"[a-zA-ZÀ-ỹ0-9]+", text_norm)
+        return " ".join(t for t in tokens if t not in stop and not t.isdigit()).strip() or None
+
+    qn = lv_norm(q_raw)
+    if fuzzy_has(qn, ["som nhat", "sớm nhất", "den som nhat", "som nhut", "somnha"]) or \
+       fuzzy_has(qn, ["muon nhat", "muộn nhất", "den muon nhat", "den tre nhat", "tre nhat"]):
+        return "extreme_time"
+    if any(w in qn for w in ["di hoc", "co mat", "vang", "khong"]):
+        if extract_buoi(qn, buoi_cols) and extract_name_candidate(qn):
+            return "student_in_buoi"
+    if any(w in qn for w in ["bao nhieu", "di hoc", "co mat", "vang"]):
+        return "buoi_stats"
+    if re.search(r"\bto\b", qn):
+        return "group_stats"
+    if "mssv" in qn or re.search(r"\b[0-9]{7,}\b", qn) or any(k in qn for k in ["sv ", "sinh vien"]):
+        return "student"
+    if "chuyen can" in qn or ("ty le" in qn and "buoi" not in qn):
+        return "rate"
+    if re.search(r"vang\s+qua\s+(\d+)\s*buoi", qn):
+        return "absent_over"
+    return "unknown"
+
+def bench(fn, corpus, n):
+    per_q = []
+    for q in corpus:
+        fn(q)  # làm nóng (lru_cache, regex...)
+        t0 = time.perf_counter()
+        for _ in range(n):
+            fn(q)
+        per_q.append((time.perf_counter() - t0) / n * 1e6)
+    return {"mean_us": round(statistics.fmean(per_q), 2), "median_us": round(statistics.median(per_q), 2),
+            "max_us": round(max(per_q), 2)}
+
+def main_cli(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("-n", type=int, default=2000, help="số lượt mỗi câu")
+    ap.add_argument("--json", help="lưu kết quả ra file JSON")
+    args = ap.parse_args(argv)
+
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    import main
+
+    routers = {
+        "legacy": lambda q: legacy_route(q, BUOI_COLS),
+        "router": lambda q: main.parse_question(q, BUOI_COLS).intent,
+    }
+    results = {}
+    print(f"{'bộ câu':<12}{'cách':<10}{'TB µs':>10}{'trung vị':>10}{'max':>10}")
+    for corpus_name, corpus in (("có dấu", CORPUS_ACCENTED), ("không dấu", CORPUS_PLAIN)):
+        for name, fn in routers.items():
+            r = bench(fn, corpus, args.n)
+            results[f"{corpus_name}/{name}"] = r
+            print(f"{corpus_name:<12}{name:<10}{r['mean_us']:>10}{r['median_us']:>10}{r['max_us']:>10}")
+
+    print("\nÝ định theo từng câu (cũ -> mới):")
+    for q in CORPUS_ACCENTED + CORPUS_PLAIN:
+        old, new = routers["legacy"](q), routers["router"](q)
+        print(f"  {'  ' if old == new else '* '}{q:<45} {old:<16} -> {new}")
+    wrong = [(q, want, routers["router"](q)) for q0, want in EXPECTED.items() for q in (q0, strip(q0))
+             if routers["router"](q) != want]
+    for q, want, got in wrong:
+        print(f"LỖI: {q!r} -> {got}, cần {want}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 1 if wrong else 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,202 @@
+# benchmarks/fake_sheets.py
+"""Worksheet giả trong bộ nhớ thay cho gspread, dùng cho load test và benchmark.
+
+Mô phỏng độ trễ mạng, quota theo phút (đọc/ghi riêng như Sheets API) và lỗi 429 ngẫu nhiên;
+đếm số lệnh gọi theo từng endpoint để so sánh trước/sau khi tối ưu.
+"""
+import random
+import threading
+import time
+from collections import Counter, deque
+
+import gspread
+from gspread.utils import a1_to_rowcol
+
+HO = ["Nguyễn", "Trần", "Lê", "Phạm", "Hoàng", "Huỳnh", "Phan", "Vũ", "Võ", "Đặng", "Bùi", "Đỗ", "Hồ", "Ngô"]
+DEM = ["Văn", "Thị", "Hữu", "Minh", "Ngọc", "Thanh", "Quốc", "Gia", "Đức", "Thùy", "Hoài", "Bảo"]
+TEN = ["An", "Bình", "Cường", "Dũng", "Hà", "Hải", "Hạnh", "Hùng", "Khoa", "Lan", "Linh", "Mai",
+       "Nam", "Phúc", "Quân", "Thảo", "Trang", "Tuấn", "Vy", "Yến", "Thái", "Nhi", "Long", "Huy"]
+
+def synthetic_roster(n: int, sessions: int = 6, prefix: str = "51125", present_rate: float = 0.0,
+                     groups: int = 8, seed: int = 0) -> list[list[str]]:
+    """Giá trị worksheet (dòng 1 là tiêu đề) gồm n SV, mỗi buổi có cột Buổi + Thời gian."""
+    rnd = random.Random(seed)
+    headers = ["MSSV", "Họ và Tên", "Tổ"]
+    for b in range(1, sessions + 1):
+        headers += [f"Buổi {b}", f"Thời gian Buổi {b}"]
+    rows = [headers]
+    for i in range(n):
+        row = [f"{prefix}{i:04d}", f"{rnd.choice(HO)} {rnd.choice(DEM)} {rnd.choice(TEN)}", str(i % groups + 1)]
+        for b in range(sessions):
+            if rnd.random() < present_rate:
+                row += ["✅", f"2025-09-{b+1:02d} 07:{rnd.randrange(60):02d}:{rnd.randrange(60):02d}"]
+            else:
+                row += ["", ""]
+        rows.append(row)
+    return rows
+
+class FakeResponse:
+    def __init__(self, status_code: int, message: str):
+        self.status_code = status_code
+        self.text = message
+
+    def json(self):
+        return {"error": {"code": self.status_code, "message": self.text, "status": "RESOURCE_EXHAUSTED"}}
+
+class FakeCell:
+    def __init__(self, row, col, value):
+        self.row, self.col, self.value = row, col, value
+
+class FakeSpreadsheet:
+    def __init__(self, key: str = "fake-spreadsheet"):
+        self.id = key
+        self.title = key
+        self._worksheets = {}
+        self.modified = 0
+
+    def worksheet(self, name):
+        ws = self._worksheets[name]
+        ws._api("worksheet", "read")
+        return ws
+
+    def get_lastUpdateTime(self):
+        next(iter(self._worksheets.values()))._api("get_lastUpdateTime", "read")
+        return f"rev-{self.modified}"
+
+class FakeWorksheet:
+    """Worksheet trong bộ nhớ với các method gspread mà app dùng.
+
+    latency/jitter: giây mỗi lệnh gọi; quota_per_min: giới hạn đọc và ghi (riêng) mỗi 60 giây,
+    vượt thì ném APIError 429; error_rate: xác suất ném 429 ngẫu nhiên.
+    """
+
+    def __init__(self, values, title="D25C", spreadsheet=None, ws_id=0, latency=0.0, jitter=0.0,
+                 quota_per_min=None, error_rate=0.0, seed=0):
+        self.title = title
+        self.id = ws_id
+        self.spreadsheet = spreadsheet or FakeSpreadsheet()
+        self.spreadsheet._worksheets[title] = self
+        self.rows = [list(r) for r in values]
+        self.latency, self.jitter = latency, jitter
+        self.quota_per_min = quota_per_min
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.errors = Counter()
+        self._lock = threading.Lock()
+        self._rnd = random.Random(seed)
+        self._window = {"read": deque(), "write": deque()}
+
+    # ---------- mô phỏng mạng / quota ----------
+    def _api(self, endpoint: str, kind: str):
+        with self._lock:
+            self.calls[endpoint] += 1
+            now = time.monotonic()
+            win = self._window[kind]
+            while win and now - win[0] > 60:
+                win.popleft()
+            over = self.quota_per_min is not None and len(win) >= self.quota_per_min
+            if not over:
+                win.append(now)
+            inject = self._rnd.random() < self.error_rate
+            delay = max(0.0, self.latency + self._rnd.uniform(-self.jitter, self.jitter))
+        if delay:
+            time.sleep(delay)
+        if over or inject:
+            self.errors[endpoint] += 1
+            raise gspread.exceptions.APIError(FakeResponse(429, "Quota exceeded (fake)"))
+
+    def _get(self, r, c):
+        if r - 1 < len(self.rows) and c - 1 < len(self.rows[r-1]):
+            return self.rows[r-1][c-1]
+        return ""
+
+    def _set(self, r, c, v):
+        with self._lock:
+            while len(self.rows) < r:
+                self.rows.append([])
+            row = self.rows[r-1]
+            row.extend([""] * (c - len(row)))
+            row[c-1] = v
+            self.spreadsheet.modified += 1
+
+    def _width(self):
+        return max((len(r) for r in self.rows), default=0)
+
+    # ---------- đọc ----------
+    def find(self, query):
+        self._api("find", "read")
+        for i, row in enumerate(self.rows, 1):
+            for j, v in enumerate(row, 1):
+                if str(v) == str(query):
+                    return FakeCell(i, j, v)
+        return None
+
+    def cell(self, row, col):
+        self._api("cell", "read")
+        return FakeCell(row, col, self._get(row, col))
+
+    def row_values(self, row):
+        self._api("row_values", "read")
+        vals = list(self.rows[row-1]) if row - 1 < len(self.rows) else []
+        while vals and vals[-1] == "":
+            vals.pop()
+        return vals
+
+    def col_values(self, col):
+        self._api("col_values", "read")
+        vals = [self._get(r, col) for r in range(1, len(self.rows) + 1)]
+        while vals and vals[-1] == "":
+            vals.pop()
+        return vals
+
+    def get_all_values(self):
+        self._api("get_all_values", "read")
+        w = self._width()
+        return [list(r) + [""] * (w - len(r)) for r in self.rows]
+
+    def get_all_records(self, **kwargs):
+        self._api("get_all_records", "read")
+        w = self._width()
+        vals = [list(r) + [""] * (w - len(r)) for r in self.rows]
+        return [dict(zip(vals[0], r)) for r in vals[1:]] if vals else []
+
+    def get(self, range_name, **kwargs):
+        self._api("get", "read")
+        start, _, end = range_name.partition(":")
+        r1, c1 = a1_to_rowcol(start)
+        r2, c2 = a1_to_rowcol(end or start)
+        return [[self._get(r, c) for c in range(c1, c2 + 1)] for r in range(r1, r2 + 1)]
+
+    def batch_get(self, ranges, **kwargs):
+        """Nhiều vùng trong 1 lệnh; hỗ trợ thêm vùng cả dòng ("1:1") / cả cột ("B:B")."""
+        self._api("batch_get", "read")
+        out = []
+        for rng in ranges:
+            start, _, end = rng.partition(":")
+            end = end or start
+            if start.isdigit():
+                r1, r2, c1, c2 = int(start), int(end), 1, self._width()
+            elif start.isalpha():
+                c1, c2 = a1_to_rowcol(f"{start}1")[1], a1_to_rowcol(f"{end}1")[1]
+                r1, r2 = 1, len(self.rows)
+            else:
+                (r1, c1), (r2, c2) = a1_to_rowcol(start), a1_to_rowcol(end)
+            vals = [[self._get(r, c) for c in range(c1, c2 + 1)] for r in range(r1, r2 + 1)]
+            for row in vals:
+                while row and row[-1] == "":
+                    row.pop()
+            while vals and not vals[-1]:
+                vals.pop()
+            out.append(vals)
+        return out
+
+    # ---------- ghi ----------
+    def update_cell(self, row, col, value):
+        self._api("update_cell", "write")
+        self._set(row, col, value)
+
+    def batch_update(self, data, **kwargs):
+        self._api("batch_update", "write")
+        for item in data:
+            r, c = a1_to_rowcol(item["range"].split(":")[0])
+            self._set(r, c, item["values"][0][0])
@@ -0,0 +1,161 @@
+# benchmarks/loadtest_checkin.py
+"""Load test: N SV cùng quét QR trong 1 khung giờ, chạy logic điểm danh thật của main.py
+trên worksheet giả trong bộ nhớ.
+
+Ví dụ:
+    python benchmarks/loadtest_checkin.py --students 200 --window 30 --latency 0.25 --quota 60
+    python benchmarks/loadtest_checkin.py --json out.json            # lưu kết quả
+    python benchmarks/loadtest_checkin.py --baseline out.json        # so với lần trước
+
+In ra p50/p95/p99 thời gian điểm danh, số lệnh gọi API mỗi lượt và tỷ lệ lỗi.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_sheets import FakeWorksheet, synthetic_roster  # noqa: E402
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+def run(args) -> dict:
+    if args.journal:
+        os.environ["ATTENDANCE_JOURNAL"] = args.journal
+    if args.app_quota:
+        os.environ["SHEETS_QUOTA_PER_MIN"] = str(args.app_quota)
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    import main  # noqa: E402  (đọc ENV ở trên khi tạo các cache dùng chung)
+
+    values = synthetic_roster(args.roster, sessions=6, seed=args.seed)
+    ws = FakeWorksheet(values, latency=args.latency, jitter=args.jitter,
+                       quota_per_min=args.quota, error_rate=args.error_rate, seed=args.seed)
+    sheet = ws if args.no_limiter else main.QuotaAwareClient(ws, main.get_api_limiter())
+
+    rnd = random.Random(args.seed)
+    students = rnd.sample(range(1, len(values)), args.students)
+    dup = [rnd.choice(students) for _ in range(int(args.students * args.duplicates))]
+    jobs = [(i, rnd.uniform(0, args.window)) for i in students + dup]
+    results = []
+    lock = threading.Lock()
+    positions = []
+    queue = main.CheckinQueue(workers=args.queue) if args.queue else None
+    t0 = time.monotonic()
+
+    def one(job):
+        idx, arrive = job
+        time.sleep(max(0.0, arrive - (time.monotonic() - t0)))
+        row = values[idx]
+        start = time.monotonic()
+        try:
+            if queue is None:
+                status, _ = main.checkin_student(sheet, args.buoi, row[0][-4:], row[1])
+            else:   # như trang SV: trả lời từ bộ nhớ nếu được, còn lại xếp hàng
+                fast = main.checkin_from_memory(sheet, args.buoi, row[0][-4:], row[1])
+                if fast is None:
+                    ticket = queue.submit(main.checkin_student, sheet, args.buoi, row[0][-4:], row[1])
+                    with lock:
+                        positions.append(ticket.position())
+                    ticket.wait()
+                    fast = ticket.result()
+                status = fast[0]
+        except Exception as e:
+            status = f"error:{type(e).__name__}"
+        with lock:
+            results.append((status, time.monotonic() - start))
+
+    with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+        list(pool.map(one, jobs))
+    main.get_write_queue().flush(timeout=60)
+    syncer = main.get_journal_syncer()
+    if syncer is not None:
+        syncer.sync_once()
+    wall = time.monotonic() - t0
+
+    lat = [d for _, d in results]
+    statuses = Counter(s for s, _ in results)
+    errors = sum(n for s, n in statuses.items() if s.startswith("error"))
+    total_calls = sum(ws.calls.values())
+    return {
+        "students": args.students,
+        "checkins": len(results),
+        "window_s": args.window,
+        "wall_s": round(wall, 2),
+        "latency_p50_ms": round(percentile(lat, 50) * 1000, 1),
+        "latency_p95_ms": round(percentile(lat, 95) * 1000, 1),
+        "latency_p99_ms": round(percentile(lat, 99) * 1000, 1),
+        "latency_mean_ms": round(statistics.fmean(lat) * 1000, 1) if lat else None,
+        "api_calls_total": total_calls,
+        "api_calls_per_checkin": round(total_calls / max(1, len(results)), 3),
+        "api_calls_by_endpoint": dict(ws.calls),
+        "api_429": dict(ws.errors),
+        "error_rate": round(errors / max(1, len(results)), 4),
+        "statuses": dict(statuses),
+        "queue_workers": args.queue,
+        "queue_max_position": max(positions, default=0),
+    }
+
+def print_report(res: dict, baseline: dict | None = None):
+    keys = ["checkins", "wall_s", "latency_p50_ms", "latency_p95_ms", "latency_p99_ms",
+            "api_calls_total", "api_calls_per_checkin", "error_rate"]
+    print(f"{'chỉ số':<24}{'hiện tại':>14}" + (f"{'baseline':>14}{'chênh':>12}" if baseline else ""))
+    for k in keys:
+        line = f"{k:<24}{res[k]:>14}"
+        if baseline and k in baseline and isinstance(baseline[k], (int, float)):
+            diff = res[k] - baseline[k]
+            line += f"{baseline[k]:>14}{diff:>+12.3f}"
+        print(line)
+    print("endpoint :", res["api_calls_by_endpoint"])
+    print("429      :", res["api_429"])
+    print("trạng thái:", res["statuses"])
+    if res.get("queue_workers"):
+        print(f"hàng đợi : {res['queue_workers']} worker, vị trí xa nhất {res['queue_max_position']}")
+
+def main_cli(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--students", type=int, default=200, help="số SV quét mã")
+    ap.add_argument("--roster", type=int, default=250, help="sĩ số trong worksheet giả")
+    ap.add_argument("--window", type=float, default=30, help="khung thời gian SV quét (giây)")
+    ap.add_argument("--buoi", default="Buổi 1")
+    ap.add_argument("--duplicates", type=float, default=0.1, help="tỷ lệ quét lại (máy thứ 2, F5...)")
+    ap.add_argument("--latency", type=float, default=0.2, help="độ trễ mỗi lệnh gọi API (giây)")
+    ap.add_argument("--jitter", type=float, default=0.05)
+    ap.add_argument("--quota", type=int, default=60, help="quota giả lập mỗi phút (đọc/ghi riêng); 0 = không giới hạn")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="xác suất 429 ngẫu nhiên mỗi lệnh gọi")
+    ap.add_argument("--app-quota", type=int, default=0, help="ghi đè sheets_quota_per_min của app")
+    ap.add_argument("--no-limiter", action="store_true", help="gọi thẳng worksheet giả, bỏ qua bộ giới hạn của app")
+    ap.add_argument("--journal", default="", help="bật chế độ nhật ký SQLite (đường dẫn file .db)")
+    ap.add_argument("--queue", type=int, default=0,
+                    help="đi qua hàng đợi điểm danh với N worker như trang SV; 0 = gọi thẳng")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", help="lưu kết quả ra file JSON")
+    ap.add_argument("--baseline", help="file JSON của lần chạy trước để so sánh")
+    args = ap.parse_args(argv)
+    args.quota = args.quota or None
+    args.students = min(args.students, args.roster)
+
+    res = run(args)
+    baseline = json.load(open(args.baseline, encoding="utf-8")) if args.baseline else None
+    print_report(res, baseline)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(res, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,21 +1,62 @@
 # main.py
+from __future__ import annotations
+
 import os
 import io
+import sys
 import re
 import time
+import atexit
 import base64
+import threading
 import urllib.parse
 import unicodedata
 import datetime
-from difflib import get_close_matches
+import json
+import random
+import sqlite3
+import bisect
+import heapq
+import itertools
+import contextlib
+import contextvars
+import functools
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from difflib import SequenceMatcher
 
 import streamlit as st
 import gspread
 from google.oauth2.service_account import Credentials
-from PIL import Image
-import qrcode
-import pandas as pd
-import altair as alt
+
+
+class _LazyModule:
+    """Thư viện nặng chỉ được import ở lần dùng đầu tiên.
+
+    Trang SV (?sv=1) không cần pandas/numpy/altair/qrcode; import sẵn ở đầu file
+    khiến mỗi tiến trình mới tốn thêm vài trăm ms trước khi trả lời lượt quét đầu tiên.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._mod = None
+
+    def __getattr__(self, attr):
+        mod = self._mod
+        if mod is None:
+            __import__(self._name)   # qua lệnh import thường để -X importtime vẫn đo được
+            mod = self._mod = sys.modules[self._name]
+        return getattr(mod, attr)
+
+    def __repr__(self):
+        state = "đã nạp" if self._mod is not None else "chưa nạp"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+qrcode = _LazyModule("qrcode")
+np = _LazyModule("numpy")
+pd = _LazyModule("pandas")
+alt = _LazyModule("altair")
 
 # ===================== CẤU HÌNH CHUNG =====================
 QR_SLOT_SECONDS = 30          # đổi 1 chỗ cho toàn app (30 giây là khuyến nghị)
@@ -30,8 +71,6 @@ SHEET_KEY = "1P7SOGsmb2KwBX50MU1Y1iVCYtjTiU7F7jLqgp6Bl8Bo"  # Đổi nếu cần
 WORKSHEET_NAME = "D25C"                                     # Đổi nếu cần
 VN_TZ = datetime.timezone(datetime.timedelta(hours=7))
 
-st.set_page_config(page_title="QR Lecturer", layout="wide")
-
 # ===================== TIỆN ÍCH CHUNG =====================
 def get_query_params():
     # Streamlit mới: st.query_params; fallback: experimental
@@ -40,6 +79,19 @@ def get_query_params():
     raw = st.experimental_get_query_params()
     return {k: (v[0] if isinstance(v, list) and v else v) for k, v in raw.items()}
 
+def get_setting(name: str, default=None):
+    """Đọc cấu hình: Secrets (gốc hoặc block google_service_account) → ENV (chữ HOA) → mặc định."""
+    try:
+        if name in st.secrets:
+            return st.secrets[name]
+        if "google_service_account" in st.secrets:
+            maybe = st.secrets["google_service_account"].get(name)
+            if maybe is not None:
+                return maybe
+    except Exception:
+        pass  # chưa có secrets.toml
+    return os.getenv(name.upper(), default)
+
 def normalize_name(name: str):
     return " ".join(w.capitalize() for w in (name or "").strip().split())
 
@@ -54,6 +106,15 @@ def norm_search(s: str) -> str:
 def attendance_flag(val) -> bool:
     return str(val or "").strip() != ""
 
+def row_cell(row_values: list, col: int | None) -> str:
+    # row_values() cắt bỏ ô trống ở cuối dòng -> cột vượt độ dài là ô rỗng
+    if not col or col > len(row_values):
+        return ""
+    return str(row_values[col-1] or "")
+
+def mssv_digits(val) -> str:
+    return re.sub(r"\D", "", str(val or ""))
+
 # ===================== MẬT KHẨU GV (Secrets/ENV) =====================
 def _get_teacher_pw():
     if "teacher_password" in st.secrets:
@@ -84,6 +145,284 @@ def render_gv_auth():
                 else:
                     st.warning("Sai mật khẩu hoặc chưa cấu hình `teacher_password` trong Secrets/ENV.")
 
+# ===================== ĐO HIỆU NĂNG (INSTRUMENTATION) =====================
+# Đếm số lệnh gọi, số byte và thời gian theo (nhóm, tên): lệnh gọi Sheets, vẽ QR, nạp danh sách,
+# vẽ từng mục. Tổng hợp theo từng lượt chạy trang (rerun) và theo cửa sổ trượt cho mọi phiên.
+# Đặt Secrets/ENV `metrics_export` = đường dẫn file .jsonl để ghi từng sự kiện ra file.
+METRICS_WINDOW = 300          # giây; cửa sổ trượt tổng hợp cho mọi phiên
+METRICS_MAX_EVENTS = 50_000   # trần số sự kiện giữ trong bộ nhớ
+
+_rerun_stats = contextvars.ContextVar("rerun_stats", default=None)
+
+def _approx_bytes(obj) -> int:
+    """Ước lượng kích thước dữ liệu trả về/gửi đi (chuỗi, bytes, list/dict lồng nhau)."""
+    if obj is None:
+        return 0
+    if isinstance(obj, (bytes, bytearray)):
+        return len(obj)
+    if isinstance(obj, str):
+        return len(obj.encode("utf-8"))
+    if isinstance(obj, dict):
+        return sum(_approx_bytes(k) + _approx_bytes(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return sum(_approx_bytes(x) for x in obj)
+    if isinstance(obj, (int, float, bool)):
+        return 8
+    return 0
+
+class RerunStats:
+    """Số liệu của 1 lượt chạy trang: (nhóm, tên) -> [số lần, byte, giây]."""
+
+    def __init__(self, label: str, rerun_id: int):
+        self.label = label
+        self.rerun_id = rerun_id
+        self.started = time.time()
+        self.wall = 0.0
+        self.items = defaultdict(lambda: [0, 0, 0.0])
+
+    def add(self, category: str, name: str, seconds: float, nbytes: int):
+        it = self.items[(category, name)]
+        it[0] += 1; it[1] += nbytes; it[2] += seconds
+
+    def rows(self) -> list[dict]:
+        return [{"Nhóm": c, "Tên": n, "Số lần": k, "KB": round(b / 1024, 1), "ms": round(s * 1000, 1)}
+                for (c, n), (k, b, s) in sorted(self.items.items(), key=lambda kv: -kv[1][2])]
+
+class PerfMetrics:
+    """Bộ đo dùng chung mọi phiên: cửa sổ trượt + (tùy chọn) xuất JSON lines."""
+
+    def __init__(self, window: float = METRICS_WINDOW, export_path: str | None = None):
+        self.window = window
+        self._lock = threading.Lock()
+        self._events = deque(maxlen=METRICS_MAX_EVENTS)   # (ts, nhóm, tên, giây, byte)
+        self._rerun_ids = itertools.count(1)
+        self._export = open(export_path, "a", encoding="utf-8") if export_path else None
+
+    def _write(self, obj: dict):
+        if self._export is not None:
+            self._export.write(json.dumps(obj, ensure_ascii=False) + "\n")
+
+    def record(self, category: str, name: str, seconds: float, nbytes: int = 0):
+        now = time.time()
+        stats = _rerun_stats.get()
+        if stats is not None:
+            stats.add(category, name, seconds, nbytes)
+        with self._lock:
+            self._events.append((now, category, name, seconds, nbytes))
+            self._write({"ts": round(now, 3), "rerun": stats.rerun_id if stats else None,
+                         "cat": category, "name": name,
+                         "ms": round(seconds * 1000, 3), "bytes": nbytes})
+
+    @contextlib.contextmanager
+    def rerun(self, label: str):
+        """Gom mọi số đo trong khối vào 1 RerunStats (kể cả khi trang dừng bằng st.stop/rerun)."""
+        stats = RerunStats(label, next(self._rerun_ids))
+        token = _rerun_stats.set(stats)
+        t0 = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats.wall = time.perf_counter() - t0
+            _rerun_stats.reset(token)
+            with self._lock:
+                self._write({"ts": round(stats.started, 3), "rerun": stats.rerun_id, "cat": "page",
+                             "name": label, "ms": round(stats.wall * 1000, 3),
+                             "calls": sum(k for k, _, _ in stats.items.values())})
+                if self._export is not None:
+                    self._export.flush()
+
+    def summary(self) -> list[dict]:
+        """Tổng hợp theo (nhóm, tên) trong cửa sổ trượt: số lần, KB, tổng/trung bình/p95 (ms)."""
+        cutoff = time.time() - self.window
+        with self._lock:
+            while self._events and self._events[0][0] < cutoff:
+                self._events.popleft()
+            events = list(self._events)
+        groups = defaultdict(list)
+        for _, c, n, s, b in events:
+            groups[(c, n)].append((s, b))
+        rows = []
+        for (c, n), items in groups.items():
+            secs = sorted(s for s, _ in items)
+            rows.append({"Nhóm": c, "Tên": n, "Số lần": len(secs),
+                         "KB": round(sum(b for _, b in items) / 1024, 1),
+                         "Tổng ms": round(sum(secs) * 1000, 1),
+                         "TB ms": round(sum(secs) / len(secs) * 1000, 1),
+                         "p95 ms": round(secs[min(len(secs) - 1, int(len(secs) * 0.95))] * 1000, 1)})
+        rows.sort(key=lambda r: -r["Tổng ms"])
+        return rows
+
+    def events_jsonl(self) -> str:
+        with self._lock:
+            events = list(self._events)
+        return "".join(json.dumps({"ts": round(t, 3), "cat": c, "name": n, "ms": round(s * 1000, 3),
+                                   "bytes": b}, ensure_ascii=False) + "\n"
+                       for t, c, n, s, b in events)
+
+    def close(self):
+        with self._lock:
+            if self._export is not None:
+                self._export.close()
+                self._export = None
+
+@st.cache_resource
+def get_metrics() -> PerfMetrics:
+    metrics = PerfMetrics(export_path=get_setting("metrics_export") or None)
+    atexit.register(metrics.close)
+    return metrics
+
+@contextlib.contextmanager
+def timed(category: str, name: str):
+    """Đo thời gian khối lệnh; gán box["bytes"] trong khối nếu muốn ghi kích thước dữ liệu."""
+    box = {"bytes": 0}
+    t0 = time.perf_counter()
+    try:
+        yield box
+    finally:
+        get_metrics().record(category, name, time.perf_counter() - t0, box["bytes"])
+
+# ===================== GIỚI HẠN QUOTA GOOGLE SHEETS =====================
+# Sheets API: ~60 request đọc và ~60 request ghi mỗi phút cho 1 service account.
+SHEETS_QUOTA_PER_MIN = 60     # đổi qua Secrets/ENV `sheets_quota_per_min`
+API_MAX_RETRIES = 5           # số lần thử lại khi gặp 429 / 5xx
+API_BACKOFF_BASE = 1.0        # giây; lần thử thứ n chờ ~ base * 2^n (có jitter)
+API_BACKOFF_MAX = 32
+API_BURST_FRACTION = 0.1      # phần quota được dùng dồn ngay; phần còn lại nạp đều theo thời gian
+
+PRIORITY_CHECKIN = 0          # ghi/đọc phục vụ SV điểm danh: đi trước
+PRIORITY_READ = 1             # đọc cho màn hình GV (tìm kiếm, thống kê, trợ lý)
+PRIORITY_BACKGROUND = 2       # việc nền (bộ đếm trực tiếp, dò thay đổi...)
+API_WAIT_TIMEOUT = {PRIORITY_CHECKIN: 30, PRIORITY_READ: 10, PRIORITY_BACKGROUND: 5}
+
+_api_priority = contextvars.ContextVar("api_priority", default=PRIORITY_READ)
+
+@contextlib.contextmanager
+def api_priority(priority: int):
+    """Các lệnh gọi Sheets trong khối này xếp hàng theo `priority` (nhỏ hơn đi trước)."""
+    token = _api_priority.set(priority)
+    try:
+        yield
+    finally:
+        _api_priority.reset(token)
+
+class SheetsBusyError(RuntimeError):
+    """Hết quota / Sheets quá tải sau khi đã chờ và thử lại."""
+
+class TokenBucket:
+    """Token bucket có hàng chờ ưu tiên: ai ưu tiên cao (số nhỏ) được cấp token trước.
+
+    Dồn tối đa `capacity` lệnh, nạp (per_minute - capacity) / 60 mỗi giây, nên mọi cửa sổ
+    60 giây cấp không quá per_minute token (bucket đầy ban đầu không vượt quota).
+    """
+
+    def __init__(self, per_minute: float, burst_fraction: float = API_BURST_FRACTION):
+        self.capacity = float(max(1, int(per_minute * burst_fraction)))
+        self.rate = max(per_minute - self.capacity, 1) / 60.0
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._seq = itertools.count()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, priority: int = PRIORITY_READ, timeout: float | None = None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    self._refill()
+                    if self._waiters[0] == entry and self.tokens >= 1:
+                        self.tokens -= 1
+                        return True
+                    wait = (1 - self.tokens) / self.rate if self._waiters[0] == entry else 1.0
+                    if deadline is not None:
+                        remain = deadline - time.monotonic()
+                        if remain <= 0:
+                            return False
+                        wait = min(wait, remain)
+                    self._cond.wait(max(wait, 0.01))
+            finally:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+def _api_status(err: Exception) -> int | None:
+    resp = getattr(err, "response", None)
+    return getattr(resp, "status_code", None) or getattr(err, "code", None)
+
+class SheetsRateLimiter:
+    """Giới hạn tốc độ dùng chung (đọc/ghi riêng) + thử lại có backoff khi gặp 429/5xx."""
+
+    def __init__(self, per_minute: float = SHEETS_QUOTA_PER_MIN):
+        self.buckets = {"read": TokenBucket(per_minute), "write": TokenBucket(per_minute)}
+
+    def call(self, kind: str, fn, *args, **kwargs):
+        priority = _api_priority.get()
+        bucket = self.buckets[kind]
+        for attempt in range(API_MAX_RETRIES + 1):
+            t0 = time.perf_counter()
+            ok = bucket.acquire(priority, timeout=API_WAIT_TIMEOUT.get(priority))
+            waited = time.perf_counter() - t0
+            if waited > 0.001:
+                get_metrics().record("quota", f"wait_{kind}", waited)
+            if not ok:
+                raise SheetsBusyError("Google Sheets đang quá tải, vui lòng thử lại sau ít giây.")
+            try:
+                return fn(*args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                status = _api_status(e)
+                if attempt >= API_MAX_RETRIES or not (status == 429 or (status or 0) >= 500):
+                    raise
+                delay = min(API_BACKOFF_MAX, API_BACKOFF_BASE * 2 ** attempt)
+                time.sleep(delay * random.uniform(0.5, 1.0))
+
+@st.cache_resource
+def get_api_limiter() -> SheetsRateLimiter:
+    return SheetsRateLimiter(float(get_setting("sheets_quota_per_min", SHEETS_QUOTA_PER_MIN)))
+
+_READ_CALLS = {
+    "open_by_key", "worksheet", "worksheets", "fetch_sheet_metadata", "get_lastUpdateTime",
+    "find", "findall", "cell", "row_values", "col_values", "get", "batch_get",
+    "get_values", "get_all_values", "get_all_records",
+}
+_WRITE_CALLS = {
+    "update_cell", "update_cells", "update", "batch_update", "append_row", "append_rows",
+    "insert_row", "insert_rows", "add_cols", "add_rows",
+}
+
+class QuotaAwareClient:
+    """Bọc client/spreadsheet/worksheet của gspread: mọi lệnh gọi API đi qua SheetsRateLimiter.
+
+    Thuộc tính thường (id, title, ...) đi thẳng; spreadsheet/worksheet trả về cũng được bọc.
+    """
+
+    def __init__(self, target, limiter: SheetsRateLimiter):
+        self._target = target
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name == "spreadsheet":
+            return QuotaAwareClient(attr, self._limiter)
+        kind = "read" if name in _READ_CALLS else "write" if name in _WRITE_CALLS else None
+        if kind is None or not callable(attr):
+            return attr
+
+        def _call(*args, **kwargs):
+            with timed("sheets", name) as box:
+                out = self._limiter.call(kind, attr, *args, **kwargs)
+                box["bytes"] = _approx_bytes(out) + (_approx_bytes(args) if kind == "write" else 0)
+            if name in ("open_by_key", "worksheet"):
+                return QuotaAwareClient(out, self._limiter)
+            return out
+        return _call
+
 # ===================== KẾT NỐI GOOGLE SHEETS =====================
 @st.cache_resource
 def _get_gspread_client():
@@ -120,37 +459,1119 @@ def _get_gspread_client():
     pk_clean = header + "\n" + "\n".join(body[i:i+64] for i in range(0, len(body), 64)) + "\n" + footer + "\n"
     cred["private_key"] = pk_clean
     creds = Credentials.from_service_account_info(cred, scopes=SCOPES)
-    return gspread.authorize(creds)
+    return QuotaAwareClient(gspread.authorize(creds), get_api_limiter())
 
-def get_sheet():
+@st.cache_resource
+def _open_worksheet(sheet_key: str, worksheet_name: str):
     client = _get_gspread_client()
-    ss = client.open_by_key(SHEET_KEY)
-    return ss.worksheet(WORKSHEET_NAME)
+    ss = client.open_by_key(sheet_key)
+    return ss.worksheet(worksheet_name)
+
+# ===================== LỚP HỌC (NHIỀU WORKSHEET / SPREADSHEET) =====================
+# Secrets/ENV `classes`: {mã lớp: "Worksheet" | "SheetKey/Worksheet" | {sheet_key, worksheet}}
+# hoặc danh sách tên worksheet (ENV dùng JSON). Không khai báo thì chỉ có lớp SHEET_KEY/WORKSHEET_NAME.
+# Mã lớp đi theo QR qua tham số `class`; mỗi worksheet có handle, schema, snapshot riêng.
+DASHBOARD_WORKERS = 8         # số lớp tải song song ở bảng tổng quan của GV
+
+def _parse_class_spec(class_id: str, spec) -> tuple[str, str]:
+    if isinstance(spec, str):
+        key, _, ws = spec.rpartition("/")
+        return key or SHEET_KEY, ws or class_id
+    spec = dict(spec)
+    return spec.get("sheet_key") or SHEET_KEY, spec.get("worksheet") or class_id
+
+@st.cache_resource
+def get_classes() -> dict[str, tuple[str, str]]:
+    """Mã lớp -> (sheet_key, tên worksheet), theo thứ tự khai báo."""
+    raw = get_setting("classes")
+    if isinstance(raw, str):
+        raw = json.loads(raw) if raw.strip() else None
+    if not raw:
+        return {WORKSHEET_NAME: (SHEET_KEY, WORKSHEET_NAME)}
+    if isinstance(raw, (list, tuple)):
+        return {str(ws): (SHEET_KEY, str(ws)) for ws in raw}
+    return {str(k): _parse_class_spec(str(k), v) for k, v in dict(raw).items()}
+
+def current_class() -> str:
+    """Lớp đang làm việc: lựa chọn ở sidebar GV > `class` trên URL (QR của SV) > lớp đầu tiên."""
+    classes = get_classes()
+    try:
+        cls = st.session_state.get("class_gv") or get_query_params().get("class")
+    except Exception:
+        cls = None
+    return cls if cls in classes else next(iter(classes))
+
+def get_sheet(class_id: str | None = None):
+    # handle worksheet dùng chung theo lớp, mỗi lớp chỉ mở (open_by_key + worksheet) 1 lần
+    sheet_key, worksheet_name = get_classes()[class_id or current_class()]
+    return _open_worksheet(sheet_key, worksheet_name)
+
+@st.cache_resource
+def get_dashboard_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=DASHBOARD_WORKERS, thread_name_prefix="dashboard")
+
+def map_classes(fn, class_ids):
+    """Chạy fn(class_id) song song cho nhiều lớp; trả {class_id: kết quả hoặc Exception}.
+
+    Mỗi lượt chạy trong bản sao context hiện tại (giữ mức ưu tiên API và số đo của lượt tải trang).
+    """
+    pool = get_dashboard_pool()
+    futures = {c: pool.submit(contextvars.copy_context().run, fn, c) for c in class_ids}
+    out = {}
+    for c, fut in futures.items():
+        try:
+            out[c] = fut.result()
+        except Exception as e:
+            out[c] = e
+    return out
+
+# ===================== GHI TRỄ THEO LÔ (WRITE-BEHIND) =====================
+WRITE_FLUSH_SECONDS = 0.3     # gom lệnh ghi trong khoảng này rồi đẩy 1 lần
+WRITE_BATCH_MAX = 200         # hoặc đẩy ngay khi đủ số ô đang chờ
+WRITE_CONFIRM_TIMEOUT = 20    # SV chờ xác nhận ghi tối đa (giây)
+
+def _ws_key(sheet):
+    return (sheet.spreadsheet.id, sheet.id)
+
+class SheetWriteQueue:
+    """Hàng đợi ghi dùng chung cho mọi phiên.
+
+    Gom các lệnh (row, col, value) rồi đẩy bằng 1 `batch_update` cho mỗi worksheet
+    sau `flush_seconds` hoặc khi đủ `batch_max` ô. Ô ghi trùng thì giá trị sau thắng.
+    Mỗi lệnh có thể kèm `callback(err)`: err=None nghĩa là lô chứa nó đã ghi xong.
+    """
+
+    def __init__(self, flush_seconds=WRITE_FLUSH_SECONDS, batch_max=WRITE_BATCH_MAX):
+        self.flush_seconds = flush_seconds
+        self.batch_max = batch_max
+        self._cond = threading.Condition()
+        self._pending = {}        # ws_key -> {"sheet", "cells": {(row, col): value}, "callbacks"}
+        self._count = 0
+        self._inflight = 0
+        self._flush_now = False
+        self._closed = False
+        self._listeners = []      # listener(sheet, {(row, col): value}) sau mỗi lô ghi thành công
+        self._thread = threading.Thread(target=self._run, name="sheet-write-queue", daemon=True)
+        self._thread.start()
+
+    def add_listener(self, fn):
+        self._listeners.append(fn)
+
+    def put(self, sheet, row: int, col: int, value, callback=None):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Hàng đợi ghi đã đóng.")
+            bucket = self._pending.setdefault(
+                _ws_key(sheet), {"sheet": sheet, "cells": {}, "callbacks": []}
+            )
+            if (row, col) not in bucket["cells"]:
+                self._count += 1
+            bucket["cells"][(row, col)] = value
+            if callback:
+                bucket["callbacks"].append(callback)
+            self._cond.notify_all()
+
+    def _run(self):
+        _api_priority.set(PRIORITY_CHECKIN)  # ghi điểm danh đi trước các lệnh đọc thống kê
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                # chờ gom thêm cho tới hạn flush (trừ khi đã đủ lô / được yêu cầu đẩy ngay)
+                deadline = time.monotonic() + self.flush_seconds
+                while self._count < self.batch_max and not (self._flush_now or self._closed):
+                    remain = deadline - time.monotonic()
+                    if remain <= 0:
+                        break
+                    self._cond.wait(remain)
+                batches, self._pending, self._count = self._pending, {}, 0
+                self._flush_now = False
+                self._inflight += 1
+            try:
+                for bucket in batches.values():
+                    self._write_bucket(bucket)
+            finally:
+                with self._cond:
+                    self._inflight -= 1
+                    self._cond.notify_all()
+
+    def _write_bucket(self, bucket):
+        data = [
+            {"range": gspread.utils.rowcol_to_a1(r, c), "values": [[v]]}
+            for (r, c), v in bucket["cells"].items()
+        ]
+        err = None
+        try:
+            bucket["sheet"].batch_update(data, value_input_option="USER_ENTERED")
+        except Exception as e:
+            err = e
+        if err is None:
+            for fn in self._listeners:
+                try:
+                    fn(bucket["sheet"], bucket["cells"])
+                except Exception:
+                    pass
+        for cb in bucket["callbacks"]:
+            try:
+                cb(err)
+            except Exception:
+                pass
+
+    def write_now(self, sheet, cells: dict):
+        """Ghi ngay {(row, col): value} bằng 1 batch_update (không gom chung lô khác), báo listener như thường."""
+        errors = []
+        self._write_bucket({"sheet": sheet, "cells": dict(cells), "callbacks": [errors.append]})
+        if errors[0] is not None:
+            raise errors[0]
+
+    def flush(self, timeout=None) -> bool:
+        """Đẩy ngay mọi lệnh đang chờ và đợi ghi xong. Trả False nếu quá `timeout`."""
+        with self._cond:
+            self._flush_now = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self._pending and not self._inflight, timeout)
+
+    def close(self, timeout=WRITE_CONFIRM_TIMEOUT):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+@st.cache_resource
+def get_write_queue() -> SheetWriteQueue:
+    q = SheetWriteQueue()
+    q.add_listener(get_roster_cache().patch_cells)  # ghi xong -> vá luôn snapshot
+    atexit.register(q.close)  # tắt app -> đẩy nốt các ô còn chờ
+    return q
+
+def write_cells_confirmed(sheet, cells, timeout=WRITE_CONFIRM_TIMEOUT, queue=None):
+    """Đưa các ô [(row, col, value), ...] vào hàng đợi và chờ tới khi chúng đã lên Sheet."""
+    if not cells:
+        return  # không có gì để ghi -> khỏi chờ callback sẽ không bao giờ tới
+    done = threading.Event()
+    lock = threading.Lock()
+    state = {"left": len(cells), "err": None}
+
+    def _cb(err):
+        with lock:
+            state["left"] -= 1
+            if err is not None and state["err"] is None:
+                state["err"] = err
+            if state["left"] <= 0 or err is not None:
+                done.set()
+
+    q = queue or get_write_queue()
+    for row, col, value in cells:
+        q.put(sheet, row, col, value, callback=_cb)
+    if not done.wait(timeout):
+        raise TimeoutError("Ghi Google Sheets quá lâu, vui lòng thử lại.")
+    if state["err"] is not None:
+        raise state["err"]
+
+# ===================== SNAPSHOT DANH SÁCH DÙNG CHUNG =====================
+ROSTER_TTL = 60               # giây; đổi qua Secrets/ENV `roster_ttl`
+ROSTER_MISS_REFRESH = 10      # không thấy MSSV -> nạp lại nếu snapshot cũ hơn số giây này
+ROSTER_RETRY_SECONDS = 10     # nạp lại lỗi -> dùng tạm bản cũ, thử lại sau số giây này
+
+_roster_versions = itertools.count(1)  # version tăng dần trên toàn tiến trình
+
+class MssvIndex:
+    """Chỉ mục MSSV → số dòng trên Sheet: theo MSSV đầy đủ (chỉ chữ số) và theo 4 số cuối."""
+
+    def __init__(self):
+        self.by_full = {}      # "511251234" -> [row, ...] (tăng dần)
+        self.by_suffix = {}    # "1234" -> [row, ...]
+        self._row_key = {}     # row -> MSSV (chữ số) đang được index
+
+    @classmethod
+    def build(cls, records: list[dict]):
+        idx = cls()
+        for row, r in enumerate(records, start=2):
+            idx.set_row(row, r.get("MSSV", ""))
+        return idx
+
+    def set_row(self, row: int, mssv):
+        old = self._row_key.pop(row, None)
+        if old:
+            for bucket, k in ((self.by_full, old), (self.by_suffix, old[-4:])):
+                rows = bucket.get(k, [])
+                if row in rows:
+                    rows.remove(row)
+                if not rows:
+                    bucket.pop(k, None)
+        ms = mssv_digits(mssv)
+        if not ms:
+            return
+        self._row_key[row] = ms
+        bisect.insort(self.by_full.setdefault(ms, []), row)
+        bisect.insort(self.by_suffix.setdefault(ms[-4:], []), row)
+
+    def rows_with_suffix(self, suffix: str) -> list[int]:
+        return list(self.by_suffix.get(suffix, []))
+
+    def find_row(self, mssv, suffix: str | None = None) -> int | None:
+        """Dòng của MSSV đầy đủ; nếu không có thì dòng đầu tiên có MSSV_PREFIX + 4 số cuối."""
+        rows = self.by_full.get(mssv_digits(mssv))
+        if rows:
+            return rows[0]
+        for row in self.by_suffix.get(suffix or "", []):
+            if self._row_key[row].startswith(MSSV_PREFIX):
+                return row
+        return None
+
+def _trigrams(s: str) -> set[str]:
+    return {s[i:i+3] for i in range(len(s) - 2)}
+
+class NameSearchIndex:
+    """Chỉ mục tìm theo họ tên, dựng 1 lần mỗi snapshot.
+
+    Giữ sẵn tên đã chuẩn hóa (norm_search) và chỉ mục ngược trigram → vị trí record.
+    Khớp chuỗi con dùng giao các trigram rồi kiểm tra lại. Khớp gần đúng cho đúng kết quả
+    của get_close_matches trên toàn bộ tên: cận trên quick_ratio của mọi tên được tính 1 lần
+    bằng ma trận đếm ký tự (numpy), chỉ các tên vượt cận mới phải chấm ratio().
+    """
+
+    def __init__(self, records: list[dict]):
+        self.records = records
+        self.names = [r.get("Họ và Tên", "") for r in records]
+        self.names_norm = [norm_search(n) for n in self.names]
+        self.name_map = {n: r for n, r in zip(self.names, records)}
+        self.norm_to_name = {nn: n for n, nn in zip(self.names, self.names_norm)}
+        self._grams = defaultdict(list)
+        for i, nn in enumerate(self.names_norm):
+            for g in _trigrams(f" {nn} "):
+                self._grams[g].append(i)
+        self._char_counts = {"names": self._count_chars(self.names), "norm": self._count_chars(self.names_norm)}
+
+    @staticmethod
+    def _count_chars(names: list[str]):
+        """(ký tự -> cột, ma trận số lần xuất hiện mỗi ký tự trong từng tên, độ dài từng tên)."""
+        alpha = {}
+        codes = [alpha.setdefault(ch, len(alpha)) for nm in names for ch in nm]
+        lengths = np.array([len(nm) for nm in names], dtype=np.int32)
+        counts = np.zeros((len(names), len(alpha)), dtype=np.int32)
+        np.add.at(counts, (np.repeat(np.arange(len(names)), lengths), np.array(codes, dtype=np.intp)), 1)
+        return alpha, counts, lengths
+
+    def contains(self, qn: str) -> list[int]:
+        """Vị trí các record có tên (đã chuẩn hóa) chứa `qn`, theo thứ tự trong Sheet."""
+        grams = _trigrams(qn)
+        if not grams:
+            return [i for i, nn in enumerate(self.names_norm) if qn in nn]
+        postings = sorted((self._grams.get(g, []) for g in grams), key=len)
+        cand = set(postings[0])
+        for p in postings[1:]:
+            cand.intersection_update(p)
+            if not cand:
+                return []
+        return [i for i in sorted(cand) if qn in self.names_norm[i]]
+
+    def _close(self, word: str, key: str, n: int, cutoff: float) -> list[str]:
+        """Cùng kết quả với get_close_matches(word, names, n, cutoff) (cùng bộ lọc, cùng thứ hạng)."""
+        names = self.names if key == "names" else self.names_norm
+        alpha, counts, lengths = self._char_counts[key]
+        want = np.zeros(len(alpha), dtype=np.int32)
+        for ch in word:
+            if (j := alpha.get(ch)) is not None:
+                want[j] += 1
+        # quick_ratio = 2·(số ký tự chung, không kể thứ tự) / (la + lb): lọc trước cả roster 1 lần,
+        # nới 1e-9 để sai số làm tròn không loại nhầm; các bộ lọc gốc vẫn chạy lại bên dưới
+        common = np.minimum(counts, want).sum(axis=1)
+        cand = np.flatnonzero(2 * common >= cutoff * (lengths + len(word)) - 1e-9)
+        s = SequenceMatcher()
+        s.set_seq2(word)
+        result = []
+        for i in cand:
+            s.set_seq1(names[i])
+            if s.real_quick_ratio() >= cutoff and s.quick_ratio() >= cutoff and s.ratio() >= cutoff:
+                result.append((s.ratio(), names[i]))
+        return [x for _, x in heapq.nlargest(n, result)]
+
+    def close_names(self, q: str, n: int = 5, cutoff: float = 0.6) -> list[str]:
+        """Như get_close_matches(q, names)."""
+        return self._close(q, "names", n, cutoff)
+
+    def close_names_norm(self, qn: str, n: int = 5, cutoff: float = 0.6) -> list[str]:
+        """So khớp gần đúng trên tên không dấu; trả về tên gốc tương ứng."""
+        return [self.norm_to_name[c] for c in self._close(qn, "norm", n, cutoff)]
+
+class AttendanceMatrix:
+    """Ma trận điểm danh dạng cột: SV × buổi (bool) + cột Tổ (categorical).
+
+    Dựng 1 lần mỗi snapshot; mọi truy vấn đếm theo buổi / tổ / SV là phép toán NumPy.
+    Dòng i ứng với records[i] (dòng i+2 trên Sheet).
+
+    Kèm tổng hợp theo SV (số buổi có mặt, buổi có mặt gần nhất, giờ đến sớm/muộn nhất) và
+    theo buổi (số SV có mặt). set_mark() cập nhật tăng dần: mỗi lượt điểm danh chỉ đụng 1 ô,
+    vài bộ đếm và giờ đến của đúng SV đó; không quét lại cả danh sách.
+    "Buổi đã diễn ra" = buổi có ít nhất 1 SV có mặt (cột các buổi sau để trống sẵn không tính vắng).
+    """
+
+    def __init__(self, records: list[dict], buoi_cols: list[str], time_cols: dict[str, str] | None = None):
+        self.buoi_cols = list(buoi_cols)
+        self._col_idx = {b: j for j, b in enumerate(self.buoi_cols)}
+        frame = pd.DataFrame.from_records(records, columns=self.buoi_cols + ["Tổ"])
+        marks = frame[self.buoi_cols].fillna("").astype(str)
+        self.present = np.column_stack(
+            [marks[b].str.strip().ne("").to_numpy(dtype=bool) for b in self.buoi_cols]
+        ) if self.buoi_cols else np.zeros((len(frame), 0), dtype=bool)
+        groups = frame["Tổ"].fillna("").astype(str).str.strip().replace("", "Chưa rõ")
+        self.groups = pd.Categorical(groups, categories=sorted(set(groups)))
+
+        n, s = self.present.shape
+        self.attended = self.present.sum(axis=1).astype(np.int64)
+        self.col_counts = self.present.sum(axis=0).astype(np.int64)
+        # chỉ số buổi có mặt gần nhất của từng SV (-1: chưa có buổi nào)
+        self.last_present = np.where(self.present.any(axis=1),
+                                     s - 1 - np.argmax(self.present[:, ::-1], axis=1), -1) if s else np.full(n, -1)
+        self._refresh_held()
+
+        # giờ đến (epoch giây, NaN: trống / không đọc được), từ cột Thời gian cạnh mỗi buổi
+        self._time_idx = {h: self._col_idx[b] for b, h in (time_cols or {}).items() if b in self._col_idx}
+        self.times = np.full((n, s), np.nan)
+        for h, j in self._time_idx.items():
+            parsed = parse_time_column([r.get(h, "") for r in records])
+            self.times[:, j] = [dt.timestamp() if dt else np.nan for dt in parsed]
+        arrived = np.where(self.present, self.times, np.nan)
+        self.first_arrival = np.fmin.reduce(arrived, axis=1) if s else np.full(n, np.nan)
+        self.last_arrival = np.fmax.reduce(arrived, axis=1) if s else np.full(n, np.nan)
+
+    def _refresh_held(self):
+        """Tính lại tập buổi đã diễn ra (O(số buổi)); chỉ gọi khi 1 buổi bắt đầu / bị xóa hết."""
+        held = self.col_counts > 0
+        self.held_idx = np.flatnonzero(held)
+        # held_from[k] = số buổi đã diễn ra có chỉ số >= k  -> chuỗi vắng hiện tại = held_from[last_present + 1]
+        self.held_from = np.append(np.cumsum(held[::-1])[::-1], 0)
+
+    def _recompute_student(self, i: int):
+        """Tính lại tổng hợp của 1 SV từ dòng của SV đó (O(số buổi)), dùng khi 1 ô bị xóa/sửa."""
+        row = self.present[i]
+        hit = np.flatnonzero(row)
+        self.last_present[i] = hit[-1] if hit.size else -1
+        arrived = self.times[i][row]
+        arrived = arrived[~np.isnan(arrived)]
+        self.first_arrival[i] = arrived.min() if arrived.size else np.nan
+        self.last_arrival[i] = arrived.max() if arrived.size else np.nan
+
+    def _note_arrival(self, i: int, t: float):
+        if not np.isnan(t):
+            self.first_arrival[i] = np.fmin(self.first_arrival[i], t)
+            self.last_arrival[i] = np.fmax(self.last_arrival[i], t)
+
+    @property
+    def n_students(self) -> int:
+        return self.present.shape[0]
+
+    @property
+    def n_held(self) -> int:
+        return len(self.held_idx)
+
+    def mask(self, buoi: str) -> np.ndarray:
+        j = self._col_idx.get(buoi)
+        if j is None:
+            return np.zeros(self.n_students, dtype=bool)
+        return self.present[:, j]
+
+    def present_count(self, buoi: str) -> int:
+        j = self._col_idx.get(buoi)
+        return int(self.col_counts[j]) if j is not None else 0
+
+    def present_by_buoi(self) -> dict[str, int]:
+        return {b: int(c) for b, c in zip(self.buoi_cols, self.col_counts)}
+
+    def present_total(self) -> int:
+        return int(self.col_counts.sum())
+
+    def total_slots(self) -> int:
+        return self.present.size
+
+    def by_group(self, buoi: str) -> pd.DataFrame:
+        """Bảng theo Tổ (đã sắp xếp): Tổ, Có mặt, Vắng, Tổng."""
+        df = pd.DataFrame({"Tổ": self.groups, "Có mặt": self.mask(buoi).astype(int)})
+        out = df.groupby("Tổ", observed=True, sort=True)["Có mặt"].agg(["sum", "count"]).reset_index()
+        out.columns = ["Tổ", "Có mặt", "Tổng"]
+        out["Tổ"] = out["Tổ"].astype(str)
+        out["Vắng"] = out["Tổng"] - out["Có mặt"]
+        return out[["Tổ", "Có mặt", "Vắng", "Tổng"]]
+
+    def student_present(self, i: int) -> np.ndarray:
+        return self.present[i]
+
+    def absent_per_student(self) -> np.ndarray:
+        """Số buổi vắng của từng SV, chỉ tính các buổi đã diễn ra."""
+        return self.n_held - self.attended
+
+    def absent_streaks(self) -> np.ndarray:
+        """Số buổi đã diễn ra vắng liên tiếp tính tới buổi gần nhất, của từng SV."""
+        return self.held_from[self.last_present + 1]
+
+    def absent_more_than(self, limit: int) -> np.ndarray:
+        """Vị trí các SV vắng > limit buổi."""
+        return np.flatnonzero(self.absent_per_student() > limit)
+
+    def at_risk(self, min_absent: int, min_streak: int) -> np.ndarray:
+        """Vị trí SV vắng >= min_absent buổi hoặc vắng liên tiếp >= min_streak buổi,
+        xếp theo chuỗi vắng rồi tổng số buổi vắng (nhiều trước)."""
+        absent, streak = self.absent_per_student(), self.absent_streaks()
+        idx = np.flatnonzero((absent >= min_absent) | (streak >= min_streak))
+        return idx[np.lexsort((-absent[idx], -streak[idx]))]
+
+    def student_summary(self, i: int) -> dict:
+        """Tổng hợp 1 SV: có mặt / vắng / số buổi đã diễn ra, giờ đến sớm & muộn nhất, chuỗi hiện tại."""
+        row = self.present[i]
+        streak_present = 0
+        for j in self.held_idx[::-1]:
+            if not row[j]:
+                break
+            streak_present += 1
+        first, last = self.first_arrival[i], self.last_arrival[i]
+        return {
+            "attended": int(self.attended[i]),
+            "absent": int(self.n_held - self.attended[i]),
+            "held": self.n_held,
+            "first_arrival": None if np.isnan(first) else datetime.datetime.fromtimestamp(first, VN_TZ),
+            "last_arrival": None if np.isnan(last) else datetime.datetime.fromtimestamp(last, VN_TZ),
+            "present_streak": streak_present,
+            "absent_streak": int(self.held_from[self.last_present[i] + 1]),
+        }
+
+    def set_mark(self, i: int, header: str, value):
+        """Vá 1 ô (cột buổi hoặc cột thời gian của buổi) của SV i, cập nhật tổng hợp tăng dần."""
+        if not 0 <= i < self.n_students:
+            return
+        j = self._col_idx.get(header)
+        if j is not None:
+            flag = attendance_flag(value)
+            if flag == self.present[i, j]:
+                return
+            self.present[i, j] = flag
+            step = 1 if flag else -1
+            self.attended[i] += step
+            self.col_counts[j] += step
+            if self.col_counts[j] == (1 if flag else 0):
+                self._refresh_held()
+            if flag:
+                self.last_present[i] = max(self.last_present[i], j)
+                self._note_arrival(i, self.times[i, j])
+            else:
+                self._recompute_student(i)
+            return
+        j = self._time_idx.get(header)
+        if j is not None:
+            old = self.times[i, j]
+            t = parse_time(value)
+            self.times[i, j] = t.timestamp() if t else np.nan
+            if self.present[i, j]:
+                if np.isnan(old):
+                    self._note_arrival(i, self.times[i, j])
+                else:
+                    self._recompute_student(i)
+
+class RosterSnapshot:
+    """Bản sao worksheet trong bộ nhớ: `headers` (dòng 1) + `records` (dict theo header).
+
+    records[i] ứng với dòng i+2 trên Sheet. Mỗi lần nạp lại hoặc vá, `version` đổi.
+    """
+
+    def __init__(self, headers: list[str], records: list[dict]):
+        self.headers = headers
+        self.records = records
+        self.version = next(_roster_versions)
+        self.loaded_at = time.monotonic()
+        self.stamp = None         # modifiedTime của file lúc tải (None: không dò thay đổi được)
+        self.lock = threading.RLock()
+        self._mssv_index = None
+        self._search_index = None
+        self._attendance = None
+
+    @classmethod
+    def from_values(cls, values: list[list]):
+        headers = [str(h) for h in values[0]] if values else []
+        records = [
+            {h: (row[i] if i < len(row) else "") for i, h in enumerate(headers)}
+            for row in values[1:]
+        ]
+        return cls(headers, records)
+
+    def age(self) -> float:
+        return time.monotonic() - self.loaded_at
+
+    def mssv_index(self) -> MssvIndex:
+        with self.lock:
+            if self._mssv_index is None:
+                self._mssv_index = MssvIndex.build(self.records)
+            return self._mssv_index
+
+    def search_index(self) -> NameSearchIndex:
+        with self.lock:
+            if self._search_index is None:
+                self._search_index = NameSearchIndex(self.records)
+            return self._search_index
+
+    def attendance(self) -> AttendanceMatrix:
+        with self.lock:
+            if self._attendance is None:
+                buoi_cols = detect_buoi_columns(self.headers)
+                time_cols = {b: self.headers[t-1] for b, t in build_time_map(self.headers, buoi_cols).items() if t}
+                self._attendance = AttendanceMatrix(self.records, buoi_cols, time_cols)
+            return self._attendance
+
+    def record_index(self, rec: dict) -> int | None:
+        """Vị trí của bản ghi `rec` (lấy từ snapshot này) trong records; tra theo MSSV trước."""
+        for row in self.mssv_index().by_full.get(mssv_digits(rec.get("MSSV")), []):
+            if self.record_at(row) is rec:
+                return row - 2
+        return next((i for i, r in enumerate(self.records) if r is rec), None)
+
+    def column(self, col: int) -> list:
+        """Giá trị cột `col` (1-based) của mọi dòng dữ liệu, đọc từ snapshot."""
+        if not 1 <= col <= len(self.headers):
+            return [""] * len(self.records)
+        h = self.headers[col-1]
+        return [r.get(h, "") for r in self.records]
+
+    def record_at(self, row: int) -> dict | None:
+        i = row - 2
+        return self.records[i] if 0 <= i < len(self.records) else None
+
+    def patch_cells(self, cells: dict):
+        """Vá tại chỗ các ô {(row, col): value} vừa được app ghi lên Sheet."""
+        with self.lock:
+            headers, records = self.headers, self.records
+            if any(r == 1 for r, _ in cells):
+                # đổi header -> dựng lại records (copy-on-write để luồng đang đọc không vỡ)
+                headers = list(headers)
+                for (r, c), v in cells.items():
+                    if r == 1:
+                        headers.extend([""] * (c - len(headers)))
+                        headers[c-1] = str(v)
+                old = self.headers
+                records = [
+                    {h: (rec.get(old[i], "") if i < len(old) else "") for i, h in enumerate(headers)}
+                    for rec in records
+                ]
+                self._mssv_index = None  # cột MSSV có thể đã đổi -> dựng lại khi cần
+                self._search_index = None
+                self._attendance = None
+            for (r, c), v in cells.items():
+                if r < 2 or c > len(headers):
+                    continue
+                while len(records) < r - 1:
+                    records.append({h: "" for h in headers})
+                    self._search_index = None
+                    self._attendance = None
+                records[r-2][headers[c-1]] = v
+                if self._attendance is not None:
+                    self._attendance.set_mark(r - 2, headers[c-1], v)
+                    if headers[c-1] == "Tổ":
+                        self._attendance = None
+                if headers[c-1] == "MSSV" and self._mssv_index is not None:
+                    self._mssv_index.set_row(r, v)
+                if headers[c-1] == "Họ và Tên":
+                    self._search_index = None
+            self.headers, self.records = headers, records
+            self.version = next(_roster_versions)
+
+def modified_stamp(sheet) -> str:
+    """modifiedTime của file (Drive API): 1 lệnh gọi nhỏ, đổi khi có bất kỳ ai sửa Spreadsheet."""
+    return sheet.spreadsheet.get_lastUpdateTime()
+
+class RosterCache:
+    """Snapshot dùng chung mọi phiên, mỗi worksheet 1 bản.
+
+    Quá TTL thì hỏi modifiedTime của file trước; chỉ tải lại cả sheet khi file thực sự đã đổi.
+    """
+
+    def __init__(self, ttl: float = ROSTER_TTL, journal=None):
+        self.ttl = ttl
+        self.journal = journal    # AttendanceJournal (chế độ lưu cục bộ) hoặc None
+        self._lock = threading.Lock()
+        self._snaps = {}
+        self._load_locks = {}
+        self._listeners = []      # listener(sheet, snapshot) sau mỗi lần nạp lại từ Sheet
+
+    def add_listener(self, fn):
+        self._listeners.append(fn)
+
+    def get(self, sheet) -> RosterSnapshot:
+        key = _ws_key(sheet)
+        snap = self._snaps.get(key)
+        if snap is not None and snap.age() <= self.ttl:
+            return snap
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+        with load_lock:  # nhiều phiên cùng hết hạn -> chỉ 1 phiên tải
+            snap = self._snaps.get(key)
+            if snap is None or snap.age() > self.ttl:
+                # lấy modifiedTime TRƯỚC khi đọc: sửa đổi xen giữa sẽ bị phát hiện ở lần kiểm tra sau
+                stamp = self._stamp(sheet)
+                if snap is not None and stamp is not None and stamp == snap.stamp:
+                    snap.loaded_at = time.monotonic()   # file chưa đổi: dùng tiếp snapshot
+                    return snap
+                try:
+                    fresh = self._load(sheet, stamp)
+                except Exception:
+                    if snap is None:
+                        raise
+                    # Sheets lỗi/quá tải: dùng tạm bản cũ, thử lại sau ROSTER_RETRY_SECONDS
+                    snap.loaded_at = time.monotonic() - self.ttl + ROSTER_RETRY_SECONDS
+                    return snap
+                snap = self._snaps[key] = fresh
+                for fn in self._listeners:
+                    fn(sheet, snap)
+            return snap
+
+    @staticmethod
+    def _stamp(sheet) -> str | None:
+        try:
+            return modified_stamp(sheet)
+        except Exception:
+            return None  # không hỏi được -> tải lại như cũ
+
+    def _load(self, sheet, stamp: str | None = None) -> RosterSnapshot:
+        with timed("roster", "load"):
+            if self.journal is None:
+                snap = RosterSnapshot.from_values(sheet.get_all_values())
+                snap.stamp = stamp
+                return snap
+            # chế độ nhật ký: lưu bản sao cục bộ, Sheets lỗi thì dùng bản đã lưu;
+            # các lượt điểm danh chưa đồng bộ được phủ lên snapshot
+            jkey = journal_key(sheet)
+            try:
+                values = sheet.get_all_values()
+                self.journal.save_roster(jkey, values)
+                from_sheet = True
+            except Exception:
+                values = self.journal.load_roster(jkey)
+                if values is None:
+                    raise
+                from_sheet = False
+            snap = RosterSnapshot.from_values(values)
+            snap.stamp = stamp if from_sheet else None
+            # bản lưu cục bộ có thể cũ hơn cả các lượt đã đồng bộ -> phủ toàn bộ nhật ký;
+            # vị trí tra lại theo MSSV + tiêu đề của chính bản vừa nạp (Sheet có thể đã bị sắp xếp)
+            entries = self.journal.entries(jkey, pending_only=from_sheet)
+            cells, _ = place_journal_entries(snap.headers, snap.mssv_index().find_row, entries)
+            if cells:
+                snap.patch_cells(cells)
+            return snap
+
+    def peek(self, sheet) -> RosterSnapshot:
+        """Snapshot đang có (kể cả đã quá TTL); chỉ tải khi chưa có."""
+        snap = self._snaps.get(_ws_key(sheet))
+        return snap if snap is not None else self.get(sheet)
+
+    def refresh(self, sheet, min_age: float = 0) -> RosterSnapshot:
+        """Nạp lại ngay nếu snapshot hiện tại cũ hơn `min_age` giây."""
+        snap = self._snaps.get(_ws_key(sheet))
+        if snap is not None and snap.age() < min_age:
+            return snap
+        self.invalidate(sheet)
+        return self.get(sheet)
+
+    def patch_cells(self, sheet, cells: dict):
+        snap = self._snaps.get(_ws_key(sheet))
+        if snap is not None:
+            snap.patch_cells(cells)
+
+    def invalidate(self, sheet):
+        self._snaps.pop(_ws_key(sheet), None)
+
+@st.cache_resource
+def get_roster_cache() -> RosterCache:
+    cache = RosterCache(ttl=float(get_setting("roster_ttl", ROSTER_TTL)), journal=get_journal())
+    # đã tải cả sheet thì cập nhật luôn schema nếu dòng tiêu đề bị sửa tay
+    cache.add_listener(lambda sheet, snap: get_schema_cache().update_headers(sheet, snap.headers))
+    # ... và tập "đã điểm danh" dùng chung (bổ sung lượt có sẵn, bỏ lượt bị xóa tay)
+    cache.add_listener(lambda sheet, snap: get_checkin_registry().load_snapshot(sheet, snap))
+    return cache
+
+def get_roster(sheet) -> RosterSnapshot:
+    with timed("roster", "get"):
+        return get_roster_cache().get(sheet)
+
+# ===================== NHẬT KÝ ĐIỂM DANH CỤC BỘ (SQLite WAL) =====================
+# Bật bằng Secrets/ENV `attendance_journal` = đường dẫn file .db. Khi bật, lượt điểm danh
+# được ghi vào SQLite trước (SV nhận xác nhận ngay), luồng nền đẩy dần lên Google Sheets.
+JOURNAL_SYNC_SECONDS = 2      # chu kỳ đồng bộ nhật ký -> Sheets
+JOURNAL_SYNC_BATCH = 500      # số lượt tối đa mỗi lần đồng bộ
+JOURNAL_MAX_BACKOFF = 60      # giây; đồng bộ lỗi thì giãn dần tới mức này
+
+def journal_key(sheet) -> str:
+    return "{}/{}".format(*_ws_key(sheet))
+
+class AttendanceJournal:
+    """Nhật ký điểm danh trong SQLite (WAL). Mỗi (worksheet, buổi, MSSV) chỉ có 1 dòng."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS checkins (
+                ws_key     TEXT NOT NULL,
+                buoi       TEXT NOT NULL,
+                mssv       TEXT NOT NULL,
+                row        INTEGER NOT NULL,
+                col_buoi   INTEGER NOT NULL,
+                col_time   INTEGER NOT NULL,
+                ts         TEXT NOT NULL,
+                synced     INTEGER NOT NULL DEFAULT 0,
+                attempts   INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                PRIMARY KEY (ws_key, buoi, mssv)
+            );
+            CREATE INDEX IF NOT EXISTS idx_checkins_pending ON checkins (synced, ws_key);
+            CREATE TABLE IF NOT EXISTS roster_cache (
+                ws_key   TEXT PRIMARY KEY,
+                values_json TEXT NOT NULL,
+                saved_at REAL NOT NULL
+            );
+        """)
+
+    def record(self, ws_key: str, buoi: str, mssv: str, row: int,
+               col_buoi: int, col_time: int, ts: str) -> tuple[bool, str]:
+        """Ghi 1 lượt điểm danh. Trả (True, ts) nếu mới, (False, ts cũ) nếu đã có từ trước.
+
+        row/col_* chỉ lưu để tra cứu: lúc phủ snapshot hay đồng bộ, vị trí được tính lại theo
+        MSSV + tên cột Buổi, vì Sheet có thể bị sắp xếp / chèn dòng trong lúc chờ.
+        """
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT OR IGNORE INTO checkins (ws_key, buoi, mssv, row, col_buoi, col_time, ts) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (ws_key, buoi, mssv, row, col_buoi, col_time, ts),
+            )
+            if cur.rowcount:
+                return True, ts
+            old = self._conn.execute(
+                "SELECT ts FROM checkins WHERE ws_key=? AND buoi=? AND mssv=?", (ws_key, buoi, mssv)
+            ).fetchone()
+            return False, old[0]
+
+    def pending(self, limit: int = JOURNAL_SYNC_BATCH) -> list[tuple]:
+        """[(ws_key, buoi, mssv, ts)] chưa đồng bộ, cũ trước."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT ws_key, buoi, mssv, ts FROM checkins "
+                "WHERE synced=0 ORDER BY rowid LIMIT ?", (limit,)
+            ).fetchall()
+
+    def entries(self, ws_key: str, pending_only: bool = True) -> list[tuple]:
+        """[(buoi, mssv, ts)] nhật ký đã ghi cho worksheet (mặc định: chỉ lượt chưa đồng bộ)."""
+        sql = "SELECT buoi, mssv, ts FROM checkins WHERE ws_key=?"
+        if pending_only:
+            sql += " AND synced=0"
+        with self._lock:
+            return self._conn.execute(sql, (ws_key,)).fetchall()
+
+    def mark_synced(self, keys: list[tuple]):
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE checkins SET synced=1, last_error=NULL WHERE ws_key=? AND buoi=? AND mssv=?", keys
+            )
+
+    def mark_failed(self, keys: list[tuple], err: Exception):
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE checkins SET attempts=attempts+1, last_error=? WHERE ws_key=? AND buoi=? AND mssv=?",
+                [(str(err)[:500], *k) for k in keys],
+            )
+
+    def counts(self) -> dict:
+        with self._lock:
+            total, pending = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(synced=0), 0) FROM checkins"
+            ).fetchone()
+        return {"total": total, "pending": pending}
+
+    def save_roster(self, ws_key: str, values: list[list]):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO roster_cache (ws_key, values_json, saved_at) VALUES (?, ?, ?)",
+                (ws_key, json.dumps(values, ensure_ascii=False), time.time()),
+            )
+
+    def load_roster(self, ws_key: str) -> list[list] | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT values_json FROM roster_cache WHERE ws_key=?", (ws_key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+def place_journal_entries(headers: list[str], find_row, entries) -> tuple[dict, list]:
+    """[(buoi, mssv, ts)] -> ({(row, col): value}, các lượt không đặt được).
+
+    Dòng tra bằng `find_row(mssv)`, cột theo tên cột Buổi trong `headers` (+ cột thời gian kề bên).
+    """
+    schema = SheetSchema(headers)
+    cells, unplaced = {}, []
+    for buoi, mssv, ts in entries:
+        row = find_row(mssv)
+        col_buoi = schema.col(buoi)
+        col_time = schema.checkin_time_col(col_buoi, buoi) if col_buoi else None
+        if row is None or not col_time:
+            unplaced.append((buoi, mssv, ts))
+            continue
+        cells[(row, col_buoi)] = "✅"
+        cells[(row, col_time)] = ts
+    return cells, unplaced
+
+class JournalSyncer:
+    """Luồng nền đẩy các lượt chưa đồng bộ lên Sheet qua hàng đợi ghi; lỗi thì thử lại (backoff).
+
+    Ghi lại 1 lượt nhiều lần vẫn cho cùng kết quả (✅ + thời gian), nên phát lại an toàn.
+    Trước mỗi lô, dòng tiêu đề và cột MSSV được đọc lại từ Sheet (1 lệnh batch_get) để đặt
+    lượt theo vị trí hiện tại; lượt không còn thấy MSSV / cột Buổi thì giữ lại chờ lần sau.
+    """
+
+    def __init__(self, journal: AttendanceJournal, queue: SheetWriteQueue, roster: RosterCache):
+        self.journal = journal
+        self.queue = queue
+        self.roster = roster
+        self._sync_lock = threading.Lock()   # 1 lô tại 1 thời điểm (luồng nền / gọi tay)
+        self._sheets = {}         # journal_key -> worksheet handle
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="journal-syncer", daemon=True)
+        self._thread.start()
+
+    def register(self, sheet):
+        self._sheets[journal_key(sheet)] = sheet
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        backoff = JOURNAL_SYNC_SECONDS
+        while True:
+            self._wake.wait(backoff)
+            self._wake.clear()
+            try:
+                ok = self.sync_once()
+            except Exception:
+                ok = False
+            backoff = JOURNAL_SYNC_SECONDS if ok else min(JOURNAL_MAX_BACKOFF, backoff * 2)
+            backoff *= random.uniform(0.8, 1.2)
+
+    def _live_layout(self, sheet) -> tuple[list[str], dict]:
+        """(dòng tiêu đề, {MSSV: dòng}) đọc thẳng từ Sheet ngay trước khi ghi."""
+        col = SheetSchema(self.roster.peek(sheet).headers).mssv_col
+        if not col:
+            raise RuntimeError("Không thấy cột MSSV.")
+        letter = re.sub(r"\d+", "", gspread.utils.rowcol_to_a1(1, col))
+        header_rng, mssv_rng = sheet.batch_get(["1:1", f"{letter}:{letter}"])
+        headers = [str(h) for h in (header_rng[0] if header_rng else [])]
+        if col > len(headers) or headers[col-1] != "MSSV":
+            self.roster.invalidate(sheet)  # cột MSSV đã dời chỗ -> nạp lại, lần sau đọc đúng cột
+            raise RuntimeError("Cột MSSV trên Sheet đã đổi chỗ, chờ nạp lại danh sách.")
+        rows = {}
+        for row, vals in enumerate(mssv_rng[1:], start=2):
+            if vals and (ms := mssv_digits(vals[0])):
+                rows.setdefault(ms, row)
+        return headers, rows
+
+    def sync_once(self) -> bool:
+        """Đẩy 1 lô; trả False nếu có lượt ghi lỗi."""
+        with self._sync_lock:
+            return self._sync_batch()
+
+    def _sync_batch(self) -> bool:
+        by_sheet = {}
+        for ws_key, buoi, mssv, ts in self.journal.pending():
+            sheet = self._sheets.get(ws_key)
+            if sheet is None:
+                continue  # worksheet chưa được mở lại kể từ khi khởi động
+            by_sheet.setdefault(ws_key, (sheet, []))[1].append((buoi, mssv, ts))
+        ok = True
+        for ws_key, (sheet, entries) in by_sheet.items():
+            keys = [(ws_key, buoi, mssv) for buoi, mssv, _ in entries]
+            try:
+                headers, rows = self._live_layout(sheet)
+            except Exception as e:
+                self.journal.mark_failed(keys, e)
+                ok = False
+                continue
+            cells, unplaced = place_journal_entries(headers, lambda m: rows.get(mssv_digits(m)), entries)
+            if unplaced:
+                held = {(ws_key, buoi, mssv) for buoi, mssv, _ in unplaced}
+                self.journal.mark_failed(list(held), RuntimeError("Không thấy MSSV / cột buổi trên Sheet."))
+                keys = [k for k in keys if k not in held]
+            if not cells:
+                continue
+            try:
+                # ghi ngay (không chờ gom lô) để khoảng hở giữa lúc đọc vị trí và lúc ghi thật ngắn
+                self.queue.write_now(sheet, cells)
+            except Exception as e:
+                self.journal.mark_failed(keys, e)
+                ok = False
+            else:
+                self.journal.mark_synced(keys)
+        return ok
+
+@st.cache_resource
+def get_journal() -> AttendanceJournal | None:
+    path = get_setting("attendance_journal")
+    return AttendanceJournal(str(path)) if path else None
 
-def load_records(sheet):
-    return sheet.get_all_records(expected_headers=None, default_blank="")
+@st.cache_resource
+def get_journal_syncer() -> JournalSyncer | None:
+    journal = get_journal()
+    return JournalSyncer(journal, get_write_queue(), get_roster_cache()) if journal is not None else None
+
+def use_sheet(sheet):
+    """Báo cho bộ đồng bộ nhật ký biết handle worksheet (chế độ lưu cục bộ)."""
+    syncer = get_journal_syncer()
+    if syncer is not None:
+        syncer.register(sheet)
+    return sheet
+
+# ===================== CẤU TRÚC CỘT (SCHEMA) =====================
+def detect_buoi_columns(headers: list[str]) -> list[str]:
+    cols = []
+    for h in headers:
+        hn = norm_search(h).replace("_", " ").replace("-", " ")
+        if re.match(r"^(b|bu|buoi)\s*\d+$", hn):
+            cols.append(h); continue
+        if hn.startswith("buoi ") and re.search(r"\d+", hn):
+            cols.append(h); continue
+        if norm_search(h).startswith("buổi ") and re.search(r"\d+", norm_search(h)):
+            cols.append(h); continue
+    seen, out = set(), []
+    for h in cols:
+        if h not in seen:
+            seen.add(h); out.append(h)
+    return out
+
+def build_time_map(headers: list[str], buoi_cols: list[str]) -> dict[str,int|None]:
+    name_to_idx = {h: i+1 for i, h in enumerate(headers)}
+    time_map = {}
+    for b in buoi_cols:
+        idx = name_to_idx[b]
+        m = re.search(r"(\d+)", b)
+        num = m.group(1) if m else None
+        tcol = None
+        if num:
+            for i, h in enumerate(headers, start=1):
+                hn = norm_search(h)
+                if (("thời gian" in h.lower()) or ("thoi gian" in hn) or ("time" in h.lower())) and re.search(rf"\b{num}\b", hn):
+                    tcol = i; break
+        if not tcol and idx < len(headers):
+            right = headers[idx]  # cột bên phải (1-based -> headers[idx])
+            hn = norm_search(right)
+            if ("thời gian" in right.lower()) or ("time" in right.lower()) or ("thoi gian" in hn):
+                tcol = idx + 1
+        time_map[b] = tcol
+    return time_map
+
+class SheetSchema:
+    """Bản đồ dòng tiêu đề: tên cột → số cột, cột Buổi → cột Thời gian, cột MSSV / Họ và Tên."""
+
+    def __init__(self, headers: list[str]):
+        self.headers = [str(h) for h in headers]
+        self.col_of = {}
+        for i, h in enumerate(self.headers, start=1):
+            self.col_of.setdefault(h, i)
+        self.buoi_cols = detect_buoi_columns(self.headers)
+        self.time_map = build_time_map(self.headers, self.buoi_cols)
+        self.mssv_col = self.col_of.get("MSSV")
+        self.name_col = self.col_of.get("Họ và Tên")
+
+    def col(self, header_name: str) -> int | None:
+        return self.col_of.get(header_name)
+
+    def checkin_time_col(self, buoi_col: int, buoi_header: str) -> int | None:
+        """Cột thời gian để ghi khi điểm danh: ưu tiên cột kề phải, rồi cột 'thời gian <số buổi>'."""
+        headers = self.headers
+        nxt = buoi_col + 1
+        if nxt <= len(headers):
+            h = (headers[nxt-1] or "").lower()
+            if "thời gian" in h or "time" in h:
+                return nxt
+        m = re.search(r"(\d+)", buoi_header or "", flags=re.I)
+        idx = m.group(1) if m else None
+        if idx:
+            for i, h in enumerate(headers, start=1):
+                hl = (h or "").lower()
+                if (("thời gian" in hl) or ("time" in hl)) and re.search(rf"\b{idx}\b", hl):
+                    return i
+        return None
+
+    def with_header(self, col: int, name: str) -> "SheetSchema":
+        headers = list(self.headers)
+        headers.extend([""] * (col - len(headers)))
+        headers[col-1] = name
+        return SheetSchema(headers)
+
+class SchemaCache:
+    """Schema dùng chung mọi phiên; chỉ đọc dòng 1 một lần cho mỗi worksheet."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._schemas = {}
+
+    def get(self, sheet) -> SheetSchema:
+        key = _ws_key(sheet)
+        schema = self._schemas.get(key)
+        if schema is None:
+            with self._lock:
+                schema = self._schemas.get(key)
+                if schema is None:
+                    schema = self._schemas[key] = SheetSchema(sheet.row_values(1))
+        return schema
+
+    def set_header(self, sheet, col: int, name: str):
+        with self._lock:
+            key = _ws_key(sheet)
+            base = self._schemas.get(key) or SheetSchema([])
+            self._schemas[key] = base.with_header(col, name)
+
+    def update_headers(self, sheet, headers: list[str]):
+        key = _ws_key(sheet)
+        schema = self._schemas.get(key)
+        trimmed = list(headers)
+        while trimmed and not trimmed[-1]:
+            trimmed.pop()
+        if schema is None or schema.headers != trimmed:
+            self._schemas[key] = SheetSchema(trimmed)
+
+    def invalidate(self, sheet):
+        self._schemas.pop(_ws_key(sheet), None)
+
+@st.cache_resource
+def get_schema_cache() -> SchemaCache:
+    return SchemaCache()
+
+def get_schema(sheet) -> SheetSchema:
+    return get_schema_cache().get(sheet)
+
+def reload_sheet_metadata():
+    """Tải lại handle worksheet, schema và snapshot (nút 'Tải lại' của GV)."""
+    sheet = get_sheet()
+    get_schema_cache().invalidate(sheet)
+    get_roster_cache().invalidate(sheet)
+    _open_worksheet.clear()
 
 def find_header_col(sheet, header_name):
-    return sheet.find(header_name).col
+    col = get_schema(sheet).col(header_name)
+    if col:
+        return col
+    return sheet.find(header_name).col  # không có ở dòng tiêu đề -> tìm trên Sheet như cũ
 
 # ===================== CỘT THỜI GIAN CẠNH CỘT BUỔI =====================
 def find_or_create_time_col(sheet, buoi_col: int, buoi_header: str) -> int:
-    headers = sheet.row_values(1)
-    n_cols = len(headers)
-    nxt = buoi_col + 1
-    if nxt <= n_cols:
-        h = (headers[nxt-1] or "").lower()
-        if "thời gian" in h or "time" in h:
-            return nxt
-    m = re.search(r"(\d+)", buoi_header or "", flags=re.I)
-    idx = m.group(1) if m else None
-    if idx:
-        for i, h in enumerate(headers, start=1):
-            hl = (h or "").lower()
-            if (("thời gian" in hl) or ("time" in hl)) and re.search(rf"\b{idx}\b", hl):
-                return i
+    t_col = get_schema(sheet).checkin_time_col(buoi_col, buoi_header)
+    if t_col:
+        return t_col
     # tạo mới ở cột kế bên
-    sheet.update_cell(1, nxt, f"Thời gian {buoi_header}")
+    nxt = buoi_col + 1
+    header = f"Thời gian {buoi_header}"
+    sheet.update_cell(1, nxt, header)
+    get_schema_cache().set_header(sheet, nxt, header)
+    get_roster_cache().patch_cells(sheet, {(1, nxt): header})
     return nxt
 
 # ===================== TOKEN QR =====================
@@ -167,13 +1588,679 @@ def token_valid(t_str: str, step=QR_SLOT_SECONDS, strict=True) -> bool:
         return t == now_slot
     return abs(t - now_slot) <= 1  # chấp nhận lệch ±1 slot nếu cần
 
+# ===================== CACHE ẢNH QR =====================
+QR_CACHE_SIZE = 64            # số ảnh QR giữ lại (LRU), đủ cho vài GV x vài buổi
+QR_PREFETCH_SECONDS = 5       # còn ≤ số giây này thì vẽ sẵn QR của slot kế tiếp
+
+def qr_payload(base_url: str, buoi: str, slot: int, class_id: str | None = None) -> str:
+    url = f"{base_url}/?sv=1&buoi={urllib.parse.quote(buoi)}&t={slot}"
+    return f"{url}&class={urllib.parse.quote(class_id)}" if class_id else url
+
+def render_qr_png(data: str) -> bytes:
+    with timed("qr", "qrcode.make") as box:
+        qr = qrcode.make(data)
+        buf = io.BytesIO(); qr.save(buf, format="PNG")
+        box["bytes"] = buf.tell()
+    return buf.getvalue()
+
+class QRCache:
+    """Ảnh QR (PNG) theo (base_url, buoi, slot, lớp): mỗi slot chỉ vẽ 1 lần cho mọi màn hình."""
+
+    def __init__(self, maxsize: int = QR_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._pending = {}
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="qr-prefetch")
+
+    def _store(self, key, png: bytes):
+        with self._lock:
+            self._items[key] = png
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def _render(self, key) -> bytes:
+        png = render_qr_png(qr_payload(*key))
+        self._store(key, png)
+        return png
+
+    def _prefetch_job(self, key) -> bytes:
+        try:
+            return self._render(key)
+        finally:
+            with self._lock:  # xong hay lỗi đều bỏ khỏi _pending, lần sau get/prefetch vẽ lại
+                self._pending.pop(key, None)
+
+    def get(self, base_url: str, buoi: str, slot: int, class_id: str | None = None) -> bytes:
+        key = (base_url, buoi, slot, class_id)
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+            fut = self._pending.get(key)
+        if fut is not None:
+            try:
+                return fut.result()  # đang được vẽ sẵn ở nền
+            except Exception:
+                pass  # vẽ nền lỗi -> vẽ lại trực tiếp
+        return self._render(key)
+
+    def prefetch(self, base_url: str, buoi: str, slot: int, class_id: str | None = None):
+        """Vẽ sẵn ở nền (không chặn) để lúc sang slot mới chỉ việc lấy ra."""
+        key = (base_url, buoi, slot, class_id)
+        with self._lock:
+            if key in self._items or key in self._pending:
+                return
+            self._pending[key] = self._pool.submit(self._prefetch_job, key)
+
+@st.cache_resource
+def get_qr_cache() -> QRCache:
+    return QRCache()
+
+# ===================== BỘ ĐẾM ĐIỂM DANH TRỰC TIẾP (MÀN CHIẾU) =====================
+LIVE_POLL_SECONDS = 10        # đọc lại cột Buổi tối đa 1 lần / số giây này cho mỗi (worksheet, buổi)
+LIVE_RECENT = 5               # số SV vừa điểm danh hiển thị cạnh QR
+
+class LiveCounter:
+    """Số SV có mặt + SV vừa điểm danh của 1 buổi, dùng chung mọi màn chiếu.
+
+    Lượt điểm danh qua app đã được vá vào snapshot ngay khi ghi; chỉ cột Buổi được đọc lại
+    định kỳ (1 lệnh col_values, ưu tiên nền) để bắt các sửa tay trên Sheet. Việc đọc chạy ở
+    luồng nền nên đồng hồ QR không bị đứng khi phải chờ quota.
+    """
+
+    def __init__(self, poll_seconds: float = LIVE_POLL_SECONDS):
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        self._polled = {}         # (ws_key, buoi) -> lúc đọc cột gần nhất
+        self._polling = set()
+        self._summary = {}        # (ws_key, buoi) -> (snapshot version, kết quả)
+        self._pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="live-poll")
+
+    def get(self, sheet, buoi: str) -> dict:
+        key = (_ws_key(sheet), buoi)
+        with self._lock:
+            due = (time.monotonic() - self._polled.get(key, float("-inf")) >= self.poll_seconds
+                   and key not in self._polling)
+            if due:
+                self._polling.add(key)
+        if due:  # chỉ 1 màn chiếu đi đọc (ở nền), các màn khác dùng số liệu sẵn có
+            self._pool.submit(self._poll_job, key, sheet, buoi, get_schema(sheet).col(buoi),
+                              get_roster_cache(), get_journal() is not None)
+        roster = get_roster_cache().peek(sheet)
+        cached = self._summary.get(key)
+        if cached is not None and cached[0] == roster.version:
+            return cached[1]
+        result = self._summarize(roster, get_schema(sheet), buoi)
+        self._summary[key] = (roster.version, result)
+        return result
+
+    def _poll_job(self, key, *args):
+        try:
+            self._poll(*args)
+        except Exception:
+            pass  # Sheets bận/lỗi: vẫn hiển thị theo snapshot
+        finally:
+            with self._lock:
+                self._polled[key] = time.monotonic()
+                self._polling.discard(key)
+
+    def _poll(self, sheet, buoi: str, col: int | None, cache: RosterCache, has_journal: bool):
+        if not col:
+            return
+        roster = cache.peek(sheet)
+        version = roster.version
+        with api_priority(PRIORITY_BACKGROUND):
+            values = sheet.col_values(col)
+        if col > len(roster.headers):
+            return
+        h = roster.headers[col-1]
+        # Ô bị xóa tay chỉ áp khi snapshot không đổi trong lúc đọc và không có nhật ký cục bộ
+        # (tránh xóa nhầm lượt vừa ghi / chưa đồng bộ); còn lại chờ lần nạp lại đầy đủ.
+        allow_clear = roster.version == version and not has_journal
+        cells = {}
+        for i, rec in enumerate(roster.records):
+            v = values[i+1] if i + 1 < len(values) else ""
+            if str(rec.get(h, "")) != str(v) and (v or allow_clear):
+                cells[(i+2, col)] = v
+        if cells:
+            roster.patch_cells(cells)
+
+    @staticmethod
+    def _summarize(roster: RosterSnapshot, schema: SheetSchema, buoi: str) -> dict:
+        matrix = roster.attendance()
+        col = schema.col(buoi)
+        t_col = schema.checkin_time_col(col, buoi) if col else None
+        t_h = schema.headers[t_col-1] if t_col else None
+        recent = heapq.nlargest(
+            LIVE_RECENT,
+            ((str(roster.records[i].get(t_h, "")), int(i)) for i in np.flatnonzero(matrix.mask(buoi))),
+        ) if t_h else []
+        return {
+            "present": matrix.present_count(buoi),
+            "total": matrix.n_students,
+            "recent": [(t, roster.records[i].get("Họ và Tên", ""), roster.records[i].get("MSSV", ""))
+                       for t, i in recent if t],
+        }
+
+@st.cache_resource
+def get_live_counter() -> LiveCounter:
+    return LiveCounter()
+
+# ===================== TRỢ LÝ: ĐỊNH TUYẾN CÂU HỎI (INTENT ROUTER) =====================
+# Regex biên dịch 1 lần, danh sách cụm từ chuẩn hóa 1 lần; mỗi câu hỏi chỉ chuẩn hóa + tách từ 1 lần.
+INTENT_EXTREME_TIME = "extreme_time"        # ai sớm nhất / muộn nhất buổi X
+INTENT_STUDENT_IN_BUOI = "student_in_buoi"  # buổi X <tên> có đi học không
+INTENT_ABSENT_OVER = "absent_over"          # vắng quá N buổi
+INTENT_BUOI_STATS = "buoi_stats"            # buổi X có bao nhiêu SV đi học / tổng quan
+INTENT_GROUP_STATS = "group_stats"          # tổ Y buổi X
+INTENT_STUDENT = "student"                  # MSSV / SV cụ thể đi mấy buổi
+INTENT_RATE = "rate"                        # tỷ lệ chuyên cần trung bình
+INTENT_UNKNOWN = "unknown"
+
+INTENT_FUZZY_THRESHOLD = 0.8  # từ được so gần đúng (sớm/muộn/trễ) phải giống ít nhất mức này
+
+_RE_TOKEN = re.compile(r"[a-zA-ZÀ-ỹ0-9]+")
+_RE_BUOI_NUM = re.compile(r"\bbuoi\s*(\d+)\b")
+_RE_TO_WORD = re.compile(r"\bto\b")
+_RE_TO_ID = re.compile(r"\bto\s*([0-9]+)\b|\bto\s+([a-z])\b")  # "tổ 2", "tổ A" (không bắt "tổ chức", "tôi")
+_RE_MSSV_PREFIXED = re.compile(r"(?:mssv|sv|student)\s*([0-9]{6,})")
+_RE_LONG_NUM = re.compile(r"\b([0-9]{7,})\b")
+_RE_VANG_QUA = re.compile(r"vang\s+qua\s+(\d+)\s*buoi")
+
+def norm_question(s: str) -> str:
+    """Như norm_search nhưng đổi cả đ -> d (NFD không tách được dấu của đ)."""
+    return norm_search(s).replace("đ", "d")
+
+@functools.lru_cache(maxsize=4096)
+def _token_sim(a: str, b: str) -> float:
+    return SequenceMatcher(None, a, b).ratio()
+
+class PhraseSet:
+    """Các cách viết của 1 cụm từ (có/không dấu, viết tắt), chuẩn hóa sẵn.
+
+    `anchors`: các từ phải có đúng nguyên văn (vd "nhat"/"nhut"); chỉ các từ còn lại được so gần
+    đúng, để tên như "Trần Nhật", "Sơn Nhật" không bị nhầm thành "trễ nhất", "sớm nhất".
+    """
+
+    def __init__(self, variants: list[str], anchors: frozenset = frozenset()):
+        self.variants = tuple(dict.fromkeys(norm_question(v) for v in variants))
+        self.anchors = anchors
+        # cụm không chứa từ neo nào (vd "somnha") chỉ khớp nguyên văn
+        self._split = [vt for vt in (v.split() for v in self.variants) if anchors.intersection(vt)]
+
+    def score(self, text: str, tokens: list[str], thresh: float = INTENT_FUZZY_THRESHOLD) -> float:
+        """1.0 nếu có nguyên cụm; không thì so từng từ với các cửa sổ cùng độ dài của câu: từ neo
+        phải trùng, từ khác giống ≥ thresh. Trả độ giống trung bình của cửa sổ tốt nhất (0 nếu không có)."""
+        if any(v in text for v in self.variants):
+            return 1.0
+        best = 0.0
+        for vt in self._split:
+            n = len(vt)
+            for i in range(len(tokens) - n + 1):
+                total = 0.0
+                for tok, want in zip(tokens[i:i + n], vt):
+                    r = float(tok in self.anchors) if want in self.anchors else _token_sim(tok, want)
+                    if r < thresh:
+                        break
+                    total += r
+                else:
+                    best = max(best, total / n)
+        return best
+
+_SUPERLATIVE = frozenset({"nhat", "nhut"})
+_EARLIEST = PhraseSet(["som nhat", "sớm nhất", "den som nhat", "som nhut", "somnha"], _SUPERLATIVE)
+_LATEST = PhraseSet(["muon nhat", "muộn nhất", "den muon nhat", "den tre nhat", "tre nhat"], _SUPERLATIVE)
+_ATTEND_WORDS = ("di hoc", "co mat", "vang", "khong")
+_STATS_WORDS = ("bao nhieu", "di hoc", "co mat", "vang")
+_STUDENT_WORDS = ("sv ", "sinh vien", "sinhvien")
+_NAME_STOPWORDS = frozenset({
+    "buoi", "to", "mssv", "sv", "student",
+    "di", "hoc", "co", "mat", "vang", "khong", "ai", "nhat", "som", "muon",
+    "den", "tre", "bao", "nhiu", "nhieu", "ty", "le", "chuyen", "can", "la",
+})
+_NAME_STOP_BIGRAMS = frozenset({("trung", "binh")})   # "Bình" một mình vẫn là tên
+
+def _name_from_tokens(tokens: list[str], name_tokens: list[str]) -> str:
+    keep, i = [], 0
+    while i < len(tokens):
+        if tuple(tokens[i:i + 2]) in _NAME_STOP_BIGRAMS:
+            i += 2
+            continue
+        if tokens[i] not in _NAME_STOPWORDS and not tokens[i].isdigit():
+            keep.append(name_tokens[i])
+        i += 1
+    return " ".join(keep)
+
+@functools.lru_cache(maxsize=64)
+def _buoi_lookup(buoi_cols: tuple[str, ...]) -> tuple[tuple[str, str, frozenset], ...]:
+    """(tên cột, tên chuẩn hóa, các số trong tên) của từng cột Buổi."""
+    return tuple((b, norm_question(b), frozenset(re.findall(r"\d+", norm_question(b))))
+                 for b in buoi_cols)
+
+def extract_buoi(text: str, buoi_cols) -> str | None:
+    lookup = _buoi_lookup(tuple(buoi_cols))
+    for b, bn, _ in lookup:
+        if bn in text:
+            return b
+    m = _RE_BUOI_NUM.search(text)
+    if m:
+        for b, _, nums in lookup:
+            if m.group(1) in nums:
+                return b
+    return None
+
+def extract_mssv(text: str) -> str | None:
+    m = _RE_MSSV_PREFIXED.search(text) or _RE_LONG_NUM.search(text)
+    return m.group(1) if m else None
+
+def looks_like_mssv(s: str) -> bool:
+    return len(mssv_digits(s)) >= 7
+
+class ParsedQuestion:
+    """Câu hỏi đã phân tích: `intent` (INTENT_*) + `params` (buổi, tổ, tên, MSSV...)."""
+
+    __slots__ = ("raw", "norm", "intent", "params")
+
+    def __init__(self, raw: str, norm: str, intent: str, params: dict):
+        self.raw, self.norm, self.intent, self.params = raw, norm, intent, params
+
+    def key(self) -> tuple:
+        return (self.intent, tuple(sorted(self.params.items())))
+
+def parse_question(q_raw: str, buoi_cols: list[str]) -> ParsedQuestion:
+    """Định tuyến câu hỏi -> ý định; ưu tiên từ cụ thể đến chung, dừng ở ý định đầu tiên khớp."""
+    name_text = norm_search(q_raw)            # giữ đ để so tên với chỉ mục tìm kiếm
+    qn = name_text.replace("đ", "d")
+    tokens = _RE_TOKEN.findall(qn)
+    name_tokens = _RE_TOKEN.findall(name_text)   # cùng vị trí với tokens (đ->d không đổi số ký tự)
+
+    def out(intent, **params):
+        return ParsedQuestion(q_raw, qn, intent, params)
+
+    # ------ sớm nhất / muộn nhất theo cột thời gian ------
+    s_early, s_late = _EARLIEST.score(qn, tokens), _LATEST.score(qn, tokens)
+    if s_early or s_late:
+        return out(INTENT_EXTREME_TIME, buoi=extract_buoi(qn, buoi_cols) or buoi_cols[-1],
+                   earliest=s_early >= s_late)
+
+    # ------ “Buổi X <tên> có đi học không?” ------
+    buoi = extract_buoi(qn, buoi_cols)
+    if buoi and any(w in qn for w in _ATTEND_WORDS):
+        name = _name_from_tokens(tokens, name_tokens)
+        if name:
+            return out(INTENT_STUDENT_IN_BUOI, buoi=buoi, name=name)
+
+    # ------ vắng quá N buổi (cụ thể hơn "vắng" chung nên xét trước) ------
+    m = _RE_VANG_QUA.search(qn)
+    if m:
+        return out(INTENT_ABSENT_OVER, limit=int(m.group(1)))
+
+    # ------ theo tổ: "tổ <mã>" cụ thể hơn câu hỏi thống kê chung ------
+    m = _RE_TO_ID.search(qn)
+    if m:
+        return out(INTENT_GROUP_STATS, buoi=buoi or buoi_cols[-1], to=m.group(1) or m.group(2))
+
+    # ------ thống kê theo buổi / tổng quan ------
+    if any(w in qn for w in _STATS_WORDS):
+        return out(INTENT_BUOI_STATS, buoi=buoi)
+
+    # ------ theo tổ (không nêu tổ nào -> liệt kê mọi tổ) ------
+    if _RE_TO_WORD.search(qn):
+        return out(INTENT_GROUP_STATS, buoi=buoi or buoi_cols[-1], to=None)
+
+    # ------ một SV cụ thể (MSSV hoặc tên) ------
+    if "mssv" in qn or _RE_LONG_NUM.search(qn) or any(k in qn for k in _STUDENT_WORDS):
+        return out(INTENT_STUDENT, target=extract_mssv(qn) or q_raw)
+
+    # ------ tỷ lệ chuyên cần trung bình ------
+    if "chuyen can" in qn or ("ty le" in qn and "buoi" not in qn):
+        return out(INTENT_RATE)
+
+    return out(INTENT_UNKNOWN)
+
+TIME_FORMATS = ["%Y-%m-%d %H:%M:%S", "%d/%m/%Y %H:%M:%S", "%H:%M:%S", "%H:%M"]
+_TIME_ONLY_FORMATS = {"%H:%M:%S", "%H:%M"}   # chỉ có giờ -> hiểu là hôm nay
+_TIME_FORMAT_SHAPES = {
+    "%Y-%m-%d %H:%M:%S": re.compile(r"^\d{4}-\d{1,2}-\d{1,2} \d{1,2}:\d{1,2}:\d{1,2}$"),
+    "%d/%m/%Y %H:%M:%S": re.compile(r"^\d{1,2}/\d{1,2}/\d{4} \d{1,2}:\d{1,2}:\d{1,2}$"),
+    "%H:%M:%S": re.compile(r"^\d{1,2}:\d{1,2}:\d{1,2}$"),
+    "%H:%M": re.compile(r"^\d{1,2}:\d{1,2}$"),
+}
+TIME_SAMPLE = 32              # số ô lấy mẫu (rải đều cột) để đoán định dạng chính
+TIME_VECTOR_MIN = 64          # cột ít ô hơn thì parse từng ô (rẻ hơn dựng Series)
+
+def parse_time(val) -> datetime.datetime | None:
+    if not val: return None
+    val = str(val).strip()
+    for fmt in TIME_FORMATS:
+        try:
+            dt = datetime.datetime.strptime(val, fmt)
+            if fmt in _TIME_ONLY_FORMATS:
+                today = datetime.datetime.now(VN_TZ).date()
+                dt = datetime.datetime.combine(today, dt.time())
+            return dt.replace(tzinfo=VN_TZ)
+        except Exception:
+            continue
+    return None
+
+def detect_time_format(values: list[str]) -> str | None:
+    """Định dạng chiếm đa số trong mẫu các ô (đã strip, khác rỗng); None nếu không ô nào khớp."""
+    step = max(1, len(values) // TIME_SAMPLE)
+    counts = Counter()
+    for v in values[::step]:
+        for fmt, shape in _TIME_FORMAT_SHAPES.items():
+            if shape.match(v):
+                counts[fmt] += 1
+                break
+    return counts.most_common(1)[0][0] if counts else None
+
+def parse_time_column(values) -> list[datetime.datetime | None]:
+    """parse_time cho cả cột, cùng ngữ nghĩa (VN_TZ; chỉ có giờ -> hôm nay).
+
+    Đoán định dạng chính 1 lần rồi parse cả cột bằng 1 lệnh pandas; phần ô lệch định dạng còn
+    nhiều thì lặp lại với định dạng chính của phần đó, ít thì rơi về parse_time từng ô.
+    """
+    vals = [str(v).strip() if v else "" for v in values]
+    pending = [i for i, v in enumerate(vals) if v]
+    out = [None] * len(vals)
+    tried = set()
+    while len(pending) >= TIME_VECTOR_MIN:
+        fmt = detect_time_format([vals[i] for i in pending])
+        if fmt is None or fmt in tried:
+            break
+        tried.add(fmt)
+        texts = pd.Series([vals[i] for i in pending], dtype=object)
+        if fmt in _TIME_ONLY_FORMATS:
+            texts = datetime.datetime.now(VN_TZ).date().isoformat() + " " + texts
+            fmt = "%Y-%m-%d " + fmt
+        parsed = pd.to_datetime(texts, format=fmt, errors="coerce").dt.tz_localize(VN_TZ)
+        rest = []
+        for i, good, dt in zip(pending, parsed.notna().to_numpy(), parsed.dt.to_pydatetime()):
+            if good:
+                out[i] = dt
+            else:
+                rest.append(i)
+        pending = rest
+    for i in pending:
+        out[i] = parse_time(vals[i])
+    return out
+
+def find_student_row(roster: RosterSnapshot, mssv_or_name: str) -> dict | None:
+    if looks_like_mssv(mssv_or_name):
+        rows = roster.mssv_index().by_full.get(mssv_digits(mssv_or_name))
+        if rows:
+            return roster.record_at(rows[0])
+    target = norm_search(mssv_or_name)
+    idx = roster.search_index()
+    hits = idx.contains(target) if target else []
+    if hits:
+        return idx.name_map[idx.names[hits[0]]]
+    cand = idx.close_names(mssv_or_name, n=1, cutoff=0.6)
+    return idx.name_map[cand[0]] if cand else None
+
+def answer_question(roster: RosterSnapshot, schema: SheetSchema, pq: ParsedQuestion) -> str:
+    """Trả lời câu hỏi đã định tuyến từ snapshot (không gọi Sheets)."""
+    records = roster.records
+    buoi_cols = schema.buoi_cols
+    matrix = roster.attendance()
+    total_sv = len(records)
+    p = pq.params
+
+    if pq.intent == INTENT_EXTREME_TIME:
+        b = p["buoi"]
+        t_col = schema.time_map.get(b)
+        if not t_col:
+            return f"Không tìm thấy cột thời gian ứng với “{b}”."
+        # cột thời gian lấy thẳng từ snapshot, parse cả cột 1 lần (không gọi sheet.cell từng dòng)
+        timed_rows = [
+            (t_parsed, r)
+            for r, t_parsed in zip(records, parse_time_column(roster.column(t_col)))
+            if t_parsed and attendance_flag(r.get(b, ""))
+        ]
+        if not timed_rows:
+            return f"Chưa có dữ liệu thời gian hợp lệ cho {b}."
+        pick = min if p["earliest"] else max
+        best_time, best_row = pick(timed_rows, key=lambda x: x[0])
+        name = best_row.get("Họ và Tên", "(không tên)")
+        ms = best_row.get("MSSV", "?")
+        kind = "sớm nhất" if p["earliest"] else "muộn nhất"
+        return f"👤 {name} ({ms}) là người {kind} trong {b}: {best_time.strftime('%Y-%m-%d %H:%M:%S')}."
+
+    if pq.intent == INTENT_STUDENT_IN_BUOI:
+        b, name_guess = p["buoi"], p["name"]
+        idx = roster.search_index()
+        matches = [idx.records[i] for i in idx.contains(name_guess)]
+        if not matches:
+            close = idx.close_names(name_guess, n=5, cutoff=0.6)
+            matches = [idx.name_map[n] for n in close]
+        if not matches:
+            return f"Không tìm thấy sinh viên nào khớp với “{name_guess}”."
+        lines = []
+        for r in matches:
+            flag = "✅" if attendance_flag(r.get(b, "")) else "❌"
+            lines.append(f"- {r.get('Họ và Tên','(không tên)')} ({r.get('MSSV','?')}): {flag} tại {b}")
+        return f"Kết quả cho “{name_guess}” ở {b}:\n" + "\n".join(lines)
+
+    if pq.intent == INTENT_ABSENT_OVER:
+        limit = p["limit"]
+        vangs = matrix.absent_per_student()
+        rows = [
+            f"- {records[i].get('Họ và Tên','(không tên)')} ({records[i].get('MSSV','?')}): {vangs[i]} buổi"
+            for i in matrix.absent_more_than(limit)
+        ]
+        return (f"Danh sách vắng quá {limit} buổi (trong {matrix.n_held} buổi đã diễn ra):\n"
+                + ("\n".join(rows) if rows else "Không có."))
+
+    if pq.intent == INTENT_BUOI_STATS:
+        b = p["buoi"]
+        if b:
+            n_present = matrix.present_count(b)
+            return (f"{b}: {n_present}/{total_sv} có mặt, {total_sv - n_present} vắng "
+                    f"({(n_present/total_sv*100):.1f}%).")
+        total_present_all = matrix.present_total()
+        total_slots = total_sv * len(buoi_cols)
+        rate = total_present_all/total_slots*100 if total_slots else 0
+        return f"Tổng tất cả buổi: {total_present_all}/{total_slots} lượt có mặt (~{rate:.1f}%)."
+
+    if pq.intent == INTENT_GROUP_STATS:
+        b, target_to = p["buoi"], p["to"]
+        stats = {g: (n, tot) for g, n, tot in matrix.by_group(b)[["Tổ", "Có mặt", "Tổng"]].itertuples(index=False)}
+        if target_to and target_to in stats:
+            n, tot = stats[target_to]
+            rate = n/tot*100 if tot else 0
+            return f"{b} - Tổ {target_to}: {n}/{tot} có mặt ({rate:.1f}%)."
+        lines = []
+        for g, (n, tot) in stats.items():
+            rate = n/tot*100 if tot else 0
+            lines.append(f"Tổ {g}: {n}/{tot} ({rate:.1f}%)")
+        return f"📊 {b} theo tổ:\n" + "\n".join(lines)
+
+    if pq.intent == INTENT_STUDENT:
+        row = find_student_row(roster, p["target"])
+        if not row:
+            return "Không tìm thấy sinh viên tương ứng."
+        name = row.get("Họ và Tên", "(không tên)")
+        ms = row.get("MSSV", "?")
+        i = roster.record_index(row)
+        sm = matrix.student_summary(i)   # tổng hợp dựng sẵn, không duyệt lại các cột buổi
+        marks = [f"{b}:{'✅' if flag else '❌'}" for b, flag in zip(matrix.buoi_cols, matrix.student_present(i))]
+        lines = [f"{name} ({ms}) — {sm['attended']}/{sm['held']} buổi có mặt"
+                 + (f" (đã diễn ra {sm['held']}/{len(matrix.buoi_cols)} buổi)." if sm["held"] < len(matrix.buoi_cols) else "."),
+                 ", ".join(marks)]
+        if sm["first_arrival"]:
+            lines.append(f"Giờ đến sớm nhất: {sm['first_arrival']:%Y-%m-%d %H:%M:%S}, "
+                         f"muộn nhất: {sm['last_arrival']:%Y-%m-%d %H:%M:%S}.")
+        if sm["absent_streak"]:
+            lines.append(f"⚠️ Đang vắng liên tiếp {sm['absent_streak']} buổi gần nhất.")
+        elif sm["present_streak"] > 1:
+            lines.append(f"Có mặt liên tiếp {sm['present_streak']} buổi gần nhất.")
+        return "\n".join(lines)
+
+    if pq.intent == INTENT_RATE:
+        total_present_all = matrix.present_total()
+        total_slots = total_sv * len(buoi_cols)
+        rate = total_present_all/total_slots*100 if total_slots else 0
+        return f"📈 Tỷ lệ chuyên cần trung bình: {rate:.1f}%."
+
+    return ("🤔 Tôi chưa chắc ý bạn. Bạn có thể hỏi: "
+            "“Ai đi học sớm nhất buổi 2?”, “Buổi 1 Thái có đi học không?”, "
+            "“Buổi 3 có bao nhiêu SV đi học?”, “MSSV 5112xxxx đi mấy buổi?”")
+
+ANSWER_CACHE_SIZE = 256       # số câu trả lời giữ lại (LRU)
+
+class AnswerCache:
+    """Câu trả lời của trợ lý theo (version snapshot, ý định, tham số), LRU, dùng chung mọi phiên.
+
+    Snapshot đổi version mỗi lần nạp lại hoặc có lượt điểm danh mới, nên câu trả lời cũ tự hết hiệu lực.
+    """
+
+    def __init__(self, maxsize: int = ANSWER_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compute(self, key, compute) -> str:
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            self.misses += 1
+        value = compute()
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return value
+
+@st.cache_resource
+def get_answer_cache() -> AnswerCache:
+    return AnswerCache()
+
+def ask_assistant(sheet, q_raw: str) -> str:
+    roster = get_roster(sheet)
+    if not roster.records:
+        return "Không có dữ liệu trong Sheet."
+    schema = get_schema(sheet)
+    if not schema.buoi_cols:
+        return "Không tìm thấy các cột 'Buổi ...' trong Sheet."
+    pq = parse_question(q_raw, schema.buoi_cols)
+    # version đọc trước khi tính: có lượt vá xen giữa thì lần hỏi sau sẽ tính lại
+    key = (roster.version, tuple(schema.headers)) + pq.key()
+    return get_answer_cache().get_or_compute(key, lambda: answer_question(roster, schema, pq))
+
+# ===================== XUẤT / NHẬP DỮ LIỆU ĐIỂM DANH =====================
+# Xuất: lấy thẳng từ snapshot (không gọi Sheets). Nhập: CSV điểm danh giấy -> xem trước (dry-run)
+# -> ghi 1 lệnh batch_update. Chỉ THÊM dấu có mặt, không xóa dấu đang có.
+IMPORT_MARK_VALUES = frozenset({"x", "✅", "✓", "v", "1", "co", "co mat", "y", "yes", "true", "p", "present"})
+
+def export_frame(roster: RosterSnapshot) -> pd.DataFrame:
+    """Danh sách + mọi cột Buổi/Thời gian, đúng thứ tự cột trên Sheet."""
+    cols = [h for h in roster.headers if h]
+    return pd.DataFrame.from_records(roster.records, columns=cols)
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow  # noqa: F401 (tùy chọn: chỉ cần cho xuất Parquet)
+    except ImportError:
+        return False
+    return True
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def export_bytes(_roster: RosterSnapshot, version: int, fmt: str) -> bytes:
+    """File xuất theo `fmt` ("csv" | "parquet"); nhớ theo version snapshot nên chỉ dựng lại khi dữ liệu đổi."""
+    df = export_frame(_roster)
+    buf = io.BytesIO()
+    if fmt == "parquet":
+        df.astype(str).to_parquet(buf, index=False)
+    else:
+        buf.write(df.to_csv(index=False).encode("utf-8-sig"))   # BOM để Excel đọc đúng tiếng Việt
+    return buf.getvalue()
+
+def _import_buoi(value: str, buoi_cols: list[str]) -> str | None:
+    v = norm_question(value)
+    return extract_buoi(v, buoi_cols) or (extract_buoi(f"buoi {v}", buoi_cols) if v.isdigit() else None)
+
+def read_import_csv(data: bytes) -> list[tuple[str, str, str]]:
+    """CSV -> [(MSSV, cột Buổi gốc trong file, thời gian)].
+
+    Dạng dài: cột MSSV, Buổi (+ Thời gian tùy chọn), mỗi dòng = 1 lượt có mặt.
+    Dạng rộng: cột MSSV + các cột Buổi, ô đánh dấu (x, ✅, 1, có...) = có mặt.
+    """
+    df = pd.read_csv(io.BytesIO(data), dtype=str, keep_default_na=False, encoding="utf-8-sig")
+    cols = {norm_question(c): c for c in df.columns}
+    if "mssv" not in cols:
+        raise ValueError("File thiếu cột MSSV.")
+    mssv = df[cols["mssv"]]
+    if "buoi" in cols:
+        times = df[cols["thoi gian"]] if "thoi gian" in cols else pd.Series([""] * len(df))
+        return list(zip(mssv, df[cols["buoi"]], times))
+    rows = []
+    for c in df.columns:
+        if c == cols["mssv"] or not re.match(r"^(b|bu|buoi)\s*\d+$", norm_question(c)):
+            continue
+        marked = df[c].map(lambda v: norm_question(v) in IMPORT_MARK_VALUES)
+        rows += [(m, c, "") for m in mssv[marked]]
+    return rows
+
+def plan_import(roster: RosterSnapshot, schema: SheetSchema, entries) -> tuple[pd.DataFrame, list[str], list]:
+    """Dry-run: (bảng thay đổi, lỗi, [(row, col Buổi, tên Buổi, thời gian)] sẽ ghi)."""
+    idx = roster.mssv_index()
+    changes, errors, writes, seen = [], [], [], set()
+    for raw_mssv, raw_buoi, ts in entries:
+        digits = mssv_digits(raw_mssv)
+        if not digits:
+            continue
+        if len(digits) > 4:  # MSSV đầy đủ: phải khớp nguyên mã, không đoán theo 4 số cuối
+            full = digits
+            row = idx.find_row(full)
+        else:
+            suffix = digits.zfill(4)
+            full = f"{MSSV_PREFIX}{suffix}"
+            row = idx.find_row(full, suffix)
+        buoi = _import_buoi(raw_buoi, schema.buoi_cols)
+        if buoi is None:
+            errors.append(f"{raw_mssv}: không nhận ra buổi “{raw_buoi}”.")
+            continue
+        if row is None:
+            errors.append(f"{raw_mssv}: không có trong danh sách.")
+            continue
+        if (row, buoi) in seen:
+            continue
+        seen.add((row, buoi))
+        rec = roster.record_at(row) or {}
+        current = str(rec.get(buoi, "")).strip()
+        if current:
+            continue  # đã có mặt: giữ nguyên
+        changes.append({"MSSV": rec.get("MSSV", full), "Họ và Tên": rec.get("Họ và Tên", ""),
+                        "Buổi": buoi, "Hiện tại": current, "Sẽ ghi": "✅", "Thời gian": str(ts or "").strip()})
+        writes.append((row, schema.col(buoi), buoi, str(ts or "").strip()))
+    return pd.DataFrame(changes, columns=["MSSV", "Họ và Tên", "Buổi", "Hiện tại", "Sẽ ghi", "Thời gian"]), errors, writes
+
+def apply_import(sheet, writes) -> int:
+    """Ghi mọi lượt của bản dry-run bằng 1 lệnh batch_update; trả số ô đã ghi."""
+    cells = {}
+    for row, col, buoi, ts in writes:
+        cells[(row, col)] = "✅"
+        if ts:
+            cells[(row, find_or_create_time_col(sheet, col, buoi))] = ts
+    if cells:
+        get_write_queue().write_now(sheet, cells)
+    return len(cells)
+
 # ===================== CÁC MỤC GIAO DIỆN =====================
 def render_tab_gv():
-    # Lấy tên lớp theo tên worksheet (động)
+    # Lấy tên lớp theo tên worksheet (động); mã lớp đi kèm QR để SV vào đúng worksheet
+    cls = current_class()
     try:
-        class_name = get_sheet().title  # luôn trùng với tên worksheet hiện tại
+        class_name = get_sheet(cls).title  # luôn trùng với tên worksheet hiện tại
     except Exception:
-        class_name = WORKSHEET_NAME     # fallback nếu mạng/API lỗi
+        class_name = cls                   # fallback nếu mạng/API lỗi
 
     st.subheader(f"📸 Mã QR điểm danh lớp {class_name} (QR động mỗi {QR_SLOT_SECONDS} giây)")
     buoi = st.selectbox(
@@ -184,66 +2271,77 @@ def render_tab_gv():
     auto = st.toggle("Tự đổi QR mỗi 30 giây", value=True)
     show_link = st.toggle("🔎 Hiển thị link chi tiết (ẩn/hiện)", value=False,
                           help="Bật khi cần xem toàn bộ URL để debug")
-    go = st.button("Tạo mã QR", use_container_width=True, type="primary")
+    if st.button("Tạo mã QR", use_container_width=True, type="primary"):
+        st.session_state["qr_running"] = True
 
-    if go:
-        qr_slot = st.empty()
-        link_slot = st.empty()
-        timer_slot = st.empty()
+    if st.session_state.get("qr_running"):
         try:
-            while True:
-                now = int(time.time())
-                slot = now // QR_SLOT_SECONDS
-                token = f"{slot}"
-                base_url = st.secrets["google_service_account"].get(
-                    "app_base_url", "https://qrlecturer.streamlit.app"
-                )
-                qr_data = f"{base_url}/?sv=1&buoi={urllib.parse.quote(buoi)}&t={token}"
-
-                # QR image
-                qr = qrcode.make(qr_data)
-                buf = io.BytesIO(); qr.save(buf, format="PNG"); buf.seek(0)
-                img = Image.open(buf)
-                qr_slot.image(img, caption="📱 Quét mã để điểm danh", width=260)
-
-                if show_link:
-                    with link_slot.container():
-                        st.markdown(
-                            f'<a href="{qr_data}" target="_blank" rel="noopener noreferrer">🌐 Mở link hiện tại</a>',
-                            unsafe_allow_html=True
-                        )
-                        st.code(qr_data)
-                else:
-                    link_slot.empty()
-
-                remain = QR_SLOT_SECONDS - (now % QR_SLOT_SECONDS)
-                timer_slot.markdown(f"⏳ QR đổi sau: **{remain} giây**  •  Buổi: **{buoi}**")
-
-                if not auto:
-                    break
-                time.sleep(1)
+            base_url = st.secrets["google_service_account"].get(
+                "app_base_url", "https://qrlecturer.streamlit.app"
+            )
+            # Chỉ khung QR/đếm ngược/link chạy lại mỗi giây (fragment), luồng script trả về ngay;
+            # tắt tự đổi thì QR đứng yên như trước
+            projector = st.fragment(_render_qr_projector, run_every=1 if auto else None)
+            projector(base_url, buoi, cls, show_link, auto)
         except Exception as e:
             st.error(f"❌ Lỗi khi tạo QR: {e}")
 
-def find_student_candidates(records, query: str):
+def _render_qr_projector(base_url: str, buoi: str, cls: str, show_link: bool, auto: bool):
+    now = int(time.time())
+    slot = now // QR_SLOT_SECONDS
+    qr_data = qr_payload(base_url, buoi, slot, cls)
+    qr_cache = get_qr_cache()
+
+    # QR image: chỉ lấy ảnh mới khi sang slot mới; cùng slot thì gửi lại đúng bytes cũ
+    # (media URL theo nội dung, trình duyệt không tải lại ảnh)
+    key = (base_url, buoi, slot, cls)
+    shown = st.session_state.get("qr_shown")
+    if shown is None or shown[0] != key:
+        with timed("ui", "qr_slot_update"):
+            shown = (key, qr_cache.get(base_url, buoi, slot, cls))
+        st.session_state["qr_shown"] = shown
+    c_qr, c_live = st.columns([1, 1])
+    with c_qr:
+        st.image(shown[1], caption="📱 Quét mã để điểm danh", width=260)
+    with c_live:
+        # Bộ đếm trực tiếp: snapshot dùng chung + đọc lại riêng cột Buổi (giới hạn tần suất)
+        try:
+            live = get_live_counter().get(get_sheet(cls), buoi)
+        except Exception:
+            live = None
+        if live is not None:
+            st.metric("✅ Đã điểm danh", f"{live['present']}/{live['total']}")
+            if live["recent"]:
+                st.caption("Vừa điểm danh:")
+                st.markdown("\n".join(f"- {t[-8:]} • {name} ({mssv})" for t, name, mssv in live["recent"]))
+
+    if show_link:
+        st.markdown(
+            f'<a href="{qr_data}" target="_blank" rel="noopener noreferrer">🌐 Mở link hiện tại</a>',
+            unsafe_allow_html=True
+        )
+        st.code(qr_data)
+
+    remain = QR_SLOT_SECONDS - (now % QR_SLOT_SECONDS)
+    st.markdown(f"⏳ QR đổi sau: **{remain} giây**  •  Buổi: **{buoi}**")
+    if auto and remain <= QR_PREFETCH_SECONDS:
+        qr_cache.prefetch(base_url, buoi, slot + 1, cls)
+
+def find_student_candidates(roster: RosterSnapshot, query: str):
     q = (query or "").strip()
     if not q:
         return []
     if q.isdigit() and len(q) == 4:
-        return [r for r in records if str(r.get("MSSV", "")).strip().endswith(q)]
+        return [roster.record_at(row) for row in roster.mssv_index().rows_with_suffix(q)]
     qn = norm_search(q)
-    contains = [r for r in records if qn in norm_search(r.get("Họ và Tên", ""))]
+    idx = roster.search_index()
+    contains = [idx.records[i] for i in idx.contains(qn)]
     if contains:
         return contains
-    names = [r.get("Họ và Tên", "") for r in records]
-    name_map = {n: r for n, r in zip(names, records)}
-    close = get_close_matches(q, names, n=5, cutoff=0.6)
+    close = idx.close_names(q, n=5, cutoff=0.6)
     if not close:
-        names_no = [norm_search(n) for n in names]
-        name_map_no = {norm_search(n): n for n in names}
-        close_no = get_close_matches(qn, names_no, n=5, cutoff=0.6)
-        close = [name_map_no[c] for c in close_no]
-    return [name_map[n] for n in close]
+        close = idx.close_names_norm(qn, n=5, cutoff=0.6)
+    return [idx.name_map[n] for n in close]
 
 def render_tab_search():
     st.subheader("🔎 Tìm sinh viên (4 số cuối MSSV hoặc họ và tên)")
@@ -253,8 +2351,9 @@ def render_tab_search():
     if run and q.strip():
         try:
             sheet = get_sheet()
-            records = load_records(sheet)
-            results = find_student_candidates(records, q)
+            roster = get_roster(sheet)
+            records = roster.records
+            results = find_student_candidates(roster, q)
 
             if not results:
                 st.warning("🙁 Không tìm thấy kết quả phù hợp.")
@@ -262,39 +2361,64 @@ def render_tab_search():
                 st.success(f"Tìm thấy {len(results)} kết quả:")
                 show_cols = list(records[0].keys()) if records else []
                 pref = ["MSSV", "Họ và Tên", "Tổ"]
-                buoi_cols = [c for c in show_cols if norm_search(c).startswith("buổi ")]
+                buoi_cols = [c for c in get_schema(sheet).buoi_cols if c in show_cols]
                 cols = [c for c in pref if c in show_cols] + buoi_cols
 
+                matrix = roster.attendance()
                 tidy = []
                 for r in results:
                     row = {c: r.get(c, "") for c in cols}
                     for bc in buoi_cols:
                         row[bc] = "✅" if attendance_flag(r.get(bc, "")) else ""
+                    i = roster.record_index(r)
+                    if i is not None:
+                        sm = matrix.student_summary(i)
+                        row["Có mặt"] = f"{sm['attended']}/{sm['held']}"
+                        row["Vắng liên tiếp"] = sm["absent_streak"]
                     tidy.append(row)
                 st.dataframe(tidy, use_container_width=True)
         except Exception as e:
             st.error(f"❌ Lỗi khi tìm kiếm: {e}")
 
+AT_RISK_ABSENT = 3            # mặc định: vắng từ 3 buổi (đã diễn ra) trở lên
+AT_RISK_STREAK = 2            # ... hoặc vắng liên tiếp từ 2 buổi gần nhất
+
+def render_at_risk(roster: RosterSnapshot, matrix: AttendanceMatrix):
+    """Danh sách SV có nguy cơ do vắng nhiều, lấy từ tổng hợp theo SV dựng sẵn."""
+    st.markdown("---")
+    st.markdown(f"**⚠️ SV có nguy cơ vì vắng nhiều** (đã diễn ra {matrix.n_held}/{len(matrix.buoi_cols)} buổi)")
+    top = max(1, len(matrix.buoi_cols))
+    c1, c2 = st.columns(2)
+    with c1:
+        min_absent = st.number_input("Vắng từ (buổi)", 1, top, min(AT_RISK_ABSENT, top), key="risk_absent")
+    with c2:
+        min_streak = st.number_input("hoặc vắng liên tiếp từ (buổi)", 1, top, min(AT_RISK_STREAK, top), key="risk_streak")
+    idx = matrix.at_risk(int(min_absent), int(min_streak))
+    if not len(idx):
+        st.caption("Không có SV nào.")
+        return
+    absent, streak = matrix.absent_per_student(), matrix.absent_streaks()
+    rows = []
+    for i in idx:
+        rec = roster.records[i]
+        last = matrix.last_present[i]
+        rows.append({"MSSV": rec.get("MSSV", ""), "Họ và Tên": rec.get("Họ và Tên", ""), "Tổ": rec.get("Tổ", ""),
+                     "Vắng": int(absent[i]), "Vắng liên tiếp": int(streak[i]),
+                     "Có mặt gần nhất": matrix.buoi_cols[last] if last >= 0 else "—"})
+    st.caption(f"{len(rows)} SV")
+    st.dataframe(rows, use_container_width=True, hide_index=True)
+
 def render_tab_stats():
     st.subheader("📊 Thống kê điểm danh theo buổi & theo Tổ")
     try:
         sheet = get_sheet()
-        headers = sheet.row_values(1)
-        buoi_list = [h for h in headers if norm_search(h).startswith("buổi ")]
+        roster = get_roster(sheet)
+        buoi_list = get_schema(sheet).buoi_cols
         buoi_chon = st.selectbox("Chọn buổi", buoi_list or ["Buổi 1"], index=0)
-        records = load_records(sheet)
-
-        present, absent = 0, 0
-        by_group = {}
-        for r in records:
-            flag = attendance_flag(r.get(buoi_chon, ""))
-            if flag: present += 1
-            else: absent += 1
-            group = str(r.get("Tổ", "")).strip() or "Chưa rõ"
-            if group not in by_group:
-                by_group[group] = {"present": 0, "absent": 0}
-            by_group[group]["present" if flag else "absent"] += 1
+        matrix = roster.attendance()
 
+        present = matrix.present_count(buoi_chon)
+        absent = matrix.n_students - present
         c1, c2, c3 = st.columns(3)
         with c1: st.metric("✅ Có mặt", present)
         with c2: st.metric("❌ Vắng", absent)
@@ -302,16 +2426,10 @@ def render_tab_stats():
             total = present + absent
             st.metric("📈 Tỷ lệ có mặt", f"{(present/total*100):.1f}%" if total else "-")
 
-        rows = []
-        for g, v in sorted(by_group.items()):
-            total_g = v["present"] + v["absent"]
-            rate = (v["present"]/total_g*100) if total_g else 0.0
-            rows.append({
-                "Tổ": g, "Có mặt": v["present"], "Vắng": v["absent"],
-                "Tổng": total_g, "Tỷ lệ (%)": round(rate, 1),
-                "Nhãn": f"{v['present']} ({rate:.1f}%)"
-            })
-        df = pd.DataFrame(rows)
+        df = matrix.by_group(buoi_chon)
+        rate = (df["Có mặt"] / df["Tổng"].where(df["Tổng"] > 0) * 100).fillna(0.0)
+        df["Tỷ lệ (%)"] = rate.round(1)
+        df["Nhãn"] = df["Có mặt"].astype(str) + " (" + rate.map("{:.1f}%".format) + ")"
         if not df.empty:
             base = alt.Chart(df).encode(
                 x=alt.X('Tổ:N', sort=None, title='Tổ'),
@@ -332,20 +2450,95 @@ def render_tab_stats():
         else:
             st.info("Không có dữ liệu để vẽ biểu đồ.")
 
-        table = []
-        for g, v in sorted(by_group.items()):
-            total_g = v["present"] + v["absent"]
-            rate_g = f"{(v['present']/total_g*100):.1f}%" if total_g else "-"
-            table.append({"Tổ": g, "Có mặt": v["present"], "Vắng": v["absent"], "Tỷ lệ có mặt": rate_g})
-        st.dataframe(table, use_container_width=True)
+        table = df[["Tổ", "Có mặt", "Vắng"]].copy()
+        table["Tỷ lệ có mặt"] = rate.map("{:.1f}%".format).where(df["Tổng"] > 0, "-")
+        st.dataframe(table, use_container_width=True, hide_index=True)
+
+        render_at_risk(roster, matrix)
     except Exception as e:
         st.error(f"❌ Lỗi khi lấy thống kê: {e}")
 
+def class_overview(class_id: str) -> dict:
+    """1 dòng tổng quan của lớp: sĩ số, số SV có mặt từng buổi, tỷ lệ chuyên cần."""
+    roster = get_roster(use_sheet(get_sheet(class_id)))
+    matrix = roster.attendance()
+    row = {"Lớp": class_id, "Sĩ số": matrix.n_students, **matrix.present_by_buoi()}
+    total = matrix.total_slots()
+    row["Chuyên cần"] = f"{matrix.present_total() / total * 100:.1f}%" if total else "-"
+    return row
+
+def render_tab_classes():
+    st.subheader("🏫 Tổng quan các lớp")
+    classes = list(get_classes())
+    t0 = time.perf_counter()
+    results = map_classes(class_overview, classes)   # các lớp tải song song, không lần lượt
+    rows = []
+    for cls, res in results.items():
+        if isinstance(res, Exception):
+            st.error(f"❌ Lỗi khi tải lớp {cls}: {res}")
+        else:
+            rows.append(res)
+    if rows:
+        st.dataframe(pd.DataFrame(rows).fillna("-"), use_container_width=True, hide_index=True)
+    st.caption(f"Đã tải {len(classes)} lớp trong {time.perf_counter() - t0:.2f} giây.")
+
+def render_tab_io():
+    st.subheader("📤 Xuất / nhập dữ liệu điểm danh")
+    try:
+        sheet = get_sheet()
+        roster = get_roster(sheet)
+        schema = get_schema(sheet)
+    except Exception as e:
+        st.error(f"❌ Lỗi khi đọc dữ liệu: {e}")
+        return
+
+    # ---------- Xuất (từ snapshot trong bộ nhớ) ----------
+    st.markdown("**Xuất danh sách + các cột Buổi / Thời gian**")
+    formats = ["CSV"] + (["Parquet"] if parquet_available() else [])
+    fmt = st.radio("Định dạng", formats, horizontal=True, key="export_fmt")
+    ext = fmt.lower()
+    st.download_button(
+        f"⬇️ Tải file {fmt} ({len(roster.records)} SV)",
+        export_bytes(roster, roster.version, ext),
+        file_name=f"diemdanh_{sheet.title}.{ext}",
+        mime="text/csv" if ext == "csv" else "application/octet-stream",
+        use_container_width=True,
+    )
+
+    # ---------- Nhập hàng loạt (dry-run rồi mới ghi) ----------
+    st.markdown("---")
+    st.markdown("**Nhập điểm danh hàng loạt từ CSV** (ví dụ từ danh sách giấy khi QR gặp sự cố)")
+    st.caption("Dạng dài: cột `MSSV`, `Buổi` (+ `Thời gian` tùy chọn), mỗi dòng 1 lượt có mặt. "
+               "Dạng rộng: cột `MSSV` + các cột `Buổi N`, ô đánh dấu x / ✅ / 1 là có mặt. "
+               "Chỉ thêm dấu có mặt, không xóa dấu đang có.")
+    up = st.file_uploader("Chọn file CSV", type=["csv"], key="import_csv")
+    if up is None:
+        return
+    try:
+        entries = read_import_csv(up.getvalue())
+        diff, errors, writes = plan_import(roster, schema, entries)
+    except Exception as e:
+        st.error(f"❌ Không đọc được file: {e}")
+        return
+    st.info(f"Xem trước: **{len(writes)}** lượt sẽ được đánh dấu có mặt, {len(errors)} dòng lỗi, "
+            f"{len(entries) - len(writes) - len(errors)} dòng trùng / đã có mặt.")
+    if errors:
+        with st.expander(f"⚠️ {len(errors)} dòng lỗi"):
+            st.markdown("\n".join(f"- {e}" for e in errors))
+    if writes:
+        st.dataframe(diff, use_container_width=True, hide_index=True)
+        if st.button(f"✅ Ghi {len(writes)} lượt lên Google Sheets", type="primary", use_container_width=True):
+            try:
+                # lập lại kế hoạch theo snapshot mới nhất rồi ghi 1 lần
+                roster = get_roster(sheet)
+                _, _, writes = plan_import(roster, get_schema(sheet), entries)
+                n = apply_import(sheet, writes)
+                st.success(f"Đã ghi {n} ô trong 1 lệnh batch_update.")
+            except Exception as e:
+                st.error(f"❌ Lỗi khi ghi: {e}")
+
 # ===== Trợ lý AI (nâng cấp) – chạy nội bộ, không dùng API ngoài =====
 def render_tab_ai():
-    import unicodedata, re, datetime
-    from difflib import get_close_matches
-
     st.subheader("🤖 Trợ lý AI (nội bộ, không dùng API ngoài)")
     st.caption(
         "Ví dụ: “Buổi 3 có bao nhiêu SV đi học?”, “Tổ 2 buổi 5 có bao nhiêu SV có mặt?”, "
@@ -354,297 +2547,332 @@ def render_tab_ai():
     )
     q_raw = st.text_input("Câu hỏi của bạn", placeholder="Nhập câu hỏi tiếng Việt (có thể gõ không dấu)...")
 
-    # ===== Helpers NLP =====
-    def lv_norm(s: str) -> str:
-        s = (s or "").strip().lower()
-        s = unicodedata.normalize("NFD", s)
-        s = "".join(ch for ch in s if unicodedata.category(ch) != "Mn")
-        s = unicodedata.normalize("NFC", s)
-        s = re.sub(r"\s+", " ", s)
-        return s
-
-    def fuzzy_has(text_norm: str, variants: list[str], thresh: float = 0.8) -> bool:
-        from difflib import SequenceMatcher
-        for v in variants:
-            v2 = lv_norm(v)
-            if v2 in text_norm:
-                return True
-            if SequenceMatcher(None, text_norm, v2).ratio() >= thresh:
-                return True
-        return False
+    if st.button("Hỏi trợ lý", use_container_width=True) and q_raw.strip():
+        try:
+            st.markdown(f"**Trả lời:**\n\n{ask_assistant(get_sheet(), q_raw)}")
+        except Exception as e:
+            st.error(f"❌ Lỗi khi xử lý câu hỏi: {e}")
 
-    def extract_buoi(text_norm: str, buoi_cols: list[str]) -> str | None:
-        for b in buoi_cols:
-            if lv_norm(b) in text_norm:
-                return b
-        m = re.search(r"\bbuoi\s*(\d+)\b", text_norm)
-        if m:
-            num = m.group(1)
-            for b in buoi_cols:
-                if re.search(rf"\b{num}\b", lv_norm(b)):
-                    return b
-        return None
+# ===================== ĐÃ ĐIỂM DANH (DÙNG CHUNG MỌI PHIÊN) =====================
+CHECKIN_SEEN_TTL = 6 * 3600   # giây; đổi qua Secrets/ENV `checkin_seen_ttl`
 
-    def extract_to(text_norm: str) -> str | None:
-        m = re.search(r"\bto\s*([a-z0-9]+)\b", text_norm)
-        return m.group(1) if m else None
-
-    def looks_like_mssv(s: str) -> bool:
-        s = re.sub(r"\D", "", s or "")
-        return len(s) >= 7
-
-    def extract_mssv(text_norm: str) -> str | None:
-        m = re.search(r"(?:mssv|sv|student)\s*([0-9]{6,})", text_norm)
-        if m: return m.group(1)
-        m2 = re.search(r"\b([0-9]{7,})\b", text_norm)
-        return m2.group(1) if m2 else None
-
-    def find_student_row(records: list[dict], mssv_or_name: str) -> dict | None:
-        if looks_like_mssv(mssv_or_name):
-            ms = re.sub(r"\D", "", mssv_or_name)
-            for r in records:
-                if re.sub(r"\D", "", str(r.get("MSSV",""))) == ms:
-                    return r
-        target = lv_norm(mssv_or_name)
-        names = [r.get("Họ và Tên","") for r in records]
-        name_map = {n: r for n, r in zip(names, records)}
-        for n in names:
-            if target and target in lv_norm(n):
-                return name_map[n]
-        cand = get_close_matches(mssv_or_name, names, n=1, cutoff=0.6)
-        return name_map[cand[0]] if cand else None
-
-    def extract_name_candidate(text_norm: str) -> str | None:
-        stop = {
-            "buoi","buổi","to","tổ","mssv","sv","student",
-            "di","đi","hoc","học","co","có","mat","mặt","vang","vắng",
-            "khong","không","ai","nhat","nhất","som","sớm","muon","muộn",
-            "den","đến","tre","trễ","bao","nhiu","nhieu","bao nhieu",
-            "ty","le","ty le","chuyen","can","chuyên","cần","trung","binh","trung binh",
-            "la","là","khong di","co di","khong co mat"
-        }
-        tokens = re.findall(r"[a-zA-ZÀ-ỹ0-9]+", text_norm)
-        remain = [t for t in tokens if t not in stop and not t.isdigit()]
-        name = " ".join(remain).strip()
-        return name if name else None
-
-    # ===== Dò cột Buổi + Thời gian (linh hoạt) =====
-    def detect_buoi_columns(headers: list[str]) -> list[str]:
-        cols = []
-        for h in headers:
-            hn = norm_search(h).replace("_", " ").replace("-", " ")
-            if re.match(r"^(b|bu|buoi)\s*\d+$", hn):
-                cols.append(h); continue
-            if hn.startswith("buoi ") and re.search(r"\d+", hn):
-                cols.append(h); continue
-            if norm_search(h).startswith("buổi ") and re.search(r"\d+", norm_search(h)):
-                cols.append(h); continue
-        seen, out = set(), []
-        for h in cols:
-            if h not in seen:
-                seen.add(h); out.append(h)
-        return out
-
-    def build_time_map(headers: list[str], buoi_cols: list[str]) -> dict[str,int|None]:
-        name_to_idx = {h: i+1 for i, h in enumerate(headers)}
-        time_map = {}
-        for b in buoi_cols:
-            idx = name_to_idx[b]
-            m = re.search(r"(\d+)", b)
-            num = m.group(1) if m else None
-            tcol = None
-            if num:
-                for i, h in enumerate(headers, start=1):
-                    hn = norm_search(h)
-                    if (("thời gian" in h.lower()) or ("thoi gian" in hn) or ("time" in h.lower())) and re.search(rf"\b{num}\b", hn):
-                        tcol = i; break
-            if not tcol and idx < len(headers):
-                right = headers[idx]  # cột bên phải (1-based -> headers[idx])
-                hn = norm_search(right)
-                if ("thời gian" in right.lower()) or ("time" in right.lower()) or ("thoi gian" in hn):
-                    tcol = idx + 1
-            time_map[b] = tcol
-        return time_map
-
-    def parse_time(val: str) -> datetime.datetime | None:
-        if not val: return None
-        val = str(val).strip()
-        fmts = ["%Y-%m-%d %H:%M:%S", "%d/%m/%Y %H:%M:%S", "%H:%M:%S", "%H:%M"]
-        for fmt in fmts:
-            try:
-                dt = datetime.datetime.strptime(val, fmt)
-                if fmt in ("%H:%M:%S", "%H:%M"):
-                    today = datetime.datetime.now(VN_TZ).date()
-                    dt = datetime.datetime.combine(today, dt.time())
-                return dt.replace(tzinfo=VN_TZ)
-            except Exception:
-                continue
-        return None
+class CheckinRegistry:
+    """Tập (worksheet, buổi, MSSV) đã có mặt, dùng chung mọi phiên, có TTL.
 
-    def answer(q_user: str) -> str:
-        qn = norm_search(q_user)  # bỏ dấu + lower
-        sheet = get_sheet()
-        records = load_records(sheet)
-        if not records:
-            return "Không có dữ liệu trong Sheet."
-
-        headers = sheet.row_values(1)
-        buoi_cols = detect_buoi_columns(headers)
-        if not buoi_cols:
-            return "Không tìm thấy các cột 'Buổi ...' trong Sheet."
-        time_map = build_time_map(headers, buoi_cols)
-        total_sv = len(records)
-
-        # ------ sớm nhất / muộn nhất theo cột thời gian ------
-        ask_earliest = fuzzy_has(qn, ["som nhat", "sớm nhất", "den som nhat", "som nhut", "somnha"])
-        ask_latest   = fuzzy_has(qn, ["muon nhat", "muộn nhất", "den muon nhat", "den tre nhat", "tre nhat"])
-        if ask_earliest or ask_latest:
-            b = extract_buoi(qn, buoi_cols) or buoi_cols[-1]
-            t_col = time_map.get(b)
-            if not t_col:
-                return f"Không tìm thấy cột thời gian ứng với “{b}”."
-
-            best_row, best_time = None, None
-            for r_idx, r in enumerate(records, start=2):
-                if not attendance_flag(r.get(b,"")):
-                    continue
-                try:
-                    t_val = sheet.cell(r_idx, t_col).value
-                except Exception:
-                    t_val = ""
-                t_parsed = parse_time(t_val)
-                if not t_parsed:
-                    continue
-                if best_time is None:
-                    best_time, best_row = t_parsed, r
-                else:
-                    if ask_earliest and t_parsed < best_time:
-                        best_time, best_row = t_parsed, r
-                    if ask_latest and t_parsed > best_time:
-                        best_time, best_row = t_parsed, r
-            if best_row is None:
-                return f"Chưa có dữ liệu thời gian hợp lệ cho {b}."
-            name = best_row.get("Họ và Tên","(không tên)")
-            ms   = best_row.get("MSSV","?")
-            kind = "sớm nhất" if ask_earliest else "muộn nhất"
-            return f"👤 {name} ({ms}) là người {kind} trong {b}: {best_time.strftime('%Y-%m-%d %H:%M:%S')}."
-
-        # ------ “Buổi X <tên> có đi học không?” → liệt kê tất cả tên khớp ------
-        if any(w in qn for w in ["di hoc","co mat","vang","khong"]):
-            b = extract_buoi(qn, buoi_cols)
-            if b:
-                name_guess = extract_name_candidate(qn)
-                if name_guess:
-                    target_norm = norm_search(name_guess)
-                    matches = [r for r in records if target_norm in norm_search(r.get("Họ và Tên",""))]
-                    if not matches:
-                        names = [r.get("Họ và Tên","") for r in records]
-                        close = get_close_matches(name_guess, names, n=5, cutoff=0.6)
-                        name_map = {n: r for n, r in zip(names, records)}
-                        matches = [name_map[n] for n in close]
-                    if not matches:
-                        return f"Không tìm thấy sinh viên nào khớp với “{name_guess}”."
-                    lines = []
-                    for r in matches:
-                        flag = "✅" if attendance_flag(r.get(b,"")) else "❌"
-                        lines.append(f"- {r.get('Họ và Tên','(không tên)')} ({r.get('MSSV','?')}): {flag} tại {b}")
-                    return f"Kết quả cho “{name_guess}” ở {b}:\n" + "\n".join(lines)
-
-        # ------ Thống kê theo buổi / tổng quan ------
-        if any(w in qn for w in ["bao nhieu","di hoc","co mat","vang"]):
-            present = {b: sum(1 for r in records if attendance_flag(r.get(b,""))) for b in buoi_cols}
-            b = extract_buoi(qn, buoi_cols)
-            if b:
-                p = present[b]; a = total_sv - p
-                return f"{b}: {p}/{total_sv} có mặt, {a} vắng ({(p/total_sv*100):.1f}%)."
-            total_present_all = sum(present.values())
-            total_slots = total_sv * len(buoi_cols)
-            rate = total_present_all/total_slots*100 if total_slots else 0
-            return f"Tổng tất cả buổi: {total_present_all}/{total_slots} lượt có mặt (~{rate:.1f}%)."
-
-        # ------ Theo tổ ------
-        if " to " in f" {qn} " or re.search(r"\bto\b", qn):
-            b = extract_buoi(qn, buoi_cols) or buoi_cols[-1]
-            target_to = extract_to(qn)
-            stats = {}
-            for r in records:
-                g = str(r.get("Tổ","")).strip() or "Chưa rõ"
-                stats.setdefault(g, {"present":0,"absent":0})
-                if attendance_flag(r.get(b,"")):
-                    stats[g]["present"] += 1
-                else:
-                    stats[g]["absent"] += 1
-            if target_to and target_to in stats:
-                v = stats[target_to]; tot = v["present"]+v["absent"]
-                rate = v["present"]/tot*100 if tot else 0
-                return f"{b} - Tổ {target_to}: {v['present']}/{tot} có mặt ({rate:.1f}%)."
-            lines = []
-            for g, v in sorted(stats.items()):
-                tot = v["present"]+v["absent"]; rate = v["present"]/tot*100 if tot else 0
-                lines.append(f"Tổ {g}: {v['present']}/{tot} ({rate:.1f}%)")
-            return f"📊 {b} theo tổ:\n" + "\n".join(lines)
-
-        # ------ Một sinh viên cụ thể (MSSV hoặc tên) ------
-        if "mssv" in qn or re.search(r"\b[0-9]{7,}\b", qn) or any(k in qn for k in ["sv ","sinh vien","sinhvien"]):
-            mssv = extract_mssv(qn)
-            target = mssv if mssv else q_raw
-            row = find_student_row(records, target)
-            if not row:
-                return "Không tìm thấy sinh viên tương ứng."
-            name = row.get("Họ và Tên","(không tên)")
-            ms   = row.get("MSSV","?")
-            presents = 0; marks = []
-            for b in buoi_cols:
-                flag = "✅" if attendance_flag(row.get(b,"")) else "❌"
-                if flag == "✅": presents += 1
-                marks.append(f"{b}:{flag}")
-            return f"{name} ({ms}) — {presents}/{len(buoi_cols)} buổi có mặt.\n" + ", ".join(marks)
-
-        # ------ Tỷ lệ chuyên cần trung bình ------
-        if "chuyen can" in qn or ("ty le" in qn and "buoi" not in qn):
-            total_present_all = sum(
-                sum(1 for r in records if attendance_flag(r.get(b,"")))
-                for b in buoi_cols
-            )
-            total_slots = total_sv * len(buoi_cols)
-            rate = total_present_all/total_slots*100 if total_slots else 0
-            return f"📈 Tỷ lệ chuyên cần trung bình: {rate:.1f}%."
-
-        # ------ Danh sách vắng quá N buổi ------
-        m = re.search(r"vang\s+qua\s+(\d+)\s*buoi", qn)
-        if m:
-            limit = int(m.group(1))
-            rows = []
-            for r in records:
-                vangs = sum(1 for b in buoi_cols if not attendance_flag(r.get(b,"")))
-                if vangs > limit:
-                    rows.append(f"- {r.get('Họ và Tên','(không tên)')} ({r.get('MSSV','?')}): {vangs} buổi")
-            return "Danh sách vắng quá {} buổi:\n".format(limit) + ("\n".join(rows) if rows else "Không có.")
-
-        # ------ fallback ------
-        return ("🤔 Tôi chưa chắc ý bạn. Bạn có thể hỏi: "
-                "“Ai đi học sớm nhất buổi 2?”, “Buổi 1 Thái có đi học không?”, "
-                "“Buổi 3 có bao nhiêu SV đi học?”, “MSSV 5112xxxx đi mấy buổi?”")
+    Lượt quét lại (máy khác, F5 mất phiên) được trả lời từ bộ nhớ, không gọi Sheets.
+    """
 
-    if st.button("Hỏi trợ lý", use_container_width=True) and q_raw.strip():
+    def __init__(self, ttl: float = CHECKIN_SEEN_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._items = {}   # (ws_key, buoi, mssv) -> (thời gian điểm danh, họ tên, hết hạn, lúc thêm)
+        self._inflight = {}  # (ws_key, buoi, mssv) -> [Lock, số lượt đang giữ/chờ]
+
+    def add(self, wskey, buoi: str, mssv: str, ts: str, name: str):
+        now = time.monotonic()
+        with self._lock:
+            self._items[(wskey, buoi, mssv)] = (ts, name, now + self.ttl, now)
+
+    def get(self, wskey, buoi: str, mssv: str) -> tuple[str, str] | None:
+        """(thời gian điểm danh, họ tên trên Sheet) hoặc None nếu chưa biết / đã hết hạn."""
+        key = (wskey, buoi, mssv)
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if item[2] < time.monotonic():
+                del self._items[key]
+                return None
+            return item[0], item[1]
+
+    @contextlib.contextmanager
+    def hold(self, wskey, buoi: str, mssv: str):
+        """Lượt điểm danh cùng 1 SV/buổi chạy lần lượt: lượt quét trùng chờ lượt đầu xong
+        rồi đọc lại bộ nhớ, không ghi đè thời gian điểm danh gốc."""
+        key = (wskey, buoi, mssv)
+        with self._lock:
+            entry = self._inflight.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
         try:
-            st.markdown(f"**Trả lời:**\n\n{answer(q_raw)}")
-        except Exception as e:
-            st.error(f"❌ Lỗi khi xử lý câu hỏi: {e}")
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    self._inflight.pop(key, None)
+
+    def load_snapshot(self, sheet, snap: RosterSnapshot):
+        """Đồng bộ với snapshot vừa tải: thêm ô đã có mặt, bỏ ô đã bị xóa tay trên Sheet."""
+        wskey = _ws_key(sheet)
+        schema = SheetSchema(snap.headers)
+        if schema.mssv_col is None:
+            return
+        mssvs = [mssv_digits(r.get("MSSV")) for r in snap.records]
+        fresh = {}
+        for buoi in schema.buoi_cols:
+            tcol = schema.checkin_time_col(schema.col(buoi), buoi)
+            t_h = schema.headers[tcol-1] if tcol else None
+            for rec, mssv in zip(snap.records, mssvs):
+                if mssv and attendance_flag(rec.get(buoi)):
+                    fresh[(wskey, buoi, mssv)] = (str(rec.get(t_h, "")) if t_h else "",
+                                                  str(rec.get("Họ và Tên", "")))
+        now = time.monotonic()
+        with self._lock:
+            for key, item in list(self._items.items()):
+                # chỉ bỏ mục thêm trước lúc tải: mục mới hơn có thể chưa kịp lên snapshot
+                if item[2] < now or (key[0] == wskey and key not in fresh and item[3] < snap.loaded_at):
+                    del self._items[key]
+            for key, (ts, name) in fresh.items():
+                old = self._items.get(key)
+                self._items[key] = (ts or (old[0] if old else ""), name, now + self.ttl, now)
+
+    def __len__(self):
+        return len(self._items)
 
-# ===================== luồng trang: SV / GV =====================
-qp = get_query_params()
+@st.cache_resource
+def get_checkin_registry() -> CheckinRegistry:
+    return CheckinRegistry(ttl=float(get_setting("checkin_seen_ttl", CHECKIN_SEEN_TTL)))
+
+# ===================== HÀNG ĐỢI ĐIỂM DANH (ADMISSION CONTROL) =====================
+CHECKIN_WORKERS = 4           # số lượt điểm danh chạy đồng thời tới Sheets; Secrets/ENV `checkin_workers`
+CHECKIN_QUEUE_MAX = 400       # số lượt chờ tối đa, quá thì báo bận; Secrets/ENV `checkin_queue_max`
+CHECKIN_POLL_SECONDS = 0.5    # chu kỳ cập nhật vị trí/thời gian chờ trên màn hình SV
+
+class CheckinTicket:
+    """1 lượt điểm danh đã vào CheckinQueue: chờ, xem vị trí/ETA, lấy kết quả."""
+
+    def __init__(self, queue: CheckinQueue, seq: int, fn, args: tuple):
+        self.seq = seq
+        self._queue = queue
+        self._fn, self._args = fn, args
+        self._ctx = contextvars.copy_context()   # giữ mức ưu tiên API và số đo của lượt tải trang
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def wait(self, timeout: float | None = None) -> bool:
+        return self._done.wait(timeout)
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def result(self):
+        """Kết quả của fn; lỗi trong lúc chạy được ném lại ở đây."""
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def position(self) -> int:
+        """Vị trí trong hàng chờ (1 = kế tiếp); 0 khi đã tới lượt."""
+        return self._queue.position(self)
+
+    def eta(self) -> float:
+        """Ước tính số giây còn phải chờ tới khi có kết quả."""
+        return self._queue.eta(self)
+
+class CheckinQueue:
+    """Hàng đợi FIFO dùng chung tiến trình, số worker cố định chạy các lượt điểm danh.
+
+    Khi cả giảng đường quét cùng lúc, chỉ `workers` lượt gọi Sheets đồng thời; các lượt còn lại
+    xếp hàng theo thứ tự tới và được báo vị trí + thời gian chờ thay vì lỗi.
+    """
+
+    def __init__(self, workers: int = CHECKIN_WORKERS, max_waiting: int = CHECKIN_QUEUE_MAX):
+        self.workers = max(1, int(workers))
+        self.max_waiting = max(1, int(max_waiting))
+        self._cond = threading.Condition()
+        self._waiting = deque()
+        self._issued = 0
+        self._started = 0    # FIFO: các vé seq < _started đã được lấy ra chạy
+        self._running = 0
+        self._service = None  # EWMA thời gian chạy 1 lượt (giây)
+        self._threads = []
+
+    def submit(self, fn, *args) -> CheckinTicket:
+        with self._cond:
+            if len(self._waiting) >= self.max_waiting:
+                raise SheetsBusyError("Hàng đợi điểm danh đã đầy")
+            ticket = CheckinTicket(self, self._issued, fn, args)
+            self._issued += 1
+            self._waiting.append(ticket)
+            if len(self._threads) < self.workers:
+                t = threading.Thread(target=self._worker, name=f"checkin-{len(self._threads)}", daemon=True)
+                self._threads.append(t)
+                t.start()
+            self._cond.notify()
+        return ticket
+
+    def position(self, ticket: CheckinTicket) -> int:
+        with self._cond:
+            return 0 if ticket.started_at is not None else ticket.seq - self._started + 1
+
+    def eta(self, ticket: CheckinTicket) -> float:
+        with self._cond:
+            service = self._service or 1.0
+            if ticket.started_at is not None:
+                return max(0.0, service - (time.monotonic() - ticket.started_at))
+            ahead = ticket.seq - self._started    # số lượt còn chờ đứng trước
+            return ((ahead // self.workers) + 1) * service
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"waiting": len(self._waiting), "running": self._running,
+                    "workers": self.workers, "service_s": self._service}
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._waiting:
+                    self._cond.wait()
+                ticket = self._waiting.popleft()
+                ticket.started_at = time.monotonic()
+                self._started += 1
+                self._running += 1
+            get_metrics().record("checkin", "queue_wait", ticket.started_at - ticket.enqueued_at)
+            try:
+                ticket._result = ticket._ctx.run(ticket._fn, *ticket._args)
+            except Exception as e:
+                ticket._error = e
+            finally:
+                spent = time.monotonic() - ticket.started_at
+                with self._cond:
+                    self._running -= 1
+                    self._service = spent if self._service is None else 0.8 * self._service + 0.2 * spent
+                ticket._done.set()
+
+@st.cache_resource
+def get_checkin_queue() -> CheckinQueue:
+    return CheckinQueue(workers=int(get_setting("checkin_workers", CHECKIN_WORKERS)),
+                        max_waiting=int(get_setting("checkin_queue_max", CHECKIN_QUEUE_MAX)))
+
+# ===================== ĐIỂM DANH (logic, không phụ thuộc giao diện) =====================
+CHECKIN_OK = "ok"
+CHECKIN_ALREADY = "already"
+CHECKIN_NOT_FOUND = "not_found"
+CHECKIN_NAME_MISMATCH = "name_mismatch"
+
+def checkin_from_memory(sheet, buoi: str, mssv_suffix: str, hoten: str) -> tuple[str, str] | None:
+    """Quét lại (máy khác, mất phiên): trả lời từ bộ nhớ, không gọi Sheets, không cần xếp hàng.
+
+    None nếu phải đi đường đầy đủ (chưa thấy, hoặc họ tên không khớp để báo lỗi như bình thường).
+    """
+    full_mssv = f"{MSSV_PREFIX}{mssv_suffix.strip().zfill(4)}"
+    seen = get_checkin_registry().get(_ws_key(sheet), buoi, full_mssv)
+    if seen is not None and normalize_name(seen[1]) == normalize_name(hoten):
+        return CHECKIN_ALREADY, (f"✅ MSSV **{full_mssv}** đã điểm danh trước đó"
+                                 + (f" lúc **{seen[0]}**." if seen[0] else "."))
+    return None
+
+def _checkin_row_values(sheet, roster: RosterSnapshot, journal, row: int) -> list:
+    if journal is not None:
+        rec = roster.record_at(row) or {}
+        return [rec.get(h, "") for h in roster.headers]
+    return sheet.row_values(row)
+
+def _row_mssv_matches(val, full_mssv: str, suffix: str) -> bool:
+    """MSSV đọc ở dòng có đúng là MSSV đang tìm (cùng quy tắc với MssvIndex.find_row)."""
+    ms = mssv_digits(val)
+    return ms == full_mssv or (ms.startswith(MSSV_PREFIX) and ms[-4:] == suffix)
+
+def checkin_student(sheet, buoi: str, mssv_suffix: str, hoten: str) -> tuple[str, str]:
+    """Điểm danh 1 SV vào cột `buoi`. Trả (trạng thái CHECKIN_*, thông báo hiển thị).
+
+    Lỗi Sheets (kể cả SheetsBusyError) được ném ra cho nơi gọi xử lý.
+    """
+    suffix = mssv_suffix.strip().zfill(4)
+    full_mssv = f"{MSSV_PREFIX}{suffix}"
+    registry = get_checkin_registry()
+    wskey = _ws_key(sheet)
+
+    if (fast := checkin_from_memory(sheet, buoi, suffix, hoten)) is not None:
+        return fast
+    with registry.hold(wskey, buoi, full_mssv), api_priority(PRIORITY_CHECKIN):
+        if (fast := checkin_from_memory(sheet, buoi, suffix, hoten)) is not None:
+            return fast
+        sheet = use_sheet(sheet)
+        journal = get_journal()
+        roster = get_roster(sheet)
+        col_buoi = find_header_col(sheet, buoi)
+
+        # Tìm hàng theo chỉ mục MSSV của snapshot (không gọi API);
+        # không thấy thì nạp lại snapshot 1 lần phòng khi danh sách vừa được bổ sung
+        row_mssv = roster.mssv_index().find_row(full_mssv, suffix)
+        if row_mssv is None:
+            roster = get_roster_cache().refresh(sheet, min_age=ROSTER_MISS_REFRESH)
+            row_mssv = roster.mssv_index().find_row(full_mssv, suffix)
+        if row_mssv is None:
+            return CHECKIN_NOT_FOUND, f"❌ Không tìm thấy MSSV **{full_mssv}** trong danh sách."
+
+        # Đọc 1 lần cả dòng của SV (họ tên, dấu điểm danh, thời gian);
+        # chế độ nhật ký cục bộ thì đọc từ snapshot (đã phủ các lượt chưa đồng bộ)
+        row_vals = _checkin_row_values(sheet, roster, journal, row_mssv)
+        mssv_col, name_col = find_header_col(sheet, "MSSV"), find_header_col(sheet, "Họ và Tên")
+
+        # Dòng đọc về không phải SV này (Sheet vừa bị sắp xếp / chèn dòng) hoặc họ tên lệch:
+        # chỉ mục có thể đã cũ -> nạp lại snapshot 1 lần rồi tra lại trước khi báo lỗi
+        mssv_ok = _row_mssv_matches(row_cell(row_vals, mssv_col), full_mssv, suffix)
+        if not mssv_ok or normalize_name(row_cell(row_vals, name_col)) != normalize_name(hoten):
+            fresh = get_roster_cache().refresh(sheet, min_age=0 if not mssv_ok else ROSTER_MISS_REFRESH)
+            if fresh is not roster:
+                roster = fresh
+                row_mssv = roster.mssv_index().find_row(full_mssv, suffix)
+                if row_mssv is None:
+                    return CHECKIN_NOT_FOUND, f"❌ Không tìm thấy MSSV **{full_mssv}** trong danh sách."
+                row_vals = _checkin_row_values(sheet, roster, journal, row_mssv)
+        if not _row_mssv_matches(row_cell(row_vals, mssv_col), full_mssv, suffix):
+            raise SheetsBusyError("Danh sách đang được chỉnh sửa, vui lòng thử lại sau ít giây.")
+
+        # Kiểm tra họ tên khớp
+        hoten_sheet = row_cell(row_vals, name_col)
+        if normalize_name(hoten_sheet or "") != normalize_name(hoten):
+            return CHECKIN_NAME_MISMATCH, "❌ Họ tên không khớp với MSSV trong danh sách."
+
+        # Kiểm tra đã điểm danh trước đó
+        curr_mark = row_cell(row_vals, col_buoi).strip()
+        time_col = find_or_create_time_col(sheet, col_buoi, buoi)
+        if curr_mark:
+            exist_time = row_cell(row_vals, time_col)
+            registry.add(wskey, buoi, full_mssv, exist_time, hoten_sheet)
+            return CHECKIN_ALREADY, (f"✅ MSSV **{full_mssv}** đã điểm danh trước đó"
+                                     + (f" lúc **{exist_time}**." if exist_time else "."))
+
+        now_str = datetime.datetime.now(VN_TZ).strftime("%Y-%m-%d %H:%M:%S")
+        if journal is not None:
+            # Ghi vào nhật ký SQLite rồi xác nhận ngay; luồng nền sẽ đẩy lên Sheet
+            is_new, ts = journal.record(journal_key(sheet), buoi, full_mssv,
+                                        row_mssv, col_buoi, time_col, now_str)
+            if not is_new:
+                registry.add(wskey, buoi, full_mssv, ts, hoten_sheet)
+                return CHECKIN_ALREADY, f"✅ MSSV **{full_mssv}** đã điểm danh trước đó lúc **{ts}**."
+            get_roster_cache().patch_cells(sheet, {(row_mssv, col_buoi): "✅", (row_mssv, time_col): now_str})
+            get_journal_syncer().wake()
+        else:
+            # Ghi ✅ và thời gian thực (qua hàng đợi ghi theo lô, chờ xác nhận)
+            write_cells_confirmed(sheet, [
+                (row_mssv, col_buoi, "✅"),
+                (row_mssv, time_col, now_str),
+            ])
+        registry.add(wskey, buoi, full_mssv, now_str, hoten_sheet)
+        return CHECKIN_OK, f"🎉 Điểm danh thành công! MSSV **{full_mssv}** ({now_str})."
 
-# ---------- MÀN HÌNH SINH VIÊN ----------
-if qp.get("sv") == "1":
+# ===================== luồng trang: SV / GV =====================
+def render_student_page(qp: dict):
     buoi_sv = qp.get("buoi", "Buổi 1")
     token_qr = qp.get("t", "")
+    class_sv = qp.get("class") or next(iter(get_classes()))   # QR cũ (không có class) -> lớp mặc định
 
-    lock_key = f"locked_{buoi_sv}"
-    info_key = f"lock_info_{buoi_sv}"
+    lock_key = f"locked_{class_sv}_{buoi_sv}"
+    info_key = f"lock_info_{class_sv}_{buoi_sv}"
 
     st.title("🎓 Điểm danh sinh viên")
-    st.info(f"Bạn đang điểm danh cho **{buoi_sv}**")
+    if class_sv not in get_classes():
+        st.error("❌ Mã lớp trong link không hợp lệ. Vui lòng quét lại mã QR trên màn chiếu.")
+        st.stop()
+    st.info(f"Bạn đang điểm danh cho **{buoi_sv}**"
+            + (f" • lớp **{class_sv}**" if len(get_classes()) > 1 else ""))
 
     # Nếu đã khóa vì đã điểm danh
     if st.session_state.get(lock_key):
@@ -652,7 +2880,8 @@ if qp.get("sv") == "1":
         st.stop()
 
     # ===== Mở khóa phiên theo session_state để tránh 'hết hạn' khi rerun =====
-    unlock_key = f"sv_unlocked_{buoi_sv}"      # lưu {'ts': epoch, 't': token}
+    unlock_key = f"sv_unlocked_{class_sv}_{buoi_sv}"   # lưu {'ts': epoch, 't': token}
+    ticket_key = f"checkin_ticket_{class_sv}_{buoi_sv}"  # lượt đang xếp hàng (giữ qua các lần rerun)
     now_epoch = time.time()
     uinfo = st.session_state.get(unlock_key)
 
@@ -667,7 +2896,7 @@ if qp.get("sv") == "1":
         st.session_state[unlock_key] = {"ts": now_epoch, "t": str(token_qr)}
     else:
         # Đã mở khóa -> cho dùng tiếp trong TTL mà KHÔNG kiểm token nữa
-        if now_epoch - uinfo["ts"] > UNLOCK_TTL:
+        if now_epoch - uinfo["ts"] > UNLOCK_TTL and ticket_key not in st.session_state:
             st.warning("Phiên điểm danh đã hết thời gian. Vui lòng quét mã QR mới.")
             del st.session_state[unlock_key]
             st.stop()
@@ -685,7 +2914,17 @@ if qp.get("sv") == "1":
         full_mssv_preview = f"{MSSV_PREFIX}{mssv_suffix.strip().zfill(4)}"
         st.caption(f"MSSV đầy đủ: **{full_mssv_preview}**")
 
-    if st.button("✅ Xác nhận điểm danh", use_container_width=True):
+    def _show_result(status: str, msg: str):
+        if status in (CHECKIN_OK, CHECKIN_ALREADY):
+            (st.success if status == CHECKIN_OK else st.info)(msg)
+            st.session_state[lock_key] = True
+            st.session_state[info_key] = msg
+            st.rerun()
+        st.error(msg)
+
+    busy_msg = "⏳ Hệ thống đang đông, vui lòng bấm **Xác nhận điểm danh** lại sau ít giây."
+    queued = ticket_key in st.session_state
+    if st.button("✅ Xác nhận điểm danh", use_container_width=True, disabled=queued) and not queued:
         if not mssv_suffix.strip().isdigit() or len(mssv_suffix.strip()) != 4:
             st.warning("⚠️ Vui lòng nhập **đúng 4 số cuối** MSSV (chỉ số).")
             st.stop()
@@ -693,118 +2932,168 @@ if qp.get("sv") == "1":
             st.warning("⚠️ Vui lòng nhập họ và tên.")
             st.stop()
 
-        full_mssv = f"{MSSV_PREFIX}{mssv_suffix.strip().zfill(4)}"
-
         try:
-            sheet = get_sheet()
-            col_buoi = find_header_col(sheet, buoi_sv)
-
-            # Tìm hàng theo MSSV đầy đủ; nếu không thấy, fallback quét records
-            try:
-                cell_mssv = sheet.find(full_mssv)
-            except Exception:
-                cell_mssv = None
-
-            if not cell_mssv:
-                records = load_records(sheet)
-                target_row = None
-                for idx, r in enumerate(records, start=2):
-                    ms = str(r.get("MSSV", "")).strip()
-                    ms_norm = re.sub(r"\D", "", ms) if ms else ""
-                    if ms_norm.startswith(MSSV_PREFIX) and ms_norm.endswith(mssv_suffix.strip().zfill(4)):
-                        target_row = idx
-                        break
-                if target_row:
-                    class DummyCell:
-                        def __init__(self, row): self.row = row
-                    cell_mssv = DummyCell(target_row)
-
-            if not cell_mssv:
-                st.error(f"❌ Không tìm thấy MSSV **{full_mssv}** trong danh sách.")
-                st.stop()
-
-            # Kiểm tra họ tên khớp
-            hoten_sheet = sheet.cell(cell_mssv.row, find_header_col(sheet, "Họ và Tên")).value
-            if normalize_name(hoten_sheet or "") != normalize_name(hoten):
-                st.error("❌ Họ tên không khớp với MSSV trong danh sách.")
-                st.stop()
-
-            # Kiểm tra đã điểm danh trước đó
-            curr_mark = (sheet.cell(cell_mssv.row, col_buoi).value or "").strip()
-            time_col = find_or_create_time_col(sheet, col_buoi, buoi_sv)
-            if curr_mark:
-                exist_time = sheet.cell(cell_mssv.row, time_col).value or ""
-                msg = f"✅ MSSV **{full_mssv}** đã điểm danh trước đó" + (f" lúc **{exist_time}**." if exist_time else ".")
-                st.info(msg)
-                st.session_state[lock_key] = True
-                st.session_state[info_key] = msg
-                st.rerun()
-
-            # Ghi ✅ và thời gian thực
-            sheet.update_cell(cell_mssv.row, col_buoi, "✅")
-            now_str = datetime.datetime.now(VN_TZ).strftime("%Y-%m-%d %H:%M:%S")
-            sheet.update_cell(cell_mssv.row, time_col, now_str)
-
-            msg = f"🎉 Điểm danh thành công! MSSV **{full_mssv}** ({now_str})."
-            st.success(msg)
-            st.session_state[lock_key] = True
-            st.session_state[info_key] = msg
-            st.rerun()
+            sheet = get_sheet(class_sv)
+            if (fast := checkin_from_memory(sheet, buoi_sv, mssv_suffix, hoten)) is not None:
+                _show_result(*fast)   # st.rerun() không phải Exception nên đi qua các except dưới
+            st.session_state[ticket_key] = get_checkin_queue().submit(
+                checkin_student, sheet, buoi_sv, mssv_suffix, hoten)
+        except SheetsBusyError:
+            st.warning(busy_msg)
+        except Exception as e:
+            st.error(f"❌ Lỗi khi điểm danh: {e}")
 
+    # Đang xếp hàng: báo vị trí + thời gian chờ, gia hạn ân hạn phiên tới khi có kết quả.
+    # Rerun giữa chừng (SV bấm lại, đổi ô nhập) chỉ chờ tiếp vé cũ, không gửi thêm lượt mới.
+    ticket = st.session_state.get(ticket_key)
+    if ticket is not None:
+        box = st.empty()
+        while not ticket.wait(CHECKIN_POLL_SECONDS):
+            st.session_state[unlock_key]["ts"] = time.time()
+            pos = ticket.position()
+            if pos:
+                box.info(f"⏳ Đang xếp hàng điểm danh: bạn ở vị trí **{pos}**, "
+                         f"ước tính còn khoảng **{max(1, round(ticket.eta()))} giây**. Vui lòng giữ nguyên trang.")
+            else:
+                box.info("⏳ Đang ghi điểm danh…")
+        box.empty()
+        st.session_state[unlock_key]["ts"] = time.time()
+        del st.session_state[ticket_key]
+        try:
+            status, msg = ticket.result()
+        except SheetsBusyError:
+            st.warning(busy_msg)
         except Exception as e:
             st.error(f"❌ Lỗi khi điểm danh: {e}")
+        else:
+            _show_result(status, msg)
 
     st.stop()
 
-# ---------- MÀN HÌNH GIẢNG VIÊN ----------
-render_gv_auth()
-st.title("📋 Hệ thống điểm danh QR")
-
-if not gv_unlocked():
-    st.error("🔒 Bạn chưa đăng nhập Giảng viên. Vào **Sidebar → Đăng nhập Giảng viên** để mở khóa.")
-    st.stop()
+def render_perf_panel():
+    """Bảng số đo hiệu năng (chỉ GV): lượt tải trang trước của phiên này + cửa sổ trượt mọi phiên."""
+    metrics = get_metrics()
+    with st.expander("⏱️ Hiệu năng", expanded=False):
+        last = st.session_state.get("_perf_last_rerun")
+        if last is not None:
+            st.caption(f"Lượt tải trang trước: **{last.wall * 1000:.0f} ms**")
+            st.dataframe(pd.DataFrame(last.rows()), hide_index=True, use_container_width=True)
+        q = get_checkin_queue().stats()
+        st.caption(f"Hàng đợi điểm danh: **{q['waiting']}** chờ • **{q['running']}/{q['workers']}** đang ghi")
+        st.caption(f"Mọi phiên, {int(metrics.window)} giây gần nhất")
+        rows = metrics.summary()
+        if rows:
+            st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+        else:
+            st.caption("Chưa có số đo.")
+        st.download_button("⬇️ Xuất JSON lines", metrics.events_jsonl().encode("utf-8"),
+                           file_name="qrlecturer_metrics.jsonl", mime="application/x-ndjson",
+                           use_container_width=True)
 
-# Điều hướng ở Sidebar
-with st.sidebar:
-    st.markdown("---")
-    st.markdown("**📂 Điều hướng**")
-    menu = st.radio(
-        "Chọn mục",
-        options=["👨‍🏫 Giảng viên (QR động)", "🔎 Tìm kiếm", "📊 Thống kê", "🤖 Trợ lý AI"],
-        index=0,
-        label_visibility="collapsed"
-    )
+def render_lecturer_page():
+    render_gv_auth()
+    st.title("📋 Hệ thống điểm danh QR")
 
-# Nội dung ở khung chính
-if menu == "👨‍🏫 Giảng viên (QR động)":
-    render_tab_gv()
-elif menu == "🔎 Tìm kiếm":
-    render_tab_search()
-elif menu == "📊 Thống kê":
-    render_tab_stats()
-else:
-    render_tab_ai()
-
-# ---------- FOOTER (bản quyền, căn giữa) ----------
-st.markdown(
-    """
-    <style>
-    .footer-dhn {
-        position: fixed;
-        left: 0; right: 0; bottom: 0;
-        padding: 8px 16px;
-        background: rgba(0,0,0,0.04);
-        color: #444;
-        font-size: 12px;
-        text-align: center;
-        z-index: 1000;
-        border-top: 1px solid rgba(0,0,0,0.1);
-        width: 100%;
-    }
-    </style>
-    <div class="footer-dhn">© Bản quyền thuộc về <strong>TS. Đào Hồng Nam - Đại học Y Dược Thành phố Hồ Chí Minh</strong></div>
-    """,
-    unsafe_allow_html=True
-)
+    if not gv_unlocked():
+        st.error("🔒 Bạn chưa đăng nhập Giảng viên. Vào **Sidebar → Đăng nhập Giảng viên** để mở khóa.")
+        st.stop()
 
+    classes = list(get_classes())
+    # Điều hướng ở Sidebar
+    with st.sidebar:
+        st.markdown("---")
+        if len(classes) > 1:
+            qp_class = get_query_params().get("class")
+            st.selectbox("🏫 Lớp", classes, key="class_gv",
+                         index=classes.index(qp_class) if qp_class in classes else 0)
+        st.markdown("**📂 Điều hướng**")
+        options = ["👨‍🏫 Giảng viên (QR động)", "🔎 Tìm kiếm", "📊 Thống kê", "🤖 Trợ lý AI", "📤 Xuất / Nhập"]
+        if len(classes) > 1:
+            options.append("🏫 Các lớp")
+        menu = st.radio(
+            "Chọn mục",
+            options=options,
+            index=0,
+            label_visibility="collapsed"
+        )
+        st.markdown("---")
+        if get_journal() is not None:
+            jc = get_journal().counts()
+            st.caption(f"💾 Nhật ký cục bộ: {jc['total']} lượt, {jc['pending']} lượt chờ đồng bộ lên Sheets")
+        if st.button("🔄 Tải lại dữ liệu Sheet", use_container_width=True,
+                     help="Đọc lại dòng tiêu đề và danh sách (khi vừa sửa Sheet bằng tay)"):
+            try:
+                reload_sheet_metadata()
+                st.toast("Đã tải lại cấu trúc và danh sách từ Google Sheets.")
+            except Exception as e:
+                st.error(f"❌ Lỗi khi tải lại: {e}")
+        render_perf_panel()
+
+    # Chế độ nhật ký cục bộ: để bộ đồng bộ biết handle worksheet của mọi lớp (kể cả sau khi khởi động lại)
+    if get_journal() is not None:
+        for cls in classes:
+            try:
+                use_sheet(get_sheet(cls))
+            except Exception:
+                pass
+
+    # Nội dung ở khung chính
+    if menu == "👨‍🏫 Giảng viên (QR động)":
+        with timed("ui", "tab_gv"):
+            render_tab_gv()
+    elif menu == "🔎 Tìm kiếm":
+        with timed("ui", "tab_search"):
+            render_tab_search()
+    elif menu == "📊 Thống kê":
+        with timed("ui", "tab_stats"):
+            render_tab_stats()
+    elif menu == "📤 Xuất / Nhập":
+        with timed("ui", "tab_io"):
+            render_tab_io()
+    elif menu == "🏫 Các lớp":
+        with timed("ui", "tab_classes"):
+            render_tab_classes()
+    else:
+        with timed("ui", "tab_ai"):
+            render_tab_ai()
+
+    # ---------- FOOTER (bản quyền, căn giữa) ----------
+    st.markdown(
+        """
+        <style>
+        .footer-dhn {
+            position: fixed;
+            left: 0; right: 0; bottom: 0;
+            padding: 8px 16px;
+            background: rgba(0,0,0,0.04);
+            color: #444;
+            font-size: 12px;
+            text-align: center;
+            z-index: 1000;
+            border-top: 1px solid rgba(0,0,0,0.1);
+            width: 100%;
+        }
+        </style>
+        <div class="footer-dhn">© Bản quyền thuộc về <strong>TS. Đào Hồng Nam - Đại học Y Dược Thành phố Hồ Chí Minh</strong></div>
+        """,
+        unsafe_allow_html=True
+    )
 
+def main():
+    st.set_page_config(page_title="QR Lecturer", layout="wide")
+    qp = get_query_params()
+    is_student = qp.get("sv") == "1"
+    with get_metrics().rerun("student" if is_student else "lecturer") as stats:
+        try:
+            if is_student:
+                render_student_page(qp)   # ---------- MÀN HÌNH SINH VIÊN ----------
+            else:
+                render_lecturer_page()    # ---------- MÀN HÌNH GIẢNG VIÊN ----------
+        finally:
+            # lượt tải kế tiếp hiển thị số đo của lượt này (bảng ở sidebar vẽ trước các mục)
+            st.session_state["_perf_last_rerun"] = stats
+
+# `streamlit run main.py` chạy file với __name__ == "__main__"; import (load test,
+# benchmark) thì chỉ nạp các hàm, không dựng giao diện.
+if __name__ == "__main__":
+    main()
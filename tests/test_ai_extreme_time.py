@@ -0,0 +1,51 @@
+# tests/test_ai_extreme_time.py
+"""Câu hỏi "ai sớm nhất / muộn nhất buổi X" của trợ lý: số lệnh gọi Sheets không tăng theo sĩ số.
+
+    python -m pytest tests
+"""
+import logging
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from fake_sheets import FakeSpreadsheet, FakeWorksheet, synthetic_roster  # noqa: E402
+
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+main = pytest.importorskip("main")
+
+SIZES = (20, 200, 2000)
+
+def ask_calls(n: int, question: str) -> tuple[str, dict]:
+    """Trả lời `question` trên worksheet giả n SV (spreadsheet riêng -> cache riêng); trả (câu trả lời, số lệnh gọi)."""
+    values = synthetic_roster(n, present_rate=0.5, seed=n)
+    ws = FakeWorksheet(values, spreadsheet=FakeSpreadsheet(f"fake-{n}-{question}"))
+    answer = main.ask_assistant(ws, question)
+    return answer, dict(ws.calls)
+
+@pytest.mark.parametrize("question, kind", [
+    ("Ai đi học sớm nhất buổi 2?", "sớm nhất"),
+    ("Ai đến muộn nhất buổi 4?", "muộn nhất"),
+])
+def test_extreme_time_calls_constant_across_roster_sizes(question, kind):
+    results = {n: ask_calls(n, question) for n in SIZES}
+    for answer, calls in results.values():
+        assert kind in answer
+        assert "cell" not in calls   # không đọc từng ô thời gian
+    counts = {n: sum(calls.values()) for n, (_, calls) in results.items()}
+    assert len(set(counts.values())) == 1, counts
+
+def test_extreme_time_picks_earliest_and_latest():
+    values = synthetic_roster(50, present_rate=0.5, seed=7)
+    headers = values[0]
+    b, t = headers.index("Buổi 2"), headers.index("Thời gian Buổi 2")
+    present = [r for r in values[1:] if r[b]]
+    first = min(present, key=lambda r: r[t])
+    last = max(present, key=lambda r: r[t])
+    ws = FakeWorksheet(values, spreadsheet=FakeSpreadsheet("fake-pick"))
+    assert first[0] in main.ask_assistant(ws, "Ai đi học sớm nhất buổi 2?")
+    assert last[0] in main.ask_assistant(ws, "Ai đến muộn nhất buổi 2?")
@@ -0,0 +1,42 @@
+# tests/test_name_search.py
+"""NameSearchIndex: khớp gần đúng phải cho đúng kết quả của get_close_matches trên toàn bộ tên."""
+import logging
+import os
+import random
+import sys
+from difflib import get_close_matches
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from fake_sheets import synthetic_roster  # noqa: E402
+
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+main = pytest.importorskip("main")
+
+def queries(names: list[str], rnd: random.Random, k: int) -> list[str]:
+    """Tên gõ sai (có/không dấu), đảo thứ tự "Tên Họ", chỉ tên, tên ghép không có trong lớp."""
+    out = []
+    for name in rnd.sample(names, k):
+        parts = name.split()
+        typo = list(name)
+        i = rnd.randrange(len(typo))
+        typo[i] = rnd.choice("aeiouhnt")
+        out += ["".join(typo), main.strip_accents("".join(typo)), " ".join(parts[::-1]),
+                parts[-1], f"{parts[-1]} {rnd.choice(names).split()[0]}"]
+    return out
+
+@pytest.mark.parametrize("n", [300, 1000, 3000])
+def test_close_names_match_full_scan(n):
+    values = synthetic_roster(n, seed=n)
+    records = [dict(zip(values[0], r)) for r in values[1:]]
+    idx = main.NameSearchIndex(records)
+    rnd = random.Random(n)
+    for q in queries(idx.names, rnd, 15):
+        assert idx.close_names(q, n=5, cutoff=0.6) == get_close_matches(q, idx.names, n=5, cutoff=0.6), q
+        qn = main.norm_search(q)
+        want = [idx.norm_to_name[c] for c in get_close_matches(qn, idx.names_norm, n=5, cutoff=0.6)]
+        assert idx.close_names_norm(qn, n=5, cutoff=0.6) == want, q
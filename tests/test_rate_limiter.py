@@ -0,0 +1,57 @@
+# tests/test_rate_limiter.py
+"""Bộ giới hạn quota: không vượt quota của Sheets trong bất kỳ cửa sổ 60 giây nào."""
+import logging
+import os
+import sys
+from collections import deque
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from fake_sheets import FakeSpreadsheet, FakeWorksheet, synthetic_roster  # noqa: E402
+
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+main = pytest.importorskip("main")
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.mark.parametrize("per_minute", [10, 60, 300])
+def test_token_bucket_never_exceeds_quota_per_window(monkeypatch, per_minute):
+    clock = FakeClock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    bucket = main.TokenBucket(per_minute)
+    granted = []
+    for _ in range(3000):           # 300 giây, mỗi bước 0.1 s xin càng nhiều càng tốt
+        while bucket.acquire(timeout=0):
+            granted.append(clock.now)
+        clock.now += 0.1
+    window = deque()
+    for t in granted:
+        window.append(t)
+        while t - window[0] >= 60:
+            window.popleft()
+        assert len(window) <= per_minute
+    assert len(granted) >= 0.85 * per_minute * 5   # vẫn dùng gần hết quota
+
+def test_no_429_when_app_quota_equals_backend_quota(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(main.time, "monotonic", clock)   # cùng module time -> worksheet giả cũng dùng
+    ws = FakeWorksheet(synthetic_roster(20), spreadsheet=FakeSpreadsheet("fake-quota"), quota_per_min=60)
+    bucket = main.SheetsRateLimiter(60).buckets["read"]
+    for _ in range(1800):           # 180 giây dồn lệnh đọc liên tục
+        while bucket.acquire(timeout=0):
+            try:
+                ws.row_values(2)
+            except main.gspread.exceptions.APIError:
+                pass            # đếm ở ws.errors
+        clock.now += 0.1
+    assert ws.calls["row_values"] >= 150
+    assert not ws.errors